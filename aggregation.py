@@ -0,0 +1,311 @@
+import heapq
+import os
+import resource
+import struct
+import sys
+import tempfile
+from array import array
+from operator import itemgetter
+
+# compact address key: out_type byte followed by the 20 bytes hash160 / witness program, see utils.encode_key
+KEY_SIZE = 21
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """ Peak resident set size of this process in bytes, of its largest waited for child with RUSAGE_CHILDREN. """
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class AddressTable:
+    """
+    Aggregation table of compact address keys, with the same (address, value, last_height) semantics as the dict of
+    [value, height] lists it replaces, at a fraction of the memory.
+
+    Entries are stored densely in insertion order: the fixed width keys in one bytearray and the amounts and heights
+    in int64 arrays. An open addressing index (linear probing) maps the key hash to the entry position, so iteration
+    follows the insertion order like a dict does.
+    """
+
+    def __init__(self, key_size=KEY_SIZE, capacity=1 << 10):
+        assert capacity & (capacity - 1) == 0, 'capacity must be a power of 2'
+        self.key_size = key_size
+        self._keys = bytearray()
+        self._amounts = array('q')
+        self._heights = array('q')
+        # entry position + 1, 0 marks an empty slot
+        self._index = array('i', bytes(4 * capacity))
+        self._mask = capacity - 1
+        self.peak_nbytes = self.nbytes
+
+    def __len__(self):
+        return len(self._amounts)
+
+    @property
+    def nbytes(self):
+        """ Size of the buffers holding the table. """
+        return (len(self._keys) + self._amounts.buffer_info()[1] * self._amounts.itemsize
+                + self._heights.buffer_info()[1] * self._heights.itemsize
+                + self._index.buffer_info()[1] * self._index.itemsize)
+
+    def _slot(self, key):
+        # keys end with a hash, their trailing bytes are uniformly distributed already
+        return int.from_bytes(key[-8:], 'little') & self._mask
+
+    def add(self, key, amount, height):
+        """ Adds amount to the balance of key and sets its last height. """
+        assert len(key) == self.key_size, key
+        ks = self.key_size
+        keys = self._keys
+        index = self._index
+        mask = self._mask
+        slot = self._slot(key)
+        while True:
+            pos = index[slot]
+            if pos == 0:
+                break
+            pos -= 1
+            if keys[pos * ks:pos * ks + ks] == key:
+                self._amounts[pos] += amount
+                self._heights[pos] = height
+                return
+            slot = (slot + 1) & mask
+
+        keys += key
+        self._amounts.append(amount)
+        self._heights.append(height)
+        index[slot] = len(self._amounts)
+        # keep the load factor under 2/3
+        if 3 * len(self._amounts) > 2 * (mask + 1):
+            self._grow()
+
+    def _grow(self):
+        capacity = 2 * (self._mask + 1)
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes + 4 * capacity)
+        self._index = index = array('i', bytes(4 * capacity))
+        self._mask = mask = capacity - 1
+        ks = self.key_size
+        keys = self._keys
+        for pos in range(len(self._amounts)):
+            slot = self._slot(keys[pos * ks:pos * ks + ks])
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = pos + 1
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+
+    def get(self, key, default=None):
+        """ Returns (value, last_height) of key. """
+        ks = self.key_size
+        slot = self._slot(key)
+        while True:
+            pos = self._index[slot]
+            if pos == 0:
+                return default
+            pos -= 1
+            if self._keys[pos * ks:pos * ks + ks] == key:
+                return self._amounts[pos], self._heights[pos]
+            slot = (slot + 1) & self._mask
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def update(self, other):
+        """ Merges the entries of other table, as if its records were added after the records of this one. """
+        for key, amount, height in other:
+            self.add(key, amount, height)
+
+    def sorted_by_amount(self, reverse=False):
+        """
+        Yields (key, value, last_height) sorted by value, ties in insertion order. Only the value and the entry
+        position are sorted, packed in a single int per entry, instead of the (key, value, height) tuples.
+        """
+        assert len(self) <= 0xffffffff
+        if reverse:
+            order = [amount << 32 | (0xffffffff - pos) for pos, amount in enumerate(self._amounts)]
+        else:
+            order = [amount << 32 | pos for pos, amount in enumerate(self._amounts)]
+        order.sort(reverse=reverse)
+
+        ks = self.key_size
+        keys = self._keys
+        for packed in order:
+            pos = packed & 0xffffffff
+            if reverse:
+                pos = 0xffffffff - pos
+            yield bytes(keys[pos * ks:pos * ks + ks]), self._amounts[pos], self._heights[pos]
+
+    def __iter__(self):
+        """ Yields (key, value, last_height) in insertion order. """
+        ks = self.key_size
+        keys = self._keys
+        for pos, (amount, height) in enumerate(zip(self._amounts, self._heights)):
+            yield bytes(keys[pos * ks:pos * ks + ks]), amount, height
+
+
+# spilled run record: key, value, last_height
+RUN_RECORD = struct.Struct('<%dsqq' % KEY_SIZE)
+# rough memory cost of an address while a batch is aggregated and then sorted for spilling: the table entry plus the
+# tuple, bytes and int objects of the sorted list
+SPILL_ENTRY_COST = 256
+# maximum number of runs merged at once
+MAX_MERGE_FANIN = 256
+
+
+def parse_size(size):
+    """ Parses a memory size like 512M or 2G (powers of 1024) into bytes. """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def write_run(entries, tmp_dir):
+    """ Writes (key, value, last_height) entries to a new temporary run file of RUN_RECORD records, returns its path. """
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+        for entry in entries:
+            f.write(RUN_RECORD.pack(*entry))
+    return path
+
+
+def read_run(path, buffer_size):
+    """ Yields the (key, value, last_height) entries of a run file, read buffer_size bytes at a time. """
+    buffer_size = max(RUN_RECORD.size, buffer_size - buffer_size % RUN_RECORD.size)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                return
+            yield from RUN_RECORD.iter_unpack(chunk)
+
+
+def _merge_runs(paths, buffer_size):
+    """ Merges sorted runs into one sorted stream of (key, value, last_height), summing the values of equal keys. Runs
+    are given in spill order, so the last height comes from the latest run. """
+    # heapq.merge is stable, equal keys come out in run order
+    merged = heapq.merge(*[read_run(path, buffer_size) for path in paths], key=itemgetter(0))
+    last = None
+    for key, amount, height in merged:
+        if last is not None and last[0] == key:
+            last[1] += amount
+            last[2] = height
+        else:
+            if last is not None:
+                yield tuple(last)
+            last = [key, amount, height]
+    if last is not None:
+        yield tuple(last)
+
+
+class SpillAggregator:
+    """
+    Aggregation of (key, value, height) records within a memory budget, records are pushed one by one with add.
+    Records are aggregated in bounded batches, every batch is sorted by key and spilled to a temporary run file, and
+    merged yields the k-way merge of the runs. close removes the run files.
+    """
+
+    def __init__(self, max_memory=256 << 20, tmp_dir=None):
+        """
+        :param max_memory: Memory budget of the batches and of the merge buffers, in bytes.
+        :param tmp_dir: Directory of the run files, the system temp dir by default.
+        """
+        self.max_memory = max_memory
+        self.tmp_dir = tmp_dir
+        self._max_entries = max(1, max_memory // SPILL_ENTRY_COST)
+        self._table = AddressTable()
+        self._runs = []
+        self._created = []
+
+    def _spill(self, entries):
+        path = write_run(entries, self.tmp_dir)
+        self._created.append(path)
+        return path
+
+    def add(self, key, amount, height):
+        self._table.add(key, amount, height)
+        if len(self._table) >= self._max_entries:
+            self._runs.append(self._spill(sorted(self._table)))
+            self._table = AddressTable()
+
+    def merged(self):
+        """ Yields the aggregated (key, value, last_height) sorted by key, once all the records are added. """
+        if len(self._table):
+            self._runs.append(self._spill(sorted(self._table)))
+        self._table = AddressTable()
+        runs = self._runs
+
+        # merge in several passes if there are too many runs to keep them all open, the merged run replaces its group
+        # at the front so that the runs stay in spill order
+        while len(runs) > MAX_MERGE_FANIN:
+            group = runs[:MAX_MERGE_FANIN]
+            runs = [self._spill(_merge_runs(group, self.max_memory // (2 * len(group))))] + runs[MAX_MERGE_FANIN:]
+            for path in group:
+                os.remove(path)
+
+        yield from _merge_runs(runs, self.max_memory // (2 * max(1, len(runs))))
+
+    def close(self):
+        for path in self._created:
+            if os.path.exists(path):
+                os.remove(path)
+        self._created = []
+
+
+def spill_aggregate(records, max_memory=256 << 20, tmp_dir=None):
+    """
+    Aggregates (key, value, height) records within a memory budget, see SpillAggregator.
+
+    :param records: (key, value, height) records, keys are compact address keys.
+    :param max_memory: Memory budget of the batches and of the merge buffers, in bytes.
+    :param tmp_dir: Directory of the run files, the system temp dir by default.
+    :return: (key, value, last_height) sorted by key.
+    """
+    aggregator = SpillAggregator(max_memory, tmp_dir)
+    try:
+        for key, amount, height in records:
+            aggregator.add(key, amount, height)
+        yield from aggregator.merged()
+    finally:
+        aggregator.close()
+
+
+def spill_sort_by_amount(entries, reverse=False, max_memory=256 << 20, tmp_dir=None):
+    """
+    External sort of (key, value, last_height) entries by value within a memory budget: sorted runs of bounded size
+    are spilled to temporary files and k-way merged. Equal values keep their input order.
+    """
+    max_entries = max(1, max_memory // SPILL_ENTRY_COST)
+    by_amount = itemgetter(1)
+    runs = []
+    try:
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= max_entries:
+                batch.sort(key=by_amount, reverse=reverse)
+                runs.append(write_run(batch, tmp_dir))
+                batch = []
+        batch.sort(key=by_amount, reverse=reverse)
+        if not runs:
+            yield from batch
+            return
+        runs.append(write_run(batch, tmp_dir))
+        del batch
+
+        buffer_size = max_memory // (2 * len(runs))
+        yield from heapq.merge(*[read_run(path, buffer_size) for path in runs], key=by_amount, reverse=reverse)
+    finally:
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def top_by_amount(entries, n, reverse=True):
+    """ The n entries with the largest (or with reverse=False the smallest) non zero values, keeping only n entries in
+    memory, sorted by value. """
+    entries = (entry for entry in entries if entry[1])
+    if reverse:
+        return heapq.nlargest(n, entries, key=itemgetter(1))
+    return heapq.nsmallest(n, entries, key=itemgetter(1))
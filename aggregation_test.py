@@ -0,0 +1,104 @@
+import pickle
+import random
+import unittest
+
+from aggregation import *
+
+
+class TestAddressTable(unittest.TestCase):
+    def records(self, n, distinct, seed=1):
+        rnd = random.Random(seed)
+        keys = [bytes([rnd.choice([0, 1, 28])]) + bytes(rnd.getrandbits(8) for _ in range(20)) for _ in range(distinct)]
+        return [(rnd.choice(keys), rnd.randrange(0, 10 ** 12), rnd.randrange(0, 800000)) for _ in range(n)]
+
+    def test_matches_dict(self):
+        records = self.records(20000, 3000)
+        expected = dict()
+        for key, val, height in records:
+            if key in expected:
+                expected[key][0] += val
+                expected[key][1] = height
+            else:
+                expected[key] = [val, height]
+
+        table = AddressTable()
+        for key, val, height in records:
+            table.add(key, val, height)
+
+        self.assertEqual(len(expected), len(table))
+        self.assertEqual([(k, v[0], v[1]) for k, v in expected.items()], list(table))
+        key = records[0][0]
+        self.assertEqual(tuple(expected[key]), table.get(key))
+        self.assertIn(key, table)
+        self.assertNotIn(b'\x05' * KEY_SIZE, table)
+        self.assertGreaterEqual(table.peak_nbytes, table.nbytes)
+
+    def test_update_and_pickle(self):
+        records = self.records(5000, 800)
+        whole = AddressTable()
+        first, second = AddressTable(), AddressTable()
+        for i, (key, val, height) in enumerate(records):
+            whole.add(key, val, height)
+            (first if i < 2000 else second).add(key, val, height)
+
+        first.update(pickle.loads(pickle.dumps(second)))
+        self.assertEqual(list(whole), list(first))
+
+    def test_sorted_by_amount(self):
+        table = AddressTable()
+        for key, val, height in self.records(3000, 600, seed=2):
+            # few distinct amounts, so that there are ties
+            table.add(key, val % 7, height)
+        self.assertEqual(sorted(table, key=lambda e: e[1]), list(table.sorted_by_amount()))
+        self.assertEqual(sorted(table, key=lambda e: e[1], reverse=True), list(table.sorted_by_amount(reverse=True)))
+
+
+class TestSpillAggregate(unittest.TestCase):
+    def test_matches_table(self):
+        records = TestAddressTable().records(20000, 3000, seed=3)
+        table = AddressTable()
+        for key, val, height in records:
+            table.add(key, val, height)
+        expected = sorted(table)
+
+        # 100 addresses per run
+        self.assertEqual(expected, list(spill_aggregate(iter(records), max_memory=100 * SPILL_ENTRY_COST)))
+        self.assertEqual(expected, list(spill_aggregate(iter(records))))
+        self.assertEqual([], list(spill_aggregate(iter([]))))
+
+    def test_multi_pass_merge(self):
+        records = TestAddressTable().records(3000, 500, seed=4)
+        table = AddressTable()
+        for key, val, height in records:
+            table.add(key, val, height)
+
+        import aggregation
+        fanin = aggregation.MAX_MERGE_FANIN
+        aggregation.MAX_MERGE_FANIN = 4
+        try:
+            self.assertEqual(sorted(table), list(spill_aggregate(iter(records), max_memory=50 * SPILL_ENTRY_COST)))
+        finally:
+            aggregation.MAX_MERGE_FANIN = fanin
+
+    def test_spill_sort_by_amount(self):
+        table = AddressTable()
+        for key, val, height in TestAddressTable().records(3000, 900, seed=5):
+            table.add(key, val, height)
+        for reverse in [False, True]:
+            expected = sorted(table, key=lambda e: e[1], reverse=reverse)
+            self.assertEqual(expected, list(spill_sort_by_amount(iter(table), reverse, 10 * SPILL_ENTRY_COST)))
+            self.assertEqual(expected, list(spill_sort_by_amount(iter(table), reverse)))
+
+    def test_top_by_amount(self):
+        entries = [(b'a', 5, 1), (b'b', 0, 1), (b'c', 9, 1), (b'd', 1, 1), (b'e', 7, 1)]
+        self.assertEqual([(b'c', 9, 1), (b'e', 7, 1)], top_by_amount(iter(entries), 2))
+        self.assertEqual([(b'd', 1, 1), (b'a', 5, 1)], top_by_amount(iter(entries), 2, reverse=False))
+
+    def test_parse_size(self):
+        self.assertEqual(512 << 20, parse_size('512M'))
+        self.assertEqual(3 << 29, parse_size('1.5g'))
+        self.assertEqual(1000, parse_size('1000'))
+
+
+if __name__ == '__main__':
+    unittest.main()
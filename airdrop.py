@@ -0,0 +1,72 @@
+"""
+Genesis outputs straight from a chainstate, without the btcposbal2csv --raw_script csv in between: the outputs of the
+chainstate are aggregated per address (parse_ldb and spill_aggregate) and handed to generate_genesis_block as script
+bytes and int amounts, nothing is formatted to text and parsed back.
+
+The outputs are in compact address key order (script type, then hash), whatever the reader or the layout of the
+chainstate LevelDB, so the coinbase and the merkle root only depend on the UTXO set and the filters.
+"""
+import os
+
+from aggregation import read_run, spill_aggregate, write_run
+from btcutil import CScript, CTxOut
+from utils import key_script, parse_ldb
+
+# bytes read at once from the run of the outputs
+READ_SIZE = 1 << 20
+
+
+class Airdrop:
+    """
+    Balances of the addresses of a chainstate as genesis outputs, one CTxOut per address holding at least min_balance
+    satoshi. The aggregated balances are kept in a temporary run file within max_memory, every iteration streams
+    them from it: the outputs of the same Airdrop can be handed to several generate_genesis_block calls, the scan
+    is done once. close removes the run file.
+    """
+
+    def __init__(self, chainstate, network='main', min_balance=1, types=(0, 1), version=0.15, reader='auto',
+                 max_memory=256 << 20, tmp_dir=None, **filters):
+        """
+        :param chainstate: Chainstate LevelDB directory.
+        :param network: main or test
+        :param min_balance: Addresses holding less satoshi get no output, at least 1: there are no empty outputs.
+        :param types: out_types of the P2PKH (0) and P2SH (1) outputs to keep, see parse_ldb.
+        :param reader: LevelDB reader, see utils.open_chainstate.
+        :param max_memory: Memory budget of the aggregation, in bytes.
+        :param tmp_dir: Directory of the temporary files, the system temp dir by default.
+        :param filters: min_amount, min_height and max_height filters of the outputs, see parse_ldb.
+        """
+        assert min_balance >= 1, min_balance
+        self.min_balance = min_balance
+        self.addresses = 0
+        self.satoshi = 0
+        records = parse_ldb(chainstate, network, version=version, types=types, compact=True, reader=reader, **filters)
+        self._path = write_run(self._kept(spill_aggregate(records, max_memory, tmp_dir)), tmp_dir)
+
+    def _kept(self, rows):
+        for key, amount, height in rows:
+            if amount >= self.min_balance:
+                self.addresses += 1
+                self.satoshi += amount
+                yield key, amount, height
+
+    def __len__(self):
+        return self.addresses
+
+    def __iter__(self):
+        """ Yields the outputs in compact address key order. """
+        if self._path is None:
+            raise ValueError('closed airdrop')
+        for key, amount, _ in read_run(self._path, READ_SIZE):
+            yield CTxOut(CScript(bytearray(key_script(key))), amount)
+
+    def close(self):
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+        self._path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,215 @@
+"""
+Binary balance index: the aggregated balances sorted by compact address key (see utils.encode_key), in fixed width
+records, so that it can be memory mapped and binary searched without any load step. Every process mapping the same
+index shares its pages through the page cache.
+
+Layout: a header (magic, network, record count) followed by the records, key (21 bytes) | value (int64) |
+last_height (int64), little endian, sorted by key.
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+
+from aggregation import KEY_SIZE, RUN_RECORD, SpillAggregator
+from utils import decode_address
+
+INDEX_MAGIC = b'BTCPBIDX'
+INDEX_HEADER = struct.Struct('<8sB7xQ')
+NETWORKS = ['main', 'test']
+
+
+class IndexWriter:
+    """
+    Writes (key, value, last_height) rows, added in key order, to an index file. Rows without balance are left out.
+    The file is written next to path and renamed by commit, so readers never see a partial index.
+    """
+
+    def __init__(self, path, network):
+        self.path = path
+        self.network = network
+        self.count = 0
+        self._last = None
+        self._tmp_path = path + '.tmp'
+        self._f = open(self._tmp_path, 'wb', buffering=1 << 20)
+        self._f.write(INDEX_HEADER.pack(INDEX_MAGIC, NETWORKS.index(network), 0))
+
+    def add(self, key, amount, height):
+        if amount == 0:
+            return
+        if self._last is not None and key <= self._last:
+            raise AssertionError('index rows must be sorted by key and unique')
+        self._last = key
+        self._f.write(RUN_RECORD.pack(key, amount, height))
+        self.count += 1
+
+    def commit(self):
+        self._f.seek(0)
+        self._f.write(INDEX_HEADER.pack(INDEX_MAGIC, NETWORKS.index(self.network), self.count))
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def close(self):
+        """ Drops the index if it was not committed. """
+        self._f.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def write_index(rows, path, network):
+    """
+    Writes (key, value, last_height) rows sorted by key to an index file, see IndexWriter.
+
+    :return: Number of records written.
+    """
+    writer = IndexWriter(path, network)
+    try:
+        for key, amount, height in rows:
+            writer.add(key, amount, height)
+        writer.commit()
+    finally:
+        writer.close()
+    return writer.count
+
+
+def tee_index(rows, path, network, max_memory=256 << 20, tmp_dir=None, sorted_rows=False):
+    """
+    Yields the (key, value, last_height) rows unchanged and writes them to an index file. Rows sorted by key are
+    written as they pass, other rows are sorted with spilled runs within max_memory and written once exhausted.
+    """
+    if sorted_rows:
+        writer = IndexWriter(path, network)
+        try:
+            for key, amount, height in rows:
+                writer.add(key, amount, height)
+                yield key, amount, height
+            writer.commit()
+        finally:
+            writer.close()
+        count = writer.count
+    else:
+        aggregator = SpillAggregator(max_memory, tmp_dir)
+        try:
+            for key, amount, height in rows:
+                aggregator.add(key, amount, height)
+                yield key, amount, height
+            count = write_index(aggregator.merged(), path, network)
+        finally:
+            aggregator.close()
+    print('indexed %d addresses in %s' % (count, path))
+
+
+class _Keys:
+    """ Sequence view of the keys of a mapped index, for bisect. """
+
+    def __init__(self, buf, count):
+        self._buf = buf
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        offset = INDEX_HEADER.size + i * RUN_RECORD.size
+        return self._buf[offset:offset + KEY_SIZE]
+
+
+class BalanceIndex:
+    """
+    Read only memory mapped balance index. Lookups are binary searches on the mapped records, O(log n) page reads and
+    no load step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, network, count = INDEX_HEADER.unpack_from(self._mm)
+        if magic != INDEX_MAGIC:
+            raise Exception('%s is not a balance index' % path)
+        if len(self._mm) != INDEX_HEADER.size + count * RUN_RECORD.size:
+            raise Exception('%s is truncated' % path)
+        self.network = NETWORKS[network]
+        self._count = count
+        self._keys = _Keys(self._mm, count)
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def _record(self, i):
+        return RUN_RECORD.unpack_from(self._mm, INDEX_HEADER.size + i * RUN_RECORD.size)
+
+    def _find(self, key, lo=0):
+        i = bisect_left(self._keys, key, lo)
+        if i < self._count and self._keys[i] == key:
+            return i
+        return None
+
+    def get(self, key, default=None):
+        """ Returns (value, last_height) of a compact address key. """
+        i = self._find(key)
+        if i is None:
+            return default
+        return self._record(i)[1:]
+
+    def get_many(self, keys):
+        """
+        Batched lookup of compact address keys. The keys are searched in sorted order, every search starting where
+        the previous one ended.
+
+        :return: (value, last_height) or None of every key, in the order of keys.
+        :rtype: list
+        """
+        out = [None] * len(keys)
+        lo = 0
+        for pos in sorted(range(len(keys)), key=keys.__getitem__):
+            lo = bisect_left(self._keys, keys[pos], lo)
+            if lo < self._count and self._keys[lo] == keys[pos]:
+                out[pos] = self._record(lo)[1:]
+        return out
+
+    def lookup(self, address):
+        """ Returns (value, last_height) of an address, (0, None) if it has no balance, None if it is not a P2PKH, P2SH
+        or P2WPKH address of the network of the index. """
+        key = decode_address(address, self.network)
+        if key is None:
+            return None
+        return self.get(key, (0, None))
+
+    def __iter__(self):
+        """ Yields (key, value, last_height) sorted by key. """
+        for offset in range(INDEX_HEADER.size, len(self._mm), RUN_RECORD.size):
+            yield RUN_RECORD.unpack_from(self._mm, offset)
+
+
+def input_args():
+    parser = argparse.ArgumentParser(description='Look up address balances in a balance index written by '
+                                                 'btcposbal2csv.py --index')
+    parser.add_argument('index', metavar='INDEX', type=str, help='balance index file')
+    parser.add_argument('addresses', metavar='ADDRESS', type=str, nargs='*',
+                        help='addresses to look up, read from stdin (one per line) if none is given')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = input_args()
+    addresses = args.addresses or (line.strip() for line in sys.stdin if line.strip())
+    with BalanceIndex(args.index) as index:
+        print('address,value_satoshi,last_height')
+        for address in addresses:
+            result = index.lookup(address)
+            if result is None:
+                print('%s,invalid,' % address)
+            else:
+                print('%s,%d,%s' % (address, result[0], '' if result[1] is None else result[1]))
@@ -0,0 +1,56 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from balance_index import *
+from utils import encode_key
+
+
+class TestBalanceIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'balances.idx')
+        rnd = random.Random(3)
+        self.rows = [(bytes([rnd.choice([0, 1, 28])]) + rnd.randbytes(20), rnd.randrange(1, 10 ** 12),
+                      rnd.randrange(800000)) for _ in range(5000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tee_index(self):
+        rows = self.rows + [(b'\x00' * 21, 0, 5)]
+        self.assertEqual(rows, list(tee_index(rows, self.path, 'main', max_memory=1 << 16, tmp_dir=self.dir)))
+        self.assertEqual(['balances.idx'], os.listdir(self.dir))
+        with BalanceIndex(self.path) as index:
+            self.assertEqual(5000, len(index))
+            self.assertEqual('main', index.network)
+            self.assertEqual(sorted(self.rows), list(index))
+
+    def test_lookups(self):
+        write_index(sorted(self.rows), self.path, 'test')
+        missing = [b'\x00' * 21, b'\xff' * 21, b'\x01' + self.rows[0][0][1:]]
+        with BalanceIndex(self.path) as index:
+            for key, amount, height in self.rows:
+                self.assertEqual((amount, height), index.get(key))
+            for key in missing:
+                self.assertEqual(None, index.get(key))
+
+            keys = [key for key, _, _ in self.rows[:100]] + missing
+            expected = [(amount, height) for _, amount, height in self.rows[:100]] + [None] * 3
+            self.assertEqual(expected, index.get_many(keys))
+
+            key, amount, height = self.rows[7]
+            self.assertEqual((amount, height), index.lookup(encode_key(key, 'test')))
+            self.assertEqual((0, None), index.lookup(encode_key(b'\x00' * 21, 'test')))
+            self.assertEqual(None, index.lookup(encode_key(key, 'main')))
+
+    def test_unsorted_rows(self):
+        with self.assertRaises(AssertionError):
+            write_index(self.rows, self.path, 'main')
+        self.assertEqual([], os.listdir(self.dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
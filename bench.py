@@ -0,0 +1,192 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import timeit
+from collections import deque
+from itertools import islice
+
+import btcposbal2csv
+import pipeline
+from aggregation import peak_rss
+from btcutil import HeaderHasher, decode_target, decode_target_int, get_block_hash_int, make_header, \
+    set_header_nonce, sha256d
+from gen_chainstate import generate_chainstate, generate_coins, chainstate_size, obfuscate, parse_count
+from utils import DEOBFUSCATE_BATCH, deobfuscate_batch, deobfuscate_bytes, deobfuscate_value, parse_ldb
+
+
+def consume(rows):
+    deque(rows, maxlen=0)
+
+
+def _scan(args, decoder, types=None):
+    consume(parse_ldb(
+        fin_name=args.chainstate,
+        network=args.network,
+        types=btcposbal2csv.get_types(args) if types is None else types,
+        decoder=decoder,
+        reader=args.reader,
+        compact=True,
+        **btcposbal2csv.get_filters(args)
+    ))
+
+
+def _pipeline(args):
+    pipeline.run(args.chainstate, args.out, args.network, btcposbal2csv.get_types(args), decoders=args.decoders)
+
+
+# benchmark cases: the scan stage alone (read + de-obfuscate + decode), every aggregation engine, and the CSV writer
+# behind the in memory aggregation
+CASES = {
+    'scan': lambda args: _scan(args, 'bytes'),
+    'scan_hex': lambda args: _scan(args, 'hex'),
+    # P2PKH only
+    'scan_filtered': lambda args: _scan(args, 'bytes', types={0}),
+    'scan_python_reader': lambda args: _scan(args, 'bytes'),
+    'in_mem': lambda args: consume(btcposbal2csv.in_mem(args)),
+    'workers': lambda args: consume(btcposbal2csv.in_mem(args)),
+    'workers_python_reader': lambda args: consume(btcposbal2csv.in_mem(args)),
+    'lowmem': lambda args: consume(btcposbal2csv.low_mem(args)),
+    'sqlite': lambda args: consume(btcposbal2csv.in_sqlite(args)),
+    'pipeline': _pipeline,
+    'in_mem+write': lambda args: btcposbal2csv.write_csv(btcposbal2csv.in_mem(args), args.out, args.network),
+}
+
+CASE_ARGS = {
+    # at least 1 BTC, created after block 600000
+    'scan_filtered': ['--min_amount', '100000000', '--min_height', '600001'],
+    'scan_python_reader': ['--reader', 'python'],
+    'workers': ['--workers', str(multiprocessing.cpu_count())],
+    'workers_python_reader': ['--workers', str(multiprocessing.cpu_count()), '--reader', 'python'],
+    'lowmem': ['--lowmem'],
+    'sqlite': ['--sqlite'],
+    'pipeline': ['--pipeline'],
+}
+
+
+def _run_case(case, argv, results):
+    # the engines report their progress on stdout
+    sys.stdout = open(os.devnull, 'w')
+    args = btcposbal2csv.input_args(argv)
+    start = time.perf_counter()
+    CASES[case](args)
+    seconds = time.perf_counter() - start
+    results.put((seconds, peak_rss(), peak_rss(resource.RUSAGE_CHILDREN)))
+
+
+def run_case(case, chainstate, tmp_dir, extra_argv=()):
+    """ Runs a benchmark case in a new process, so that its peak RSS is its own. """
+    argv = [chainstate, os.path.join(tmp_dir, 'out.csv'), '--network', 'main', '--tmp_dir', tmp_dir]
+    argv += CASE_ARGS.get(case, []) + list(extra_argv)
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(case, argv, results))
+    process.start()
+    seconds, rss, children_rss = results.get()
+    process.join()
+    return seconds, rss, children_rss
+
+
+def bench_deobfuscate(count, seed=0, repeat=3):
+    """ Micro-benchmark of the de-obfuscation of count generated chainstate values: the hex string XOR of the hex
+    decoder, the per value bytes XOR and the batched XOR of the bytes decoder. Returns the best seconds per method. """
+    o_key = bytes(range(1, 9))
+    values = [obfuscate(o_key, coin) for _, coin in islice(generate_coins(count, seed=seed), count)]
+    hex_key = o_key.hex()
+    hex_values = [value.hex() for value in values]
+    methods = {
+        'hex': lambda: [deobfuscate_value(hex_key, value) for value in hex_values],
+        'bytes': lambda: [deobfuscate_bytes(o_key, value) for value in values],
+        'batch': lambda: [value for i in range(0, count, DEOBFUSCATE_BATCH)
+                          for value in deobfuscate_batch(o_key, values[i:i + DEOBFUSCATE_BATCH])],
+    }
+    return {name: min(timeit.repeat(method, number=1, repeat=repeat)) for name, method in methods.items()}
+
+
+def bench_pow(count, repeat=3):
+    """ Micro-benchmark of the genesis miner proof of work check over count nonces: the hex string conversions of the
+    first miner, the integer check of the full header hash and the midstate search of btcutil.HeaderHasher. Returns
+    the best seconds per method. """
+    nbits = 0x1d00ffff
+    header = make_header(1, b'\x00' * 32, b'\x11' * 32, 1631200000, nbits, 0)
+    target = decode_target_int(nbits)
+
+    def hex_check():
+        h = bytearray(header)
+        for nonce in range(count):
+            set_header_nonce(h, nonce)
+            if int(sha256d(h)[::-1].hex(), 16) < int(decode_target(nbits), 16):
+                break
+
+    def int_check():
+        h = bytearray(header)
+        for nonce in range(count):
+            set_header_nonce(h, nonce)
+            if get_block_hash_int(h) < target:
+                break
+
+    methods = {
+        'hex': hex_check,
+        'int': int_check,
+        'midstate': lambda: HeaderHasher(header).search(0, count, target),
+    }
+    return {name: min(timeit.repeat(method, number=1, repeat=repeat)) for name, method in methods.items()}
+
+
+def input_args():
+    parser = argparse.ArgumentParser(description='Benchmark the chainstate scan stages and aggregation engines on '
+                                                 'synthetic chainstates')
+    parser.add_argument('--sizes', type=lambda s: [parse_count(c) for c in s.split(',')], default='1M',
+                        help='comma separated UTXO counts, e.g. 1M,10M,100M, default 1M')
+    parser.add_argument('--cases', type=lambda s: s.split(','), default=list(CASES),
+                        help='comma separated cases among %s, default all' % ', '.join(CASES))
+    parser.add_argument('--dir', type=str, default='bench_chainstates',
+                        help='directory of the generated chainstates, reused between runs, default bench_chainstates')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this json file')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated chainstates, default 0')
+    parser.add_argument('--deobfuscate', type=parse_count, default=None, metavar='N',
+                        help='only run the de-obfuscation micro-benchmark on N generated values')
+    parser.add_argument('--pow', type=parse_count, default=None, metavar='N',
+                        help='only run the genesis miner proof of work micro-benchmark on N nonces')
+    a = parser.parse_args()
+    for case in a.cases:
+        if case not in CASES:
+            raise AssertionError('unknown case %s' % case)
+    return a
+
+
+if __name__ == '__main__':
+    args = input_args()
+    if args.deobfuscate:
+        for name, seconds in bench_deobfuscate(args.deobfuscate, args.seed).items():
+            print('%-6s %9.3f s %12.0f values/s' % (name, seconds, args.deobfuscate / seconds))
+        sys.exit(0)
+    if args.pow:
+        for name, seconds in bench_pow(args.pow).items():
+            print('%-8s %9.3f s %12.0f hashes/s' % (name, seconds, args.pow / seconds))
+        sys.exit(0)
+
+    os.makedirs(args.dir, exist_ok=True)
+    results = []
+    print('%-14s %10s %9s %12s %9s %10s %14s' % (
+        'case', 'utxos', 'seconds', 'utxos/s', 'MB/s', 'peak MB', 'children MB'))
+    for size in args.sizes:
+        chainstate = os.path.join(args.dir, 'utxo_%d_%d' % (size, args.seed))
+        if not os.path.exists(chainstate):
+            print('generating %s' % chainstate)
+            generate_chainstate(chainstate, size, seed=args.seed)
+        mb = chainstate_size(chainstate) / 1e6
+        for case in args.cases:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                seconds, rss, children_rss = run_case(case, chainstate, tmp_dir)
+            results.append(dict(case=case, utxos=size, seconds=seconds, utxos_per_second=size / seconds,
+                                mb_per_second=mb / seconds, peak_rss=rss, children_peak_rss=children_rss))
+            print('%-14s %10d %9.2f %12.0f %9.2f %10.1f %14.1f' % (
+                case, size, seconds, size / seconds, mb / seconds, rss / 1e6, children_rss / 1e6))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
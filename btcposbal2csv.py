@@ -3,10 +3,25 @@ import tempfile
 import argparse
 import sqlite3
 import sys
-from utils import parse_ldb
+import shutil
+import time
+import multiprocessing
+from utils import LEVELDB_READERS, parse_ldb, key_ranges, clone_chainstate, encode_key, open_chainstate, \
+    resolve_reader
+from ldb import LevelDB
+from pipeline import run as run_pipeline
+from aggregation import AddressTable, peak_rss, parse_size, spill_aggregate, spill_sort_by_amount, top_by_amount
+from metrics import Metrics
+from watchlist import WatchList, read_addresses
+from balance_index import BalanceIndex, tee_index
+from delta import merge_delta, write_delta_csv
+from checkpoint import Checkpoint
+from snapshot import parse_snapshot
+from sinks import fan_out, open_sinks, parse_sink
+from writers import COMPRESSIONS, STDOUT
 
 
-def input_args():
+def input_args(argv=None):
     parser = argparse.ArgumentParser(description='Process UTXO set from chainstate and return unspent output per'
                                                  ' address for P2PKH and P2SH addresses')
     parser.add_argument(
@@ -23,6 +38,20 @@ def input_args():
         default=0.15,
         help='versions of bitcoin node, acceptable values 0.08 - 0.15, default 0.15 should be OK'
     )
+    parser.add_argument(
+        '--decoder',
+        choices=['bytes', 'hex'],
+        default='bytes',
+        help='chainstate record decoder, "bytes" decodes records in place, "hex" goes through hex strings, '
+             'default bytes (chainstates older than 0.15 are always decoded with hex)'
+    )
+    parser.add_argument(
+        '--reader',
+        choices=LEVELDB_READERS,
+        default='auto',
+        help='chainstate reader, "plyvel" for the LevelDB library, "python" for the pure Python table reader which '
+             'needs no native library and lets --workers split the scan by table file, default plyvel if installed'
+    )
     parser.add_argument(
         'out',
         metavar='OUTFILE',
@@ -30,17 +59,94 @@ def input_args():
         default=None,
         help='output file in .csv'
     )
+    parser.add_argument(
+        '--snapshot',
+        action='store_true',
+        default=False,
+        help='PATH_TO_CHAINSTATE_DIR is a UTXO snapshot file written by the dumptxoutset RPC, the node does not have '
+             'to be stopped'
+    )
+    parser.add_argument(
+        '--sink',
+        metavar='KIND:PATH',
+        type=parse_sink,
+        action='append',
+        default=[],
+        help='also write the balances to PATH in the same pass, KIND is csv (addresses), raw_script (hex scripts), '
+             'types (PATH_p2pkh.csv, PATH_p2sh.csv... one csv per script type), hash160 (hex hash160 list) or '
+             'summary (JSON totals per script type), can be repeated'
+    )
+    parser.add_argument(
+        '--compress',
+        choices=COMPRESSIONS,
+        default='auto',
+        help='compression of the output files, "auto" picks it from their suffix (.gz, .xz, .zst), zstd needs the '
+             'zstandard package, default auto'
+    )
+    parser.add_argument(
+        '--compress_level',
+        metavar='LEVEL',
+        type=int,
+        default=None,
+        help='compression level, default of the compression'
+    )
+    parser.add_argument(
+        '--compress_threads',
+        metavar='N',
+        type=int,
+        default=1,
+        help='compress the outputs in parallel chunks on N threads, default 1 (a single stream on a background '
+             'thread)'
+    )
+    parser.add_argument(
+        '--sqlite',
+        action='store_true',
+        help='aggregate addresses in a temporary sqlite database instead of doing it in memory'
+    )
     parser.add_argument(
         '--keep_sqlite',
-        metavar='PATH_TO_SQLITE_FILE)',
+        metavar='PATH_TO_SQLITE_FILE',
         type=str,
         default=None,
-        help='output sqlite database file'
+        help='output sqlite database file, implies --sqlite'
     )
     parser.add_argument(
         '--lowmem',
         action='store_true',
-        help='use sqlite for aggregation of addresses instead of doing it in memory'
+        help='aggregate addresses in bounded batches spilled to sorted temporary files and merged at the end, '
+             'instead of doing it in memory'
+    )
+    parser.add_argument(
+        '--max_memory', '--max-memory',
+        metavar='SIZE',
+        type=parse_size,
+        default='256M',
+        help='memory budget of the --lowmem aggregation or sqlite page cache, e.g. 512M or 2G, default 256M'
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        metavar='PATH',
+        type=str,
+        default=None,
+        help='directory of the --lowmem and --sqlite temporary files, default system temp dir'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes scanning disjoint key ranges of the chainstate, default 1'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='scan with a staged pipeline: reader thread, decoding processes, aggregator and writer threads, '
+             'and print the busy/idle time of every stage'
+    )
+    parser.add_argument(
+        '--decoders',
+        type=int,
+        default=None,
+        help='number of decoding processes of --pipeline, default number of cpus'
     )
     parser.add_argument(
         '--P2PKH',
@@ -69,12 +175,106 @@ def input_args():
         '--sort',
         metavar='ASC/DESC',
         type=str,
-        default='ASC',
+        default=None,
         help='sort addresses by output ammount '
              'ASCending / DESCending '
              'if not given not sorting will be done'
     )
-    a = parser.parse_args()
+    parser.add_argument(
+        '--top',
+        metavar='N',
+        type=int,
+        default=None,
+        help='only output the N richest addresses (the N poorest with --sort ASC), sorted by amount'
+    )
+    parser.add_argument(
+        '--min_amount',
+        metavar='SATOSHI',
+        type=int,
+        default=0,
+        help='skip the outputs of less than SATOSHI, the balances only sum the remaining outputs'
+    )
+    parser.add_argument(
+        '--min_height',
+        metavar='HEIGHT',
+        type=int,
+        default=0,
+        help='skip the outputs created before block HEIGHT'
+    )
+    parser.add_argument(
+        '--max_height',
+        metavar='HEIGHT',
+        type=int,
+        default=None,
+        help='skip the outputs created after block HEIGHT'
+    )
+    parser.add_argument(
+        '--addresses',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='only output the balances of the addresses listed in FILE (one per line, or the first column of a csv), '
+             'watched addresses without outputs are written with a zero balance'
+    )
+    parser.add_argument(
+        '--bloom',
+        action='store_true',
+        default=False,
+        help='with --addresses, test the addresses with a Bloom filter in front of the address table instead of a set, '
+             'for lists of many millions of addresses'
+    )
+    parser.add_argument(
+        '--index',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='also write the balances to a binary index sorted by address, for balance_index.py lookups'
+    )
+    parser.add_argument(
+        '--delta',
+        metavar='INDEX',
+        type=str,
+        default=None,
+        help='write the balance changes since the run which wrote INDEX (--index) instead of the balances: '
+             'added, removed and changed addresses with their old and new values'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='save the scan state (next chainstate key and partial balances) to FILE every --checkpoint_interval '
+             'seconds, the file is removed once the output is written'
+    )
+    parser.add_argument(
+        '--checkpoint_interval',
+        metavar='SECONDS',
+        type=float,
+        default=300.0,
+        help='seconds between two checkpoints, default 300'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='resume the scan saved in --checkpoint FILE, if it exists'
+    )
+    parser.add_argument(
+        '--metrics',
+        metavar='PATH',
+        type=str,
+        default=None,
+        help='append the scan progress and a final summary as JSON lines to PATH, - for stderr: rates, ETA, '
+             'outputs per script type, not decoded outputs, stage times and peak RSS'
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        metavar='SECONDS',
+        type=float,
+        default=10.0,
+        help='seconds between two --metrics progress lines, default 10'
+    )
+    a = parser.parse_args(argv)
 
     if a.network not in ['main', 'test']:
         raise AssertionError('--network supports main or test argument')
@@ -82,8 +282,58 @@ def input_args():
     if a.sort not in {None, 'ASC', 'DESC'}:
         raise AssertionError('--sort can be only "ASC" or "DESC"')
 
-    if a.keep_sqlite and not a.lowmem:
-        raise AssertionError('--keep_sqlite cannot be used with --lowmem')
+    if a.top is not None and a.top < 1:
+        raise AssertionError('--top must be at least 1')
+
+    if a.min_amount < 0 or a.min_height < 0 or a.max_height is not None and a.max_height < a.min_height:
+        raise AssertionError('--min_amount and --min_height must be positive, --max_height at least --min_height')
+
+    if a.workers < 1:
+        raise AssertionError('--workers must be at least 1')
+
+    if a.lowmem and a.workers > 1:
+        raise AssertionError('--workers cannot be used with --lowmem')
+
+    if a.keep_sqlite:
+        a.sqlite = True
+
+    if a.bloom and not a.addresses:
+        raise AssertionError('--bloom needs --addresses')
+
+    if a.index and a.pipeline:
+        raise AssertionError('--index cannot be used with --pipeline')
+
+    if a.resume and not a.checkpoint:
+        raise AssertionError('--resume needs --checkpoint')
+
+    if a.checkpoint and (a.lowmem or a.sqlite or a.pipeline or a.addresses or a.workers > 1):
+        raise AssertionError(
+            '--checkpoint cannot be used with --lowmem, --sqlite, --pipeline, --addresses or --workers')
+
+    if a.snapshot and (a.pipeline or a.checkpoint or a.workers > 1):
+        raise AssertionError('--snapshot cannot be used with --pipeline, --checkpoint or --workers')
+
+    if a.delta and (a.pipeline or a.sort or a.top):
+        raise AssertionError('--delta cannot be used with --pipeline, --sort or --top')
+
+    if a.addresses and (a.lowmem or a.sqlite or a.pipeline or a.workers > 1):
+        raise AssertionError('--addresses cannot be used with --lowmem, --sqlite, --pipeline or --workers')
+
+    if a.pipeline and (a.lowmem or a.sqlite or a.workers > 1 or a.bitcoin_version < 0.15):
+        raise AssertionError(
+            '--pipeline cannot be used with --lowmem, --sqlite, --workers or chainstates older than 0.15')
+
+    if a.sink and (a.pipeline or a.delta):
+        raise AssertionError('--sink cannot be used with --pipeline or --delta')
+
+    if a.compress_threads < 1:
+        raise AssertionError('--compress_threads must be at least 1')
+
+    if ([a.out] + [path for _, path in a.sink]).count(STDOUT) > 1:
+        raise AssertionError('only one output can be written to stdout')
+
+    if a.sqlite and (a.lowmem or a.workers > 1):
+        raise AssertionError('--sqlite cannot be used with --lowmem or --workers')
     return a
 
 
@@ -98,131 +348,421 @@ def get_types(in_args):
     return keep_types
 
 
-def in_mem(in_args):
-    add_dict = dict()
-    for add, val, height in parse_ldb(
+def get_filters(in_args):
+    """ Output filters of the scan, see utils.parse_ldb. """
+    return dict(min_amount=in_args.min_amount, min_height=in_args.min_height, max_height=in_args.max_height)
+
+
+def get_output(in_args):
+    """ Options of the output files, see writers.OutputWriter. """
+    return dict(compression=in_args.compress, level=in_args.compress_level, threads=in_args.compress_threads)
+
+
+def sort_order(in_args):
+    """ Sort the aggregation has to apply, None when there is nothing to sort or when --top does the sorting. """
+    if in_args.top:
+        return None
+    return in_args.sort
+
+
+def scan(in_args, metrics=None, **kwargs):
+    """ Compact (key, value, height) records of the chainstate, or of the dumptxoutset file with in_args.snapshot. """
+    if in_args.snapshot:
+        return parse_snapshot(
+            fin_name=in_args.chainstate,
+            types=get_types(in_args),
+            network=in_args.network,
+            compact=True,
+            metrics=metrics,
+            **get_filters(in_args),
+            **kwargs
+        )
+    return parse_ldb(
         fin_name=in_args.chainstate,
         version=in_args.bitcoin_version,
         types=get_types(in_args),
-        network=args.network,
-        raw_script=args.raw_script
-    ):
-        if add in add_dict:
-            add_dict[add][0] += val
-            add_dict[add][1] = height
+        network=in_args.network,
+        decoder=in_args.decoder,
+        compact=True,
+        metrics=metrics,
+        reader=in_args.reader,
+        **get_filters(in_args),
+        **kwargs
+    )
+
+
+def aggregate(records, table=None):
+    if table is None:
+        table = AddressTable()
+    for add, val, height in records:
+        table.add(add, val, height)
+    return table
+
+
+def in_mem(in_args, metrics=None):
+    metrics = metrics or Metrics()
+    checkpoint = None
+    with metrics.stage('scan'):
+        if in_args.workers > 1:
+            table = in_mem_parallel(in_args, metrics)
+        elif in_args.checkpoint:
+            checkpoint = Checkpoint(in_args.checkpoint, checkpoint_params(in_args), in_args.checkpoint_interval)
+            table = in_mem_checkpointed(in_args, checkpoint, metrics)
+        else:
+            table = aggregate(scan(in_args, metrics))
+    print('aggregated %d addresses, table peak %.1f MB, peak RSS %.1f MB' % (
+        len(table), table.peak_nbytes / 1e6, peak_rss() / 1e6))
+
+    order = sort_order(in_args)
+    if order is None:
+        rows = table
+    else:
+        rows = table.sorted_by_amount(reverse=order == 'DESC')
+    for key, val, height in rows:
+        yield key, val, height
+    if checkpoint is not None:
+        # the output is written, there is nothing left to resume
+        checkpoint.remove()
+
+
+def checkpoint_params(in_args):
+    """ Parameters of a scan which change its result, a checkpoint is only resumed with the same ones. """
+    return dict(chainstate=os.path.abspath(in_args.chainstate), bitcoin_version=in_args.bitcoin_version,
+                types=sorted(get_types(in_args)), **get_filters(in_args))
+
+
+def in_mem_checkpointed(in_args, checkpoint, metrics):
+    """
+    Single process in memory aggregation which saves its state to the checkpoint periodically and, with
+    in_args.resume, starts from the saved state: the saved table and counters, and the scan restarted at the saved
+    chainstate key.
+    """
+    start = None
+    table = AddressTable()
+    state = checkpoint.load() if in_args.resume else None
+    if state is not None:
+        start, table, counters = state
+        # the bytes rate and ETA only cover this run
+        metrics.merge(dict(counters, bytes=0))
+        print('resuming at %d records, %d addresses' % (counters['records'], len(table)))
+    elif in_args.resume:
+        print('no checkpoint in %s, starting a new scan' % in_args.checkpoint)
+
+    aggregate(parse_ldb(
+        fin_name=in_args.chainstate,
+        version=in_args.bitcoin_version,
+        types=get_types(in_args),
+        network=in_args.network,
+        decoder=in_args.decoder,
+        start=start,
+        compact=True,
+        metrics=metrics,
+        checkpoint=lambda key: checkpoint.maybe_save(key, table, metrics.counters()),
+        reader=in_args.reader,
+        **get_filters(in_args)
+    ), table)
+    return table
+
+
+# chainstate view opened once by every worker process of in_mem_parallel
+_worker_db = None
+
+
+def _init_worker(chainstate, tmp_root, reader):
+    global _worker_db
+    if reader == 'python':
+        # the python reader takes no lock, every worker opens the chainstate itself
+        _worker_db = LevelDB(chainstate)
+        return
+    path = tempfile.mkdtemp(dir=tmp_root)
+    clone_chainstate(chainstate, path)
+    _worker_db = open_chainstate(path, reader)
+
+
+def _scan_range(job):
+    start, stop, parse_args = job
+    metrics = Metrics(total_bytes=0)
+    table = aggregate(parse_ldb(
+        fin_name=None, db=_worker_db, start=start, stop=stop, verbose=False, metrics=metrics, **parse_args))
+    return table, metrics.counters()
+
+
+def in_mem_parallel(in_args, metrics=None):
+    """
+    Scans disjoint key ranges of the chainstate in in_args.workers processes, each aggregating its own ranges. The
+    partial results are merged in key order, so the output is the same as a single process scan.
+    """
+    if in_args.bitcoin_version < 0.15:
+        prefix = b'c'
+    else:
+        prefix = b'C'
+    parse_args = dict(
+        version=in_args.bitcoin_version,
+        types=get_types(in_args),
+        network=in_args.network,
+        decoder=in_args.decoder,
+        compact=True,
+        **get_filters(in_args)
+    )
+    # more ranges than workers, so that a slow range does not leave the other workers idle
+    n = min(in_args.workers * 8, 0x10000)
+    reader = resolve_reader(in_args.reader)
+    if reader == 'python':
+        # cut on table file boundaries, every range merges the fewest files
+        db = LevelDB(in_args.chainstate)
+        ranges = db.file_ranges(prefix, bytes([prefix[0] + 1]), n)
+        db.close()
+    else:
+        ranges = key_ranges(prefix, n)
+    jobs = [(start, stop, parse_args) for start, stop in ranges]
+
+    metrics = metrics or Metrics()
+    if metrics.total_bytes is None:
+        # the parent does not open the chainstate, the table files size stands for the LevelDB approximate size
+        metrics.total_bytes = sum(os.path.getsize(os.path.join(in_args.chainstate, name))
+                                  for name in os.listdir(in_args.chainstate)
+                                  if name.endswith('.ldb') or name.endswith('.sst'))
+
+    tmp_root = tempfile.mkdtemp()
+    try:
+        table = AddressTable()
+        with multiprocessing.Pool(in_args.workers, _init_worker, (in_args.chainstate, tmp_root, reader)) as pool:
+            for part, counters in pool.imap(_scan_range, jobs):
+                table.update(part)
+                metrics.merge(counters)
+        total = metrics.not_decoded_total()
+        print('unable to decode %d transactions' % total[0])
+        print('totaling %d satoshi' % total[1])
+    finally:
+        shutil.rmtree(tmp_root)
+    return table
+
+
+def low_mem(in_args, metrics=None):
+    records = scan(in_args, metrics)
+    order = sort_order(in_args)
+    if order is None:
+        rows = spill_aggregate(records, in_args.max_memory, in_args.tmp_dir)
+    else:
+        # the merge of the aggregation runs feeds the sort runs, both get half of the budget
+        rows = spill_sort_by_amount(
+            spill_aggregate(records, in_args.max_memory // 2, in_args.tmp_dir),
+            reverse=order == 'DESC',
+            max_memory=in_args.max_memory // 2,
+            tmp_dir=in_args.tmp_dir
+        )
+    count = 0
+    for key, val, height in rows:
+        count += 1
+        yield key, val, height
+    print('aggregated %d addresses, peak RSS %.1f MB' % (count, peak_rss() / 1e6))
+
+
+def in_sqlite(in_args, batch_size=500000, metrics=None):
+    """
+    Aggregates addresses in a sqlite database: batches of pre-aggregated addresses are sorted by key and upserted
+    with executemany in one large transaction. The amount index is only created once the load is done.
+    With --keep_sqlite the database is kept, with the encoded addresses in the address column.
+    """
+    if in_args.keep_sqlite:
+        dbfile = in_args.keep_sqlite
+    else:
+        fd, dbfile = tempfile.mkstemp(suffix='.sqlite', dir=in_args.tmp_dir)
+        os.close(fd)
+
+    conn = sqlite3.connect(dbfile, isolation_level=None)
+    try:
+        curr = conn.cursor()
+        # page_size only applies to a new database file
+        curr.execute('PRAGMA page_size = 65536')
+        curr.execute('PRAGMA journal_mode = OFF')
+        curr.execute('PRAGMA synchronous = OFF')
+        curr.execute('PRAGMA temp_store = MEMORY')
+        curr.execute('PRAGMA cache_size = -%d' % (in_args.max_memory // 1024))
+
+        curr.execute(
+            """
+            DROP TABLE IF EXISTS balance
+            """
+        )
+
+        curr.execute(
+            """
+            CREATE TABLE balance (
+                    key BLOB PRIMARY KEY,
+                    amount BIGINT NOT NULL,
+                    height BIGINT NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+
+        expupsert = """
+            INSERT INTO balance (key, amount, height) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+            amount = amount + excluded.amount,
+            height = excluded.height
+            """
+
+        metrics = metrics or Metrics()
+        start = time.time()
+        records = 0
+        with metrics.stage('scan'):
+            curr.execute('BEGIN TRANSACTION')
+            batch = AddressTable()
+            for key, val, height in scan(in_args, metrics):
+                batch.add(key, val, height)
+                records += 1
+                if len(batch) >= batch_size:
+                    curr.executemany(expupsert, sorted(batch))
+                    batch = AddressTable()
+            curr.executemany(expupsert, sorted(batch))
+            del batch
+            curr.execute('COMMIT')
+        load_time = time.time() - start
+
+        with metrics.stage('index'):
+            curr.execute('CREATE INDEX balance_amount ON balance (amount)')
+        if in_args.keep_sqlite:
+            conn.create_function(
+                'encode_key', 1, lambda key: encode_key(key, in_args.network, in_args.raw_script), deterministic=True)
+            curr.execute('BEGIN TRANSACTION')
+            curr.execute('ALTER TABLE balance ADD COLUMN address TEXT')
+            curr.execute('UPDATE balance SET address = encode_key(key)')
+            curr.execute('CREATE INDEX balance_address ON balance (address)')
+            curr.execute('COMMIT')
+        (addresses,), = curr.execute('SELECT COUNT(*) FROM balance')
+        print('sqlite: %d outputs aggregated to %d addresses in %.1f s (%.0f outputs/s), database size %.1f MB' % (
+            records, addresses, load_time, records / max(load_time, 1e-9), os.path.getsize(dbfile) / 1e6))
+
+        order = sort_order(in_args)
+        if order is None:
+            exp = 'SELECT key, amount, height FROM balance'
+        elif order == 'ASC':
+            exp = 'SELECT key, amount, height FROM balance ORDER BY amount ASC'
+        elif order == 'DESC':
+            exp = 'SELECT key, amount, height FROM balance ORDER BY amount DESC'
         else:
-            add_dict[add] = [val, height]
-
-    for key in add_dict.keys():
-        ll = add_dict[key]
-        yield key, ll[0], ll[1]
-
-
-# def low_mem(in_args):
-#     keep_types = []
-#     if in_args.P2PKH:
-#         keep_types.append(0)
-#     if in_args.P2SH:
-#         keep_types.append(1)
-#     if in_args.P2PK:
-#         keep_types += [2, 3, 4, 5]
-#
-#     if in_args.keep_sqlite:
-#         dbfile = in_args.keep_sqlite
-#     else:
-#         fd, dbfile = tempfile.mkstemp()
-#         os.close(fd)
-#
-#     with sqlite3.connect(dbfile) as conn:
-#         curr = conn.cursor()
-#
-#         curr.execute(
-#             """
-#             DROP TABLE IF EXISTS balance
-#             """
-#         )
-#
-#         curr.execute(
-#             """
-#             CREATE TABLE balance (
-#                     address TEXT PRIMARY KEY,
-#                     amount BIGINT NOT NULL,
-#                     height BIGINT NOT NULL
-#             )
-#             """
-#         )
-#
-#         curr.execute('BEGIN TRANSACTION')
-#
-#         expinsert = """
-#             INSERT OR IGNORE INTO balance (address, amount, height) VALUES (?, ?, ?)"""
-#         expupdate = """
-#             UPDATE balance SET
-#             amount = amount + ?,
-#             height = ?
-#             WHERE address = ?
-#             """
-#         for add, val, height in parse_ldb(
-#                 fin_name=in_args.chainstate,
-#                 version=in_args.bitcoin_version,
-#                 types=get_types(in_args)):
-#             curr.execute(expinsert, (add, 0, 0))
-#             curr.execute(expupdate, (val, height, add))
-#
-#         if in_args.sort is None:
-#             exp = 'SELECT * FROM balance'
-#         elif in_args.sort == 'ASC':
-#             exp = 'SELECT * FROM balance ORDER BY amount ASC'
-#         elif in_args.sort == 'DESC':
-#             exp = 'SELECT * FROM balance ORDER BY amount DESC'
-#         else:
-#             raise Exception
-#
-#         curr.execute(exp)
-#
-#         for j in curr:
-#             yield j[0], j[1], j[2]
-#
-#         conn.commit()
-#         curr.close()
-#
-#     if not in_args.keep_sqlite:
-#         os.remove(dbfile)
+            raise Exception
+
+        curr.execute(exp)
+        for j in curr:
+            yield j[0], j[1], j[2]
+
+        curr.close()
+    finally:
+        conn.close()
+        if not in_args.keep_sqlite:
+            os.remove(dbfile)
+
+
+def watch_list(in_args, metrics=None):
+    """
+    Aggregates the balances of the addresses listed in in_args.addresses only, including the ones without outputs
+    (zero balance, last height 0).
+    """
+    keys, invalid = read_addresses(in_args.addresses, in_args.network)
+    if invalid:
+        print('skipping %d lines which are not P2PKH, P2SH or P2WPKH %s addresses, e.g. %s' % (
+            len(invalid), in_args.network, invalid[0]))
+    watch = WatchList(keys, bloom=in_args.bloom)
+    print('watching %d addresses' % len(watch))
+
+    metrics = metrics or Metrics()
+    with metrics.stage('scan'):
+        for key, val, height in scan(in_args, metrics, watch=watch):
+            watch.add(key, val, height)
+    table = watch.table
+    print('%d of %d watched addresses have a balance' % (sum(1 for _, val, _ in table if val), len(table)))
+
+    order = sort_order(in_args)
+    if order is None:
+        rows = table
+    else:
+        rows = table.sorted_by_amount(reverse=order == 'DESC')
+    for key, val, height in rows:
+        yield key, val, height
+
+
+def write_csv(add_iter, out, network, raw_script=False, keep_zero=False, **output):
+    # addresses are aggregated on their compact keys and encoded only here, once per address
+    fan_out(add_iter, open_sinks([('raw_script' if raw_script else 'csv', out)], keep_zero, **output), network)
 
 
 if __name__ == '__main__':
 
     args = input_args()
+    if STDOUT in [args.out] + [path for _, path in args.sink]:
+        # the output is piped, the progress messages go to stderr
+        sys.stdout = sys.stderr
+    metrics = Metrics(args.metrics, args.metrics_interval)
 
     print('reading chainstate database')
-    if args.lowmem:
+    if args.pipeline:
+        print('pipeline')
+        run_pipeline(
+            chainstate=args.chainstate,
+            out=args.out,
+            network=args.network,
+            types=get_types(args),
+            raw_script=args.raw_script,
+            decoders=args.decoders,
+            sort=args.sort,
+            top=args.top,
+            metrics=metrics,
+            reader=args.reader,
+            output=get_output(args),
+            **get_filters(args)
+        )
+        metrics.close()
+        print('writen to %s' % args.out)
+        sys.exit(0)
+
+    if args.addresses:
+        print('addresses')
+        add_iter = watch_list(args, metrics)
+    elif args.lowmem:
         print('lowmem')
-        print('not implemented') # disable lowmem
-        sys.exit(1)
-        # add_iter = low_mem(args)
+        add_iter = low_mem(args, metrics)
+    elif args.sqlite:
+        print('sqlite')
+        add_iter = in_sqlite(args, metrics=metrics)
     else:
         print('inmem')
-        add_iter = in_mem(args)
+        add_iter = in_mem(args, metrics)
 
-    if args.out:
-        w = ['address,value_satoshi,last_height']
-        with open(args.out, 'w') as f:
-            c = 0
-            for address, sat_val, block_height in add_iter:
-                if sat_val == 0:
-                    continue
-                if isinstance(address, bytes):
-                    address = address.decode('ascii')
-                assert isinstance(address, str), address
-                w.append(
-                    address + ',' + str(sat_val) + ',' + str(block_height)
-                )
-                c += 1
-                if c == 1000:
-                    f.write('\n'.join(w) + '\n')
-                    w = []
-                    c = 0
-            if c > 0:
-                f.write('\n'.join(w) + '\n')
-            f.write('\n')
+    if args.delta:
+        # the merge with the previous index needs the balances sorted by address key, lowmem yields them so
+        if not args.lowmem:
+            add_iter = spill_aggregate(add_iter, args.max_memory, args.tmp_dir)
+        if args.index:
+            # the previous index stays mapped when the new one replaces it, both can be the same file
+            add_iter = tee_index(add_iter, args.index, args.network, sorted_rows=True)
+        with BalanceIndex(args.delta) as previous:
+            if previous.network != args.network:
+                raise AssertionError('%s is an index of the %s network' % (args.delta, previous.network))
+            with metrics.stage('output'):
+                counts = write_delta_csv(merge_delta(previous, add_iter), args.out, args.network, args.raw_script,
+                                         **get_output(args))
+        print('%d added, %d removed, %d changed addresses' % (counts['added'], counts['removed'], counts['changed']))
         print('writen to %s' % args.out)
+        metrics.close()
+        sys.exit(0)
+
+    if args.index:
+        # every address goes to the index, --top only applies to the csv
+        add_iter = tee_index(add_iter, args.index, args.network, args.max_memory, args.tmp_dir)
+
+    if args.top:
+        add_iter = top_by_amount(add_iter, args.top, reverse=args.sort != 'ASC')
+
+    if args.out:
+        # the engines are generators, the output stage time includes their scan and index stages
+        sinks = open_sinks([('raw_script' if args.raw_script else 'csv', args.out)] + args.sink, bool(args.addresses),
+                           **get_output(args))
+        with metrics.stage('output'):
+            fan_out(add_iter, sinks, args.network)
+        # the files actually written, a types sink writes one per script type
+        for sink in sinks:
+            for writer in sink.writers:
+                print('writen to %s' % writer.path)
+    metrics.close()
@@ -0,0 +1,196 @@
+import io
+import json
+import os
+import random
+import sqlite3
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+from btcposbal2csv import in_mem, low_mem, in_sqlite, watch_list, write_csv, aggregate, checkpoint_params, \
+    in_mem_checkpointed
+from checkpoint import Checkpoint
+from gen_chainstate import generate_chainstate
+import pipeline
+from metrics import Metrics
+from utils import parse_ldb, encode_key
+from aggregation import top_by_amount
+from utils_test import make_chainstate
+
+
+class TestAggregation(unittest.TestCase):
+    O_KEY = bytes.fromhex('0102030405060708')
+
+    def setUp(self):
+        rnd = random.Random(7)
+        hashes = [bytes(rnd.getrandbits(8) for _ in range(20)) for _ in range(50)]
+        coins = []
+        for i in range(2000):
+            out_type = rnd.choice([0, 1, 28])
+            data = rnd.choice(hashes)
+            if out_type == 28:
+                data = b'\x00\x14' + data
+            txid = bytes(rnd.getrandbits(8) for _ in range(32))
+            coins.append((txid, rnd.randrange(1, 800000), rnd.randrange(0, 10 ** 10), out_type, data))
+        self.dir = tempfile.mkdtemp()
+        make_chainstate(self.dir, coins, self.O_KEY)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def args(self, **kwargs):
+        a = dict(chainstate=self.dir, network='main', raw_script=False, bitcoin_version=0.15, decoder='bytes',
+                 workers=1, P2PKH=True, P2SH=True, P2PK=False, max_memory=1 << 12, tmp_dir=None,
+                 sort=None, top=None, min_amount=0, min_height=0, max_height=None, checkpoint=None,
+                 snapshot=False, reader='auto')
+        a.update(kwargs)
+        return Namespace(**a)
+
+    def test_workers_match_single_process(self):
+        expected = list(in_mem(self.args()))
+        self.assertEqual(150, len(expected))
+        self.assertEqual(expected, list(in_mem(self.args(workers=3))))
+
+    def test_python_reader_matches_plyvel(self):
+        expected = list(in_mem(self.args(reader='plyvel')))
+        self.assertEqual(expected, list(in_mem(self.args(reader='python'))))
+        self.assertEqual(expected, list(in_mem(self.args(reader='python', workers=3))))
+
+    def test_lowmem_matches_in_mem(self):
+        self.assertEqual(sorted(in_mem(self.args())), list(low_mem(self.args())))
+
+    def test_sqlite_matches_in_mem(self):
+        expected = sorted(in_mem(self.args()))
+        self.assertEqual(expected, sorted(in_sqlite(self.args(keep_sqlite=None))))
+        self.assertEqual(expected, sorted(in_sqlite(self.args(keep_sqlite=None), batch_size=7)))
+
+        dbfile = os.path.join(self.dir, 'balance.sqlite')
+        list(in_sqlite(self.args(keep_sqlite=dbfile)))
+        with sqlite3.connect(dbfile) as conn:
+            rows = sorted(conn.execute('SELECT key, amount, height FROM balance'))
+            self.assertEqual(expected, rows)
+            key, address = next(conn.execute('SELECT key, address FROM balance'))
+            self.assertEqual(encode_key(key, 'main'), address)
+
+    def test_engines_sort(self):
+        for sort in ['ASC', 'DESC']:
+            expected = [val for _, val, _ in in_mem(self.args(sort=sort))]
+            self.assertEqual(sorted(expected, reverse=sort == 'DESC'), expected)
+            self.assertEqual(expected, [val for _, val, _ in low_mem(self.args(sort=sort))])
+            self.assertEqual(expected, [val for _, val, _ in in_sqlite(self.args(sort=sort, keep_sqlite=None))])
+
+    def test_pipeline_matches_in_mem(self):
+        for sort, top in [(None, None), ('DESC', None), ('ASC', 10), (None, 10)]:
+            expected_file = os.path.join(self.dir, 'expected.csv')
+            write_csv(in_mem(self.args(sort=sort, top=top)) if not top else
+                      top_by_amount(in_mem(self.args()), top, reverse=sort != 'ASC'), expected_file, 'main')
+            out_file = os.path.join(self.dir, 'pipeline.csv')
+            stats = pipeline.run(self.dir, out_file, 'main', {0, 1}, decoders=2, sort=sort, top=top, batch_size=100)
+            with open(expected_file) as expected, open(out_file) as out:
+                self.assertEqual(expected.read(), out.read())
+        self.assertEqual(2000, stats[0].items)
+
+    def test_compact_keys_match_addresses(self):
+        expected = dict()
+        for add, val, height in parse_ldb(self.dir, 'main'):
+            expected[add] = [expected.get(add, [0])[0] + val, height]
+        self.assertEqual(
+            [(add, ll[0], ll[1]) for add, ll in expected.items()],
+            [(encode_key(key, 'main'), val, height) for key, val, height in in_mem(self.args())]
+        )
+
+    def test_filters(self):
+        filters = dict(min_amount=10 ** 9, min_height=300000, max_height=600000)
+        for types in [{0, 1}, {0}]:
+            expected = list(aggregate(
+                (key, val, height) for key, val, height in parse_ldb(self.dir, 'main', types=types, compact=True)
+                if val >= filters['min_amount'] and filters['min_height'] <= height <= filters['max_height']))
+            self.assertTrue(0 < len(expected) < 150)
+            for decoder in ['bytes', 'hex']:
+                self.assertEqual(expected, list(aggregate(parse_ldb(
+                    self.dir, 'main', types=types, decoder=decoder, compact=True, **filters))))
+            args = self.args(P2SH=1 in types, **filters)
+            self.assertEqual(expected, list(in_mem(args)))
+            self.assertEqual(expected, list(in_mem(self.args(workers=3, P2SH=1 in types, **filters))))
+            self.assertEqual(sorted(expected), list(low_mem(args)))
+
+            expected_file = os.path.join(self.dir, 'expected.csv')
+            write_csv(expected, expected_file, 'main')
+            out_file = os.path.join(self.dir, 'pipeline.csv')
+            pipeline.run(self.dir, out_file, 'main', types, decoders=2, batch_size=100, **filters)
+            with open(expected_file) as expected_csv, open(out_file) as out:
+                self.assertEqual(expected_csv.read(), out.read())
+
+    def test_watch_list(self):
+        balances = list(in_mem(self.args()))
+        watched = balances[::3] + [(b'\x00' + bytes(20), 0, 0)]
+        path = os.path.join(self.dir, 'addresses.csv')
+        with open(path, 'w') as f:
+            f.write('address,value_satoshi,last_height\n')
+            f.write(''.join(encode_key(key, 'main') + '\n' for key, _, _ in watched))
+            f.write('\nnot an address\n')
+        for bloom in [False, True]:
+            self.assertEqual(sorted(watched), sorted(watch_list(self.args(addresses=path, bloom=bloom))))
+
+        out_file = os.path.join(self.dir, 'out.csv')
+        write_csv(watch_list(self.args(addresses=path, bloom=False)), out_file, 'main', keep_zero=True)
+        with open(out_file) as f:
+            self.assertIn(encode_key(b'\x00' + bytes(20), 'main') + ',0,0\n', f.read())
+
+    def test_resume_from_checkpoint(self):
+        chainstate = os.path.join(self.dir, 'large')
+        generate_chainstate(chainstate, 45000, seed=2)
+        path = os.path.join(self.dir, 'scan.checkpoint')
+        args = self.args(chainstate=chainstate, checkpoint=path, checkpoint_interval=0, resume=True)
+        expected = list(in_mem(self.args(chainstate=chainstate)))
+
+        class Crash(Exception):
+            pass
+
+        class CrashingCheckpoint(Checkpoint):
+            def save(self, key, table, counters):
+                super().save(key, table, counters)
+                if counters['records'] >= 20000:
+                    raise Crash()
+
+        with self.assertRaises(Crash):
+            in_mem_checkpointed(args, CrashingCheckpoint(path, checkpoint_params(args), 0), Metrics())
+        self.assertTrue(os.path.exists(path))
+        metrics = Metrics()
+        self.assertEqual(expected, list(in_mem(args, metrics)))
+        self.assertEqual(45000, metrics.records)
+        self.assertFalse(os.path.exists(path))
+
+        Checkpoint(path, checkpoint_params(args), 0).save(b'C', None, None)
+        self.assertEqual((b'C', None, None), Checkpoint(path, checkpoint_params(args), 0).load())
+        with self.assertRaises(AssertionError):
+            Checkpoint(path, checkpoint_params(self.args(chainstate=chainstate, min_amount=1)), 0).load()
+
+    def test_metrics_match_between_engines(self):
+        out = io.StringIO()
+        metrics = Metrics(out, interval=0)
+        list(in_mem(self.args(), metrics))
+        metrics.close()
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual('summary', lines[-1]['event'])
+        summary = lines[-1]
+        self.assertEqual(2000, summary['records'])
+        self.assertEqual(2000, summary['outputs'])
+        self.assertEqual({'P2PKH', 'P2SH', 'P2WPKH'}, set(summary['script_types']))
+        self.assertIn('scan', summary['stages'])
+
+        for run in [lambda m: list(in_mem(self.args(workers=3), m)),
+                    lambda m: list(low_mem(self.args(), m)),
+                    lambda m: list(in_sqlite(self.args(keep_sqlite=None), metrics=m)),
+                    lambda m: pipeline.run(self.dir, os.path.join(self.dir, 'out.csv'), 'main', {0, 1}, decoders=2,
+                                           batch_size=100, metrics=m)]:
+            other = Metrics()
+            run(other)
+            snapshot = other.snapshot()
+            self.assertEqual(summary['bytes'], snapshot['bytes'])
+            self.assertEqual(summary['script_types'], snapshot['script_types'])
+
+
+if __name__ == '__main__':
+    unittest.main()
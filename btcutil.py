@@ -1,6 +1,9 @@
 import hashlib
-from dataclasses import dataclass
-from typing import List
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, Iterable, List, Optional
+
+_UINT32 = struct.Struct('<I')
 
 
 def sha256(b: bytes) -> bytes:
@@ -56,7 +59,7 @@ class CScriptNum:
         if n == 0:
             return bytes()
 
-        result = bytes()
+        result = bytearray()
         neg = n < 0
         absval = abs(n)
 
@@ -69,12 +72,13 @@ class CScriptNum:
         elif neg:
             result[-1] |= 0x80
 
-        return result
+        return bytes(result)
 
 
 @dataclass()
 class CScript:
-    cmds: bytes = bytes()
+    # grown in place, appending to immutable bytes is quadratic
+    cmds: bytearray = field(default_factory=bytearray)
 
     def __add__(self, other):
         if isinstance(other, OpCode):
@@ -118,7 +122,7 @@ class CScript:
         return self
 
     def encode(self) -> bytes:
-        return self.cmds
+        return bytes(self.cmds)
 
 
 @dataclass
@@ -188,6 +192,82 @@ class Tx:
     def tx_id(self) -> bytes:
         return sha256d(self.encode())
 
+    def stream(self, out: BinaryIO = None) -> bytes:
+        """ Same as tx_id, serializing the outputs one by one, see stream_tx. """
+        return stream_tx(self.inputs, self.outputs, len(self.outputs), self.version, self.locktime, out)
+
+
+class StreamHasher:
+    """
+    Incremental double SHA-256 of a serialization written piece by piece, buffered in chunks of buffer_size bytes,
+    which are also written to out if given.
+    """
+
+    def __init__(self, out: BinaryIO = None, buffer_size: int = 1 << 20):
+        self.out = out
+        self.size = 0
+        self._sha = hashlib.sha256()
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+
+    def write(self, b: bytes):
+        self._buffer += b
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        self._sha.update(self._buffer)
+        if self.out is not None:
+            self.out.write(self._buffer)
+        self.size += len(self._buffer)
+        self._buffer.clear()
+
+    def digest(self) -> bytes:
+        """ sha256d of everything written """
+        self.flush()
+        return sha256(self._sha.digest())
+
+
+def stream_tx(
+        inputs: List[CTxIn],
+        outputs: Iterable[CTxOut],
+        n_outputs: int,
+        version: int = 1,
+        locktime: int = 0,
+        out: BinaryIO = None
+) -> bytes:
+    """
+    Serializes a transaction into an incremental SHA-256, and into out if given, and returns its id (same as
+    Tx.tx_id). The outputs are consumed one at a time, so a generator of millions of outputs is serialized in bounded
+    memory. Their count is written before them and has to be given.
+    """
+    h = StreamHasher(out)
+    h.write(encode_int(version, 4))
+    h.write(encode_varint(len(inputs)))
+    for tx_in in inputs:
+        h.write(tx_in.encode())
+    h.write(encode_varint(n_outputs))
+    count = 0
+    for tx_out in outputs:
+        h.write(tx_out.encode())
+        count += 1
+    if count != n_outputs:
+        raise ValueError("{} outputs serialized, {} announced".format(count, n_outputs))
+    h.write(encode_int(locktime, 4))
+    return h.digest()
+
+
+def merkle_root(txids: List[bytes]) -> bytes:
+    """ merkle root of the transaction ids of a block, in block order, the last hash of an odd level is paired with
+    itself """
+    assert txids
+    level = list(txids)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
 
 def script_with_prefix(nbits) -> CScript:
     c = CScript() + nbits
@@ -238,14 +318,15 @@ def decode_target(bits):
     # https://gist.github.com/shirriff/cd5c66da6ba21a96bb26#file-mine-py
     # https://gist.github.com/shirriff/cd5c66da6ba21a96bb26#file-mine-py
     # https://en.bitcoin.it/wiki/Difficulty
-    exp = bits >> 24
-    mant = bits & 0xffffff
-    target_hexstr = '%064x' % (mant * (1 << (8 * (exp - 3))))
-    return target_hexstr
+    return '%064x' % decode_target_int(bits)
 
 
-def decode_target_int(nbits):
-    return int(decode_target(nbits), 16)
+def decode_target_int(nbits: int) -> int:
+    exp = nbits >> 24
+    mant = nbits & 0xffffff
+    if exp < 3:
+        return mant >> (8 * (3 - exp))
+    return mant << (8 * (exp - 3))
 
 
 def get_block_hash(header: bytes) -> bytes:
@@ -253,4 +334,50 @@ def get_block_hash(header: bytes) -> bytes:
 
 
 def get_block_hash_int(header: bytes) -> int:
-    return int(get_block_hash(header).hex(), 16)
+    # the hash is displayed byte reversed, the digest is the little endian number
+    return int.from_bytes(sha256d(header), 'little')
+
+
+class HeaderHasher:
+    """
+    Hashes the variants of a header which differ in timestamp and nonce only. Both are in the last 16 bytes, past the
+    first SHA-256 block: the state after the first 64 bytes is computed once and copied for every nonce, and only the
+    16 bytes tail is hashed, in a buffer updated in place.
+    """
+
+    def __init__(self, header: bytes):
+        assert len(header) == 80, len(header)
+        self.prefix = bytes(header[:64])
+        self.midstate = hashlib.sha256(self.prefix)
+        # merkle root end | timestamp | nbits | nonce
+        self.tail = bytearray(header[64:])
+
+    def set_timestamp(self, ts: int):
+        _UINT32.pack_into(self.tail, 4, ts)
+
+    def set_nonce(self, nonce: int):
+        _UINT32.pack_into(self.tail, 12, nonce)
+
+    def header(self) -> bytes:
+        return self.prefix + bytes(self.tail)
+
+    def hash_int(self) -> int:
+        """ Same as get_block_hash_int of the current header. """
+        h = self.midstate.copy()
+        h.update(self.tail)
+        return int.from_bytes(sha256(h.digest()), 'little')
+
+    def search(self, start: int, stop: int, target: int) -> Optional[int]:
+        """ First nonce of [start, stop) whose hash is below target, None if there is none. """
+        copy = self.midstate.copy
+        tail = self.tail
+        pack_into = _UINT32.pack_into
+        from_bytes = int.from_bytes
+        new_sha256 = hashlib.sha256
+        for nonce in range(start, stop):
+            pack_into(tail, 12, nonce)
+            h = copy()
+            h.update(tail)
+            if from_bytes(new_sha256(h.digest()).digest(), 'little') < target:
+                return nonce
+        return None
@@ -1,3 +1,4 @@
+import io
 import unittest
 from btcutil import *
 
@@ -22,6 +23,32 @@ class TestGenerator(unittest.TestCase):
                          "63fb6db8609ea3378e12ff251fa44bee262c77de7e9b25494280ee26d3eebeb1")
         self.assertLess(get_block_hash_int(header), decode_target_int(nbits))
 
+    def test_decode_target_int(self):
+        self.assertEqual(int(decode_target(0x1d00ffff), 16), decode_target_int(0x1d00ffff))
+        self.assertEqual(0xffff << 208, decode_target_int(0x1d00ffff))
+        self.assertEqual(0x12, decode_target_int(0x01123456))
+        self.assertEqual(0x1234, decode_target_int(0x02123456))
+
+    def test_header_hasher(self):
+        header = make_header(1, b'\x00' * 32, b'\x11' * 32, 1337, 0x207fffff, 0)
+        hasher = HeaderHasher(header)
+        for ts, nonce in [(1337, 0), (1337, 5), (0x334455, 0x01020304)]:
+            set_header_timestamp(header, ts)
+            set_header_nonce(header, nonce)
+            hasher.set_timestamp(ts)
+            hasher.set_nonce(nonce)
+            self.assertEqual(bytes(header), hasher.header())
+            self.assertEqual(get_block_hash_int(header), hasher.hash_int())
+
+        target = 1 << 248
+        nonce = hasher.search(0, 10000, target)
+        set_header_nonce(header, nonce)
+        self.assertLess(get_block_hash_int(header), target)
+        for n in range(nonce):
+            set_header_nonce(header, n)
+            self.assertGreaterEqual(get_block_hash_int(header), target)
+        self.assertIsNone(hasher.search(0, nonce, target))
+
     def test_create_header(self):
         header = make_header(
             version=1,
@@ -50,6 +77,34 @@ class TestGenerator(unittest.TestCase):
         self.assertEqual('05ffffffff000104', script_with_prefix(0xffffffff).encode().hex())
         self.assertEqual('035634120103', script_with_prefix(0x123456).encode().hex())
 
+    def test_stream_tx(self):
+        scriptSig = CScript() + script_with_prefix(0x207fffff) + b'VeriBlock'
+        outputs = [CTxOut(CScript() + OpCode(0x00) + bytes([i % 256]) * 20, amount=i * 1000) for i in range(300)]
+        tx = Tx(version=1, inputs=[CTxIn(scriptSig=scriptSig)], outputs=outputs)
+        out = io.BytesIO()
+        self.assertEqual(tx.tx_id(), stream_tx(tx.inputs, iter(outputs), 300, out=out))
+        self.assertEqual(tx.encode(), out.getvalue())
+        self.assertEqual(tx.tx_id(), tx.stream())
+        self.assertRaises(ValueError, stream_tx, tx.inputs, iter(outputs), 301)
+
+    def test_script_num(self):
+        self.assertEqual('ff00', CScriptNum.serialize(255).hex())
+        self.assertEqual('81', CScriptNum.serialize(-1).hex())
+        self.assertEqual('ff80', CScriptNum.serialize(-255).hex())
+
+    def test_merkle_root(self):
+        # block 100000
+        txids = [bytes.fromhex(txid)[::-1] for txid in [
+            "8c14f0db3df150123e6f3dbbf30f8b955a8249b62ac1d1ff16284aefa3d06d87",
+            "fff2525b8931402dd09222c50775608f75787bd2b87e56995a7bdd30f79702c4",
+            "6359f0868171b1d194cbee1af2f16ea598ae8fad666d9b012c8ed2b79a236ec4",
+            "e9a66845e05d5abc0ad04ec80f774a7e585c6e8db975962d069a522137b80c1d",
+        ]]
+        self.assertEqual("f3e94742aca4b5ef85488dc37c06c3282295ffec960994b2c0d5ac2a25a95766",
+                         merkle_root(txids)[::-1].hex())
+        self.assertEqual(txids[0], merkle_root(txids[:1]))
+        self.assertEqual(merkle_root(txids[:3] + txids[2:3]), merkle_root(txids[:3]))
+
     def test_tx_id(self):
         expectedScript = "41047c62bbf7f5aa4dd5c16bad99ac621b857fac4e93de86e45f5ada73404eeb44dedcf377b03c14a24e9d51605d9dd2d8ddaef58760d9c4bb82d9c8f06d96e79488ac"
         expectedOut = "00f2052a010000004341047c62bbf7f5aa4dd5c16bad99ac621b857fac4e93de86e45f5ada73404eeb44dedcf377b03c14a24e9d51605d9dd2d8ddaef58760d9c4bb82d9c8f06d96e79488ac"
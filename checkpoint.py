@@ -0,0 +1,59 @@
+import os
+import pickle
+import time
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    """
+    Periodic snapshot of a chainstate scan: the key of the next record to scan, the partial aggregation table and
+    the scan counters. The snapshot is pickled to a temporary file and renamed over the previous one, so a crash while
+    saving leaves the previous checkpoint intact.
+
+    The scan parameters are saved with the snapshot, a checkpoint of a scan with other parameters is not resumed.
+    """
+
+    def __init__(self, path, params, interval=300.0):
+        """
+        :param path: Checkpoint file.
+        :param params: Parameters of the scan which change its result (chainstate, types, filters...).
+        :param interval: Minimum seconds between two saves.
+        """
+        self.path = path
+        self.params = params
+        self.interval = interval
+        self._last_save = time.time()
+
+    def load(self):
+        """
+        :return: (next key, table, counters) of the saved scan, None if there is no checkpoint.
+        :rtype: bytes, aggregation.AddressTable, dict
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if state['version'] != CHECKPOINT_VERSION or state['params'] != self.params:
+            raise AssertionError('%s is the checkpoint of a scan with other parameters: %s' % (
+                self.path, state['params']))
+        return state['key'], state['table'], state['counters']
+
+    def save(self, key, table, counters):
+        tmp_path = self.path + '.tmp'
+        state = dict(version=CHECKPOINT_VERSION, params=self.params, key=key, table=table, counters=counters)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._last_save = time.time()
+
+    def maybe_save(self, key, table, counters):
+        """ Saves the scan state if the last save is older than the interval. """
+        if time.time() - self._last_save >= self.interval:
+            self.save(key, table, counters)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
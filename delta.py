@@ -0,0 +1,56 @@
+"""
+Balance changes between a previous run, persisted as a balance index (btcposbal2csv.py --index), and a new
+chainstate. Both sides are streamed sorted by address key and merge-joined, so the memory stays bounded and the
+unchanged addresses are never encoded.
+"""
+from utils import encode_key
+from writers import LineWriter
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def merge_delta(old_rows, new_rows):
+    """
+    Merge-joins two streams of (key, value, last_height) sorted by key, and yields the addresses whose balance
+    differs. Rows with a zero value count as absent.
+
+    :return: (change, key, old_value, new_value, last_height), change is ADDED, REMOVED or CHANGED. last_height is the
+        one of the new row, or of the old row for the removed addresses.
+    :rtype: generator
+    """
+    old_rows = (row for row in old_rows if row[1])
+    new_rows = (row for row in new_rows if row[1])
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or old is not None and old[0] < new[0]:
+            yield REMOVED, old[0], old[1], 0, old[2]
+            old = next(old_rows, None)
+        elif old is None or new[0] < old[0]:
+            yield ADDED, new[0], 0, new[1], new[2]
+            new = next(new_rows, None)
+        else:
+            if old[1] != new[1]:
+                yield CHANGED, new[0], old[1], new[1], new[2]
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+
+
+def write_delta_csv(changes, out, network, raw_script=False, **output):
+    """
+    Writes the changes of merge_delta to a csv, returns the number of changes per kind.
+
+    :param output: writers.OutputWriter options (compression, level, threads).
+    """
+    counts = {ADDED: 0, REMOVED: 0, CHANGED: 0}
+    w = LineWriter(out, 'address,change,old_value_satoshi,new_value_satoshi,last_height', **output)
+    try:
+        for change, key, old_value, new_value, height in changes:
+            w.add('%s,%s,%d,%d,%d' % (encode_key(key, network, raw_script), change, old_value, new_value, height))
+            counts[change] += 1
+    finally:
+        w.close()
+    print(w.out.report())
+    return counts
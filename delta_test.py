@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from delta import *
+from utils import encode_key
+
+
+class TestDelta(unittest.TestCase):
+    def key(self, i):
+        return b'\x00' + bytes([i]) * 20
+
+    def test_merge_delta(self):
+        old = [(self.key(1), 10, 1), (self.key(2), 20, 2), (self.key(4), 40, 4), (self.key(6), 60, 6)]
+        new = [(self.key(0), 5, 9), (self.key(2), 20, 9), (self.key(3), 0, 9), (self.key(4), 41, 9),
+               (self.key(7), 70, 9)]
+        self.assertEqual([
+            (ADDED, self.key(0), 0, 5, 9),
+            (REMOVED, self.key(1), 10, 0, 1),
+            (CHANGED, self.key(4), 40, 41, 9),
+            (REMOVED, self.key(6), 60, 0, 6),
+            (ADDED, self.key(7), 0, 70, 9),
+        ], list(merge_delta(old, new)))
+        self.assertEqual([], list(merge_delta(old, old)))
+        self.assertEqual([(ADDED, key, 0, val, height) for key, val, height in old], list(merge_delta([], old)))
+
+    def test_write_delta_csv(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            out = os.path.join(tmp_dir, 'delta.csv')
+            counts = write_delta_csv(merge_delta([(self.key(1), 10, 1)], [(self.key(2), 20, 2)]), out, 'main')
+            self.assertEqual({ADDED: 1, REMOVED: 1, CHANGED: 0}, counts)
+            with open(out) as f:
+                self.assertEqual([
+                    'address,change,old_value_satoshi,new_value_satoshi,last_height',
+                    '%s,removed,10,0,1' % encode_key(self.key(1), 'main'),
+                    '%s,added,0,20,2' % encode_key(self.key(2), 'main'),
+                ], f.read().splitlines())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
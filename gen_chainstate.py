@@ -0,0 +1,200 @@
+import argparse
+import os
+import random
+import struct
+
+import plyvel
+
+from utils import b128_encode, encode_coin, read_b128, P2WPKH
+
+OBFUSCATE_KEY = bytes.fromhex('0e00') + b'obfuscate_key'
+
+# default share of every script type among the generated outputs
+DEFAULT_MIX = {
+    'P2PKH': 0.45,
+    'P2SH': 0.20,
+    'P2WPKH': 0.25,
+    'P2PK': 0.02,
+    'unknown': 0.08,
+}
+
+
+def obfuscate(o_key, value):
+    """ XORs value with the repeated obfuscation key, obfuscation and de-obfuscation are the same operation. """
+    extended_key = (o_key * (len(value) // len(o_key) + 1))[:len(value)]
+    return (int.from_bytes(value, 'big') ^ int.from_bytes(extended_key, 'big')).to_bytes(len(value), 'big')
+
+
+def random_output(rnd, script_type, hashes):
+    """ Returns (out_type, data) of a random output of the given script type. Address outputs reuse the given hashes.
+    """
+    if script_type == 'P2PKH':
+        return 0, rnd.choice(hashes)
+    if script_type == 'P2SH':
+        return 1, rnd.choice(hashes)
+    if script_type == 'P2WPKH':
+        return P2WPKH, b'\x00\x14' + rnd.choice(hashes)
+    if script_type == 'P2PK':
+        out_type = rnd.randint(2, 5)
+        return out_type, bytes([out_type]) + rnd.randbytes(32)
+    if script_type == 'unknown':
+        # P2WSH / P2TR outputs, OP_RETURN data and bare multisig scripts of various sizes
+        size = rnd.choice([34, 34, 34, 40, 71, 105])
+        return size + 6, rnd.randbytes(size)
+    raise Exception('Unknown script type %s' % script_type)
+
+
+def generate_coins(count, mix=None, addresses=None, seed=0, max_height=850000):
+    """
+    Yields count random (outpoint key, coin) chainstate records, not obfuscated and not sorted.
+
+    :param count: Number of outputs.
+    :param mix: Share of every script type, see DEFAULT_MIX.
+    :param addresses: Number of distinct address hashes the outputs are spread over, count // 3 by default. Like
+        on mainnet a few addresses hold many outputs.
+    :param seed: Seed of the random generator, the same seed generates the same records.
+    """
+    rnd = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    types, weights = list(mix.keys()), list(mix.values())
+    hashes = [rnd.randbytes(20) for _ in range(max(1, addresses or count // 3))]
+    # reused addresses: a pareto distributed position into the hashes
+    popular = [hashes[min(len(hashes) - 1, int(rnd.paretovariate(1.2)) - 1)] for _ in range(min(len(hashes), 1000))]
+
+    txid, vout = None, 0
+    for script_type in rnd.choices(types, weights, k=count):
+        # most transactions have one or two unspent outputs left
+        if txid is None or rnd.random() < 0.6:
+            txid, vout = rnd.randbytes(32), rnd.randrange(3)
+        else:
+            vout += 1
+        out_type, data = random_output(rnd, script_type, popular if rnd.random() < 0.2 else hashes)
+        # log uniform amounts between 546 satoshi and 1000 BTC
+        amount = int(10 ** rnd.uniform(2.74, 11))
+        coinbase = int(rnd.random() < 0.01)
+        key = b'C' + txid + b128_encode(vout)
+        yield key, encode_coin(rnd.randrange(max_height), coinbase, amount, out_type, data)
+
+
+def generate_chainstate(path, count, mix=None, addresses=None, seed=0, o_key=None, batch_size=100000):
+    """
+    Writes a synthetic obfuscated v0.15+ chainstate LevelDB with count UTXOs.
+
+    :param o_key: Obfuscation key (8 bytes), random by default. b'' writes a chainstate without obfuscation key.
+    :return: The obfuscation key.
+    """
+    if o_key is None:
+        o_key = random.Random(seed).randbytes(8)
+    db = plyvel.DB(path, create_if_missing=True, error_if_exists=True, compression=None)
+    try:
+        if o_key:
+            db.put(OBFUSCATE_KEY, bytes([len(o_key)]) + o_key)
+        batch = db.write_batch()
+        for i, (key, coin) in enumerate(generate_coins(count, mix, addresses, seed)):
+            batch.put(key, obfuscate(o_key, coin) if o_key else coin)
+            if (i + 1) % batch_size == 0:
+                batch.write()
+                batch = db.write_batch()
+        batch.write()
+        db.compact_range()
+    finally:
+        db.close()
+    return o_key
+
+
+def compact_size(n):
+    """ Bitcoin CompactSize encoding of n. """
+    if n < 0xfd:
+        return bytes((n,))
+    if n <= 0xffff:
+        return b'\xfd' + struct.pack('<H', n)
+    if n <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', n)
+    return b'\xff' + struct.pack('<Q', n)
+
+
+def write_snapshot(path, records, legacy=False, network_magic=bytes.fromhex('f9beb4d9'), block_hash=None):
+    """
+    Writes (outpoint key, coin) chainstate records, as generated by generate_coins, to a dumptxoutset snapshot file
+    (see snapshot.py). The coins are written in outpoint order like Bitcoin Core does.
+
+    :param legacy: Write the layout of Bitcoin Core v22 - v27 instead of the v28+ one.
+    :param network_magic: Network message start of the v28+ header, mainnet by default.
+    :return: Number of coins written.
+    """
+    records = sorted(records)
+    block_hash = block_hash or bytes(32)
+    with open(path, 'wb', buffering=1 << 20) as f:
+        if legacy:
+            f.write(block_hash + struct.pack('<Q', len(records)))
+        else:
+            f.write(b'utxo\xff' + struct.pack('<H', 2) + network_magic + block_hash + struct.pack('<Q', len(records)))
+        i = 0
+        while i < len(records):
+            txid = records[i][0][1:33]
+            j = i
+            while j < len(records) and records[j][0][1:33] == txid:
+                j += 1
+            if not legacy:
+                f.write(txid + compact_size(j - i))
+            for key, coin in records[i:j]:
+                vout, _ = read_b128(key, 33)
+                if legacy:
+                    f.write(txid + struct.pack('<I', vout) + coin)
+                else:
+                    f.write(compact_size(vout) + coin)
+            i = j
+    return len(records)
+
+
+def chainstate_size(path):
+    """ Size of the files of a chainstate directory in bytes. """
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def parse_count(count):
+    """ Parses an output count like 1M or 250k. """
+    units = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+    count = count.strip().upper()
+    if count[-1] in units:
+        return int(float(count[:-1]) * units[count[-1]])
+    return int(count)
+
+
+def parse_mix(mix):
+    """ Parses a script type mix like P2PKH=0.5,P2WPKH=0.5 """
+    out = dict()
+    for item in mix.split(','):
+        name, share = item.split('=')
+        assert name in DEFAULT_MIX, 'script types are %s' % ', '.join(DEFAULT_MIX)
+        out[name] = float(share)
+    return out
+
+
+def input_args():
+    parser = argparse.ArgumentParser(description='Write a synthetic obfuscated chainstate LevelDB, for tests and '
+                                                 'benchmarks of btcposbal2csv')
+    parser.add_argument('out', metavar='PATH', type=str, help='chainstate directory to create')
+    parser.add_argument('--count', type=parse_count, default='1M', help='number of UTXOs, e.g. 1M, default 1M')
+    parser.add_argument('--addresses', type=parse_count, default=None,
+                        help='number of distinct addresses, default a third of --count')
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help='share of every script type, e.g. P2PKH=0.5,P2SH=0.2,P2WPKH=0.2,P2PK=0.05,unknown=0.05')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, default 0')
+    parser.add_argument('--no_obfuscation', action='store_true', help='do not write an obfuscation key')
+    parser.add_argument('--snapshot', choices=['v28', 'legacy'], default=None,
+                        help='write a dumptxoutset snapshot file (v28+ or v22 - v27 layout) instead of a chainstate')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = input_args()
+    if args.snapshot:
+        write_snapshot(args.out, generate_coins(args.count, args.mix, args.addresses, args.seed),
+                       legacy=args.snapshot == 'legacy')
+        size = os.path.getsize(args.out)
+    else:
+        generate_chainstate(args.out, args.count, args.mix, args.addresses, args.seed,
+                            o_key=b'' if args.no_obfuscation else None)
+        size = chainstate_size(args.out)
+    print('written %d UTXOs to %s, %.1f MB' % (args.count, args.out, size / 1e6))
@@ -1,22 +1,206 @@
 import argparse
 import csv
+import gzip
+import io
+import lzma
 from pathlib import Path
 
 import multiprocessing as mp
+import queue
+from collections import deque
+from dataclasses import dataclass
 from btcutil import *
 import time
-import asyncio
 
-def read_balances(file: Path):
+from airdrop import Airdrop
+from utils import LEVELDB_READERS
+
+def _open_balances(file: Path):
+    if file.suffix == '.gz':
+        return gzip.open(file, 'rt', newline='')
+    if file.suffix == '.xz':
+        return lzma.open(file, 'rt', newline='')
+    return open(file, newline='')
+
+
+def _balance_rows(file: Path):
     assert file.exists()
-    with open(file, newline='') as csvfile:
+    with _open_balances(file) as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
-        for script, satoshis, _ in reader:
+        for row in reader:
+            # header and trailing empty line of btcposbal2csv
+            if not row or row[0] == 'address':
+                continue
+            yield row
+
+
+def read_balances(file: Path):
+    """ outputs of a btcposbal2csv --raw_script csv (optionally .gz or .xz), one at a time """
+    for script, satoshis, _ in _balance_rows(file):
+        try:
+            script = bytes.fromhex(script)
+        except ValueError:
+            raise Exception("Looks like {} is not a script".format(script))
+        # the script is the whole scriptPubKey, not a push
+        yield CTxOut(CScript(bytearray(script)), int(satoshis))
+
+
+def count_balances(file: Path) -> int:
+    return sum(1 for _ in _balance_rows(file))
+
+
+# nonces per mining job, the workers take the jobs in order from a shared counter
+NONCE_SLICE = 1 << 20
+SLICES_PER_TIMESTAMP = (1 << 32) // NONCE_SLICE
+# nonces between two checks of the stop event
+CHECK_EVERY = 1 << 14
+
+
+@dataclass
+class MiningResult:
+    nonce: int
+    timestamp: int
+    header: bytes
+    attempts: int
+    seconds: float
+
+    @property
+    def hashrate(self) -> float:
+        return self.attempts / self.seconds if self.seconds else 0.0
+
+
+def job_range(nTime: int, job: int):
+    """ timestamp and first nonce of a job: the whole 32-bit nonce space of a timestamp, then the next second """
+    return nTime + job // SLICES_PER_TIMESTAMP, (job % SLICES_PER_TIMESTAMP) * NONCE_SLICE
+
+
+def _mine_worker(header: bytes, target: int, nTime: int, next_job, attempts, found, results):
+    hasher = HeaderHasher(header)
+    while not found.is_set():
+        with next_job.get_lock():
+            job = next_job.value
+            next_job.value += 1
+        timestamp, start = job_range(nTime, job)
+        if start == 0 and job:
+            print("Increasing timestamp {}".format(timestamp))
+        hasher.set_timestamp(timestamp)
+        for chunk in range(start, start + NONCE_SLICE, CHECK_EVERY):
+            nonce = hasher.search(chunk, chunk + CHECK_EVERY, target)
+            if nonce is not None:
+                with attempts.get_lock():
+                    attempts.value += nonce - chunk + 1
+                found.set()
+                hasher.set_nonce(nonce)
+                results.put((nonce, timestamp, hasher.header()))
+                return
+            with attempts.get_lock():
+                attempts.value += CHECK_EVERY
+            if found.is_set():
+                return
+
+
+def mine(header: bytes, nBits: int, nTime: int, workers: int = None, progress: float = 10.0) -> MiningResult:
+    """
+    Searches the nonce, then the timestamp from nTime on, of a header whose hash is below the nBits target, in
+    workers processes (all cpus by default). The first worker to find one stops the others.
+    """
+    workers = workers or mp.cpu_count()
+    target = decode_target_int(nBits)
+    next_job = mp.Value('Q', 0)
+    attempts = mp.Value('Q', 0)
+    found = mp.Event()
+    results = mp.Queue()
+    procs = [mp.Process(target=_mine_worker, args=(bytes(header), target, nTime, next_job, attempts, found, results),
+                        daemon=True) for _ in range(workers)]
+    before = time.time()
+    for p in procs:
+        p.start()
+    try:
+        while True:
             try:
-                bytes.fromhex(script)
-            except:
-                raise Exception("Looks like {} is not a script".format(script))
-            yield CTxOut(CScript() + script, satoshis)
+                nonce, timestamp, header = results.get(timeout=progress)
+                break
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    raise Exception("Mining workers exited without a solution")
+                elapsed = time.time() - before
+                print("{} attempts, {:.0f} hashes/s, timestamp {}".format(
+                    attempts.value, attempts.value / elapsed, job_range(nTime, next_job.value)[0]))
+    finally:
+        found.set()
+        for p in procs:
+            p.join()
+    return MiningResult(nonce, timestamp, header, attempts.value, time.time() - before)
+
+
+def chunk_outputs(outputs: Iterable[CTxOut], outputs_per_tx: int):
+    """ lists of outputs_per_tx outputs, the last one shorter """
+    chunk = []
+    for out in outputs:
+        chunk.append(out)
+        if len(chunk) == outputs_per_tx:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _serialize_tx(nVersion: int, scriptSig: CScript, outputs: List[CTxOut], keep: bool):
+    out = io.BytesIO() if keep else None
+    txid = stream_tx([CTxIn(scriptSig=scriptSig)], outputs, len(outputs), nVersion, out=out)
+    return txid, out.getvalue() if keep else None
+
+
+def build_block_body(
+        scriptSig: CScript,
+        txouts: Iterable[CTxOut],
+        n_outputs: int,
+        outputs_per_tx: int,
+        nVersion: int,
+        body: BinaryIO = None,
+        workers: int = None
+) -> List[bytes]:
+    """
+    Splits n_outputs outputs in transactions of outputs_per_tx outputs, serialized and hashed by workers processes
+    (all cpus by default), at most two chunks per worker in flight. The first transaction is the coinbase, with
+    scriptSig, the others have a null prevout input too, whose scriptSig pushes their index so that their ids differ.
+    The transactions are written to body in block order, after their count.
+
+    Such a block has several coinbase transactions and is not valid by consensus (bad-cb-multiple): it is only meant
+    for the merkle root and the hashing throughput, a valid block needs the outputs in the single coinbase.
+
+    returns the transaction ids, in block order
+    """
+    workers = workers or mp.cpu_count()
+    n_txs = max(1, -(-n_outputs // outputs_per_tx))
+    if body is not None:
+        body.write(encode_varint(n_txs))
+    txids = []
+    pending = deque()
+
+    def collect():
+        txid, raw = pending.popleft().get()
+        txids.append(txid)
+        if body is not None:
+            body.write(raw)
+
+    with mp.Pool(workers) as pool:
+        chunks = chunk_outputs(txouts, outputs_per_tx)
+        for index in range(n_txs):
+            chunk = next(chunks, None)
+            if chunk is None:
+                chunk = []
+            if len(chunk) < min(outputs_per_tx, n_outputs - index * outputs_per_tx):
+                raise ValueError("fewer than {} outputs".format(n_outputs))
+            sig = scriptSig if index == 0 else CScript() + encode_int(index, 4)
+            pending.append(pool.apply_async(_serialize_tx, (nVersion, sig, chunk, body is not None)))
+            if len(pending) >= 2 * workers:
+                collect()
+        while pending:
+            collect()
+        if next(chunks, None) is not None:
+            raise ValueError("more than {} outputs".format(n_outputs))
+    return txids
 
 
 def generate_genesis_block(
@@ -24,57 +208,122 @@ def generate_genesis_block(
         nBits: int,
         nVersion: int,
         pszTimestamp: str = "VeriBlock",
-        txouts: List[CTxOut] = []
+        txouts: Iterable[CTxOut] = [],
+        workers: int = None,
+        n_outputs: int = None,
+        tx_file: Path = None,
+        outputs_per_tx: int = None,
+        block_file: Path = None
 ):
+    """
+    txouts can be a generator (e.g. read_balances) of n_outputs outputs, the coinbase is streamed into its hash and
+    into tx_file if given, it is never held in memory.
+
+    With outputs_per_tx, the outputs are split in transactions of at most outputs_per_tx outputs instead, hashed in
+    parallel (see build_block_body, such a block is not valid by consensus), and the whole block is written to
+    block_file if given.
+    """
     PREV = b'\x00' * 32
 
     # create input
     scriptSig = CScript() + script_with_prefix(nBits) + pszTimestamp.encode('ascii')
 
     # create coinbase tx
-    tx = Tx(
-        version=nVersion,
-        inputs=[CTxIn(scriptSig=scriptSig)],
-        outputs=txouts
+    if n_outputs is None:
+        n_outputs = len(txouts)
+    block = None
+    if outputs_per_tx:
+        block = open(block_file, 'wb') if block_file else None
+        try:
+            if block is not None:
+                # the header is written once mined
+                block.write(bytes(80))
+            txids = build_block_body(scriptSig, txouts, n_outputs, outputs_per_tx, nVersion, block, workers)
+        except BaseException:
+            if block is not None:
+                block.close()
+            raise
+        merkleroot = merkle_root(txids)
+        txdesc = "{} transactions".format(len(txids))
+        if block_file:
+            txdesc += ", block written to {}".format(block_file)
+    else:
+        inputs = [CTxIn(scriptSig=scriptSig)]
+        # small transactions are printed
+        out = open(tx_file, 'wb') if tx_file else io.BytesIO() if n_outputs <= 100 else None
+        try:
+            txid = stream_tx(inputs, txouts, n_outputs, nVersion, out=out)
+        finally:
+            if tx_file:
+                out.close()
+        if tx_file:
+            txdesc = "written to {}".format(tx_file)
+        elif out is not None:
+            txdesc = out.getvalue().hex()
+        else:
+            txdesc = "{} outputs".format(n_outputs)
+        # the coinbase is the only transaction
+        merkleroot = txid
+    header = make_header(
+        nVersion,
+        PREV,
+        merkleroot,
+        nTime,
+        nBits,
+        0
     )
-    merkleroot = tx.tx_id()
-    TIME = nTime
-    while True:
-        nonce = 0
-        header = make_header(
-            nVersion,
-            PREV,
-            merkleroot,
-            TIME,
-            nBits,
-            nonce
-        )
-
-        before = time.time()
-        target = decode_target_int(nBits)
-        while get_block_hash_int(header) >= target:
-            nonce += 1
-            if nonce > 0xffffffff:
-                nonce = 0
-                TIME += 1
-                print("Increasing timestamp {}".format(TIME))
-                set_header_timestamp(header, TIME)
-            set_header_nonce(header, nonce)
-        after = time.time()
-        if get_block_hash_int(header) < target:
-            print(f'''Found: 
-                Nonce:      {nonce}
-                Header:     {header.hex()}
-                Hash:       {get_block_hash(header).hex()}
+
+    try:
+        result = mine(header, nBits, nTime, workers)
+        if block is not None:
+            block.seek(0)
+            block.write(result.header)
+    finally:
+        if block is not None:
+            block.close()
+    print(f'''Found: 
+                Nonce:      {result.nonce}
+                Time:       {result.timestamp}
+                Header:     {result.header.hex()}
+                Hash:       {get_block_hash(result.header).hex()}
                 MerkleRoot: {merkleroot[::-1].hex()}
-                Tx:         {tx.encode().hex()} 
-                Took:       {after-before}
+                Tx:         {txdesc} 
+                Took:       {result.seconds}
+                Attempts:   {result.attempts}
+                Hashrate:   {result.hashrate:.0f} hashes/s
             ''')
-            return
-        else:
-            print("Can not find a solution...")
+    return result
+
 
 def main():
+    parser = argparse.ArgumentParser(description='Mine the genesis blocks of the regtest, testnet and mainnet targets')
+    parser.add_argument('--workers', type=int, default=None, help='number of mining processes, default number of cpus')
+    parser.add_argument('--networks', type=lambda s: s.split(','), default=['regtest', 'testnet', 'mainnet'],
+                        help='comma separated networks among regtest, testnet, mainnet, default all')
+    parser.add_argument('--balances', type=Path, default=None,
+                        help='coinbase outputs from a btcposbal2csv.py --raw_script csv (or .gz, .xz) instead of the '
+                             'default single output, streamed')
+    parser.add_argument('--tx_dir', type=Path, default=None,
+                        help='write the serialized coinbase of every network to TX_DIR/coinbase_<network>.bin')
+    parser.add_argument('--outputs_per_tx', type=int, default=None,
+                        help='split the outputs in transactions of at most N outputs, hashed in parallel, instead of '
+                             'a single coinbase. Every transaction has a null prevout input, so the block has several '
+                             'coinbases and is NOT valid by consensus')
+    parser.add_argument('--block_dir', type=Path, default=None,
+                        help='with --outputs_per_tx, write the block of every network to BLOCK_DIR/block_<network>.bin')
+    parser.add_argument('--chainstate', type=Path, default=None,
+                        help='coinbase outputs from the balances of the P2PKH, P2SH and P2WPKH addresses of a chainstate '
+                             'instead of the default single output, aggregated in process (see airdrop.Airdrop)')
+    parser.add_argument('--network', choices=['main', 'test'], default='main',
+                        help='with --chainstate, network of the chainstate')
+    parser.add_argument('--min_balance', type=int, default=1,
+                        help='with --chainstate, only the addresses holding at least MIN_BALANCE satoshi get an output')
+    parser.add_argument('--reader', choices=LEVELDB_READERS, default='auto',
+                        help='with --chainstate, LevelDB reader, see btcposbal2csv.py --reader')
+    args = parser.parse_args()
+    assert not (args.balances and args.chainstate), '--balances and --chainstate are exclusive'
+    assert args.min_balance >= 1, '--min_balance must be at least 1'
+
     pszTimestamp = "VeriBlock Bitcoin Reference Implementation, Sept 13, 2021"
     timestamp = 1631200000
 
@@ -83,32 +332,40 @@ def main():
         amount=5 * 10**8
     )
 
-    print("Regtest")
-    generate_genesis_block(
-        nTime=timestamp,
-        pszTimestamp=pszTimestamp,
-        nBits=0x207fffff,
-        nVersion=1,
-        txouts=[out]
-    )
+    airdrop = None
+    if args.chainstate:
+        airdrop = Airdrop(str(args.chainstate), args.network, min_balance=args.min_balance, types=(0, 1),
+                          reader=args.reader)
+        print('airdrop of {} satoshi to {} addresses'.format(airdrop.satoshi, len(airdrop)))
+        n_outputs = len(airdrop)
+    else:
+        n_outputs = count_balances(args.balances) if args.balances else None
 
-    print("Testnet")
-    generate_genesis_block(
-        nTime=timestamp,
-        pszTimestamp=pszTimestamp,
-        nBits=0x1d07ffff,
-        nVersion=1,
-        txouts=[out]
-    )
-
-    print("Mainnet")
-    generate_genesis_block(
-        nTime=timestamp,
-        pszTimestamp=pszTimestamp,
-        nBits=0x1d00ffff,
-        nVersion=1,
-        txouts=[out]
-    )
+    nBits = {'regtest': 0x207fffff, 'testnet': 0x1d07ffff, 'mainnet': 0x1d00ffff}
+    try:
+        for network in args.networks:
+            print(network.capitalize())
+            if airdrop is not None:
+                txouts = iter(airdrop)
+            elif args.balances:
+                txouts = read_balances(args.balances)
+            else:
+                txouts = [out]
+            generate_genesis_block(
+                nTime=timestamp,
+                pszTimestamp=pszTimestamp,
+                nBits=nBits[network],
+                nVersion=1,
+                txouts=txouts,
+                workers=args.workers,
+                n_outputs=n_outputs,
+                tx_file=args.tx_dir / 'coinbase_{}.bin'.format(network) if args.tx_dir else None,
+                outputs_per_tx=args.outputs_per_tx,
+                block_file=args.block_dir / 'block_{}.bin'.format(network) if args.block_dir else None
+            )
+    finally:
+        if airdrop is not None:
+            airdrop.close()
 
 
 if __name__ == "__main__":
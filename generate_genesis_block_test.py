@@ -0,0 +1,108 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from airdrop import Airdrop
+from btcutil import *
+from btcposbal2csv import write_csv
+from gen_chainstate import generate_chainstate
+from generate_genesis_block import SLICES_PER_TIMESTAMP, NONCE_SLICE, build_block_body, count_balances, job_range, \
+    mine, read_balances
+from utils import P2WPKH, parse_ldb
+
+
+class TestMiner(unittest.TestCase):
+    def test_job_range(self):
+        self.assertEqual((1337, 0), job_range(1337, 0))
+        self.assertEqual((1337, NONCE_SLICE), job_range(1337, 1))
+        self.assertEqual((1337, (1 << 32) - NONCE_SLICE), job_range(1337, SLICES_PER_TIMESTAMP - 1))
+        self.assertEqual((1338, 0), job_range(1337, SLICES_PER_TIMESTAMP))
+
+    def test_mine(self):
+        # about one header in 4096 is below the target
+        nbits = 0x1f0fffff
+        header = make_header(
+            version=1,
+            prev_block=b'\x00' * 32,
+            merkle_root=b'\x11' * 32,
+            timestamp=1337,
+            nbits=nbits,
+            nonce=0
+        )
+        result = mine(header, nbits, 1337, workers=2)
+        self.assertLess(get_block_hash_int(result.header), decode_target_int(nbits))
+        self.assertEqual(result.header, make_header(1, b'\x00' * 32, b'\x11' * 32, result.timestamp, nbits,
+                                                    result.nonce))
+        self.assertGreaterEqual(result.attempts, 1)
+        self.assertGreater(result.hashrate, 0)
+
+    def test_read_balances(self):
+        rows = [(b'\x00' + b'\x01' * 20, 5000, 1), (b'\x01' + b'\x02' * 20, 0, 2), (bytes([P2WPKH]) + b'\x03' * 20, 7, 3)]
+        tmp = tempfile.mkdtemp()
+        try:
+            for name in ['balances.csv', 'balances.csv.gz']:
+                path = Path(os.path.join(tmp, name))
+                write_csv(iter(rows), str(path), 'main', raw_script=True)
+                self.assertEqual(2, count_balances(path))
+                outputs = list(read_balances(path))
+                self.assertEqual([5000, 7], [out.amount for out in outputs])
+                self.assertEqual(['76a914' + '01' * 20 + '88ac', '0014' + '03' * 20],
+                                 [out.scriptPubKey.encode().hex() for out in outputs])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_airdrop(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            chainstate = os.path.join(tmp, 'chainstate')
+            generate_chainstate(chainstate, 3000, seed=7)
+            scriptSig = CScript() + script_with_prefix(0x207fffff) + b'VeriBlock'
+
+            # the csv round trip: aggregated balances written by btcposbal2csv --raw_script and read back
+            balances = dict()
+            for key, amount, height in parse_ldb(chainstate, 'main', types=(0, 1), compact=True):
+                balances[key] = (balances.get(key, (0, 0))[0] + amount, height)
+            rows = [(key, amount, height) for key, (amount, height) in sorted(balances.items()) if amount >= 1000]
+            path = Path(os.path.join(tmp, 'balances.csv'))
+            write_csv(iter(rows), str(path), 'main', raw_script=True)
+            expected = build_block_body(scriptSig, read_balances(path), len(rows), 100, 1, workers=2)
+
+            # several spilled runs or a single one, either reader: the same outputs in the same order
+            for reader, max_memory in [('plyvel', 256 << 20), ('python', 64 << 10)]:
+                with Airdrop(chainstate, min_balance=1000, reader=reader, max_memory=max_memory, tmp_dir=tmp) as airdrop:
+                    self.assertEqual(len(rows), len(airdrop))
+                    self.assertEqual(sum(row[1] for row in rows), airdrop.satoshi)
+                    self.assertEqual(expected, build_block_body(scriptSig, iter(airdrop), len(airdrop), 100, 1,
+                                                                workers=2))
+                    # iterated again for the next network
+                    self.assertEqual(len(rows), sum(1 for _ in airdrop))
+            self.assertEqual(['balances.csv', 'chainstate'], sorted(os.listdir(tmp)))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_build_block_body(self):
+        scriptSig = CScript() + script_with_prefix(0x207fffff) + b'VeriBlock'
+        outputs = [CTxOut(CScript() + OpCode(0x00) + bytes([i % 256]) * 20, amount=i) for i in range(1001)]
+        body = io.BytesIO()
+        txids = build_block_body(scriptSig, iter(outputs), 1001, 100, 1, body, workers=2)
+
+        txs = [Tx(version=1, inputs=[CTxIn(scriptSig=scriptSig if i == 0 else CScript() + encode_int(i, 4))],
+                  outputs=outputs[i * 100:(i + 1) * 100]) for i in range(11)]
+        self.assertEqual([tx.tx_id() for tx in txs], txids)
+        self.assertEqual(encode_varint(11) + b''.join(tx.encode() for tx in txs), body.getvalue())
+        self.assertEqual(txids, build_block_body(scriptSig, iter(outputs), 1001, 100, 1, workers=2))
+        self.assertRaises(ValueError, build_block_body, scriptSig, iter(outputs), 1000, 100, 1, workers=2)
+        # fewer outputs, missing from the last transaction or a whole one
+        self.assertRaises(ValueError, build_block_body, scriptSig, iter(outputs[:3]), 4, 2, 1, workers=2)
+        self.assertRaises(ValueError, build_block_body, scriptSig, iter(outputs[:3]), 5, 2, 1, workers=2)
+
+        # a coinbase without outputs
+        self.assertEqual([Tx(version=1, inputs=[CTxIn(scriptSig=scriptSig)], outputs=[]).tx_id()],
+                         build_block_body(scriptSig, iter([]), 0, 100, 1, workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
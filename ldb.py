@@ -0,0 +1,388 @@
+"""
+Read only LevelDB reader in pure Python, for the chainstate directory: the MANIFEST gives the live table files of
+every level, the .log files are replayed into a memtable, and the tables (.ldb / .sst) are memory mapped and their
+blocks parsed in place. Iterators merge the memtable and the tables overlapping the requested key range, the entry of
+the highest sequence number of every key wins and deleted keys are skipped, like the LevelDB merge iterator.
+
+It needs no native library, and any number of processes can open the same directory: there is no LOCK and the table
+pages are shared through the page cache, so table files or key ranges can be scanned in parallel.
+
+Bitcoin Core writes uncompressed blocks (kNoCompression), the snappy blocks other LevelDB builds may write when they
+open a chainstate are decompressed in Python, slowly.
+"""
+import heapq
+import mmap
+import os
+import re
+import struct
+from bisect import bisect_left
+
+TABLE_MAGIC = 0xdb4775248b80fb57
+FOOTER_SIZE = 48
+LOG_BLOCK_SIZE = 32768
+LOG_HEADER_SIZE = 7
+LOG_FULL, LOG_FIRST, LOG_MIDDLE, LOG_LAST = 1, 2, 3, 4
+
+# internal key value types
+TYPE_DELETION = 0
+TYPE_VALUE = 1
+MAX_SEQUENCE = (1 << 56) - 1
+
+# block compression types
+NO_COMPRESSION = 0
+SNAPPY_COMPRESSION = 1
+
+# VersionEdit tags
+EDIT_COMPARATOR = 1
+EDIT_LOG_NUMBER = 2
+EDIT_NEXT_FILE_NUMBER = 3
+EDIT_LAST_SEQUENCE = 4
+EDIT_COMPACT_POINTER = 5
+EDIT_DELETED_FILE = 6
+EDIT_NEW_FILE = 7
+EDIT_PREV_LOG_NUMBER = 9
+
+
+def read_varint(buf, offset):
+    """ Reads a LevelDB varint (little endian base 128), returns the value and the offset of the next byte. """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[offset]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, offset
+        shift += 7
+
+
+def read_slice(buf, offset):
+    """ Reads a varint length prefixed byte string. """
+    size, offset = read_varint(buf, offset)
+    return bytes(buf[offset:offset + size]), offset + size
+
+
+def snappy_decompress(data):
+    """ Decompresses a raw snappy block. """
+    size, offset = read_varint(data, 0)
+    out = bytearray()
+    while offset < len(data):
+        tag = data[offset]
+        offset += 1
+        kind = tag & 3
+        if kind == 0:
+            # literal, lengths over 60 follow the tag in 1 to 4 bytes
+            length = tag >> 2
+            if length >= 60:
+                n = length - 59
+                length = int.from_bytes(data[offset:offset + n], 'little')
+                offset += n
+            length += 1
+            out += data[offset:offset + length]
+            offset += length
+            continue
+        if kind == 1:
+            length = ((tag >> 2) & 7) + 4
+            distance = ((tag >> 5) << 8) | data[offset]
+            offset += 1
+        elif kind == 2:
+            length = (tag >> 2) + 1
+            distance = int.from_bytes(data[offset:offset + 2], 'little')
+            offset += 2
+        else:
+            length = (tag >> 2) + 1
+            distance = int.from_bytes(data[offset:offset + 4], 'little')
+            offset += 4
+        start = len(out) - distance
+        if distance >= length:
+            out += out[start:start + length]
+        else:
+            # the copy overlaps its own output
+            for i in range(length):
+                out.append(out[start + i])
+    if len(out) != size:
+        raise Exception('Corrupted snappy block')
+    return memoryview(bytes(out))
+
+
+def iter_log(path):
+    """ Yields the records of a LevelDB log file (the .log write ahead logs and the MANIFEST). """
+    with open(path, 'rb') as f:
+        data = f.read()
+    record = []
+    offset = 0
+    while offset + LOG_HEADER_SIZE <= len(data):
+        left = LOG_BLOCK_SIZE - offset % LOG_BLOCK_SIZE
+        if left < LOG_HEADER_SIZE:
+            # block trailer padding
+            offset += left
+            continue
+        length, record_type = struct.unpack_from('<HB', data, offset + 4)
+        fragment = data[offset + LOG_HEADER_SIZE:offset + LOG_HEADER_SIZE + length]
+        offset += LOG_HEADER_SIZE + length
+        if record_type == 0 or len(fragment) < length:
+            # preallocated zeroes, or a record cut by a crash
+            return
+        if record_type == LOG_FULL:
+            yield fragment
+        elif record_type == LOG_FIRST:
+            record = [fragment]
+        elif record_type == LOG_MIDDLE:
+            record.append(fragment)
+        elif record_type == LOG_LAST:
+            record.append(fragment)
+            yield b''.join(record)
+            record = []
+
+
+def iter_write_batch(batch):
+    """ Yields (user key, sequence, type, value) of the entries of a WriteBatch log record. """
+    seq, count = struct.unpack_from('<QI', batch)
+    offset = 12
+    for i in range(count):
+        value_type = batch[offset]
+        key, offset = read_slice(batch, offset + 1)
+        if value_type == TYPE_VALUE:
+            value, offset = read_slice(batch, offset)
+        else:
+            value = None
+        yield key, seq + i, value_type, value
+
+
+def iter_block(block, start=None):
+    """ Yields (internal key, value) of a table block, from the first key not lower than start (a user key). """
+    num_restarts = struct.unpack_from('<I', block, len(block) - 4)[0]
+    end = len(block) - 4 - 4 * num_restarts
+    offset = 0
+    key = b''
+    while offset < end:
+        # the three lengths usually fit in one byte each
+        shared, non_shared, value_size = block[offset], block[offset + 1], block[offset + 2]
+        if (shared | non_shared | value_size) < 0x80:
+            offset += 3
+        else:
+            shared, offset = read_varint(block, offset)
+            non_shared, offset = read_varint(block, offset)
+            value_size, offset = read_varint(block, offset)
+        key = key[:shared] + bytes(block[offset:offset + non_shared])
+        offset += non_shared
+        if start is None or key[:-8] >= start:
+            yield key, block[offset:offset + value_size]
+        offset += value_size
+
+
+class Table:
+    """ A memory mapped table file. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+        footer = self._view[len(self._mm) - FOOTER_SIZE:]
+        if struct.unpack_from('<Q', footer, FOOTER_SIZE - 8)[0] != TABLE_MAGIC:
+            raise Exception('%s is not a LevelDB table' % path)
+        _, offset = read_varint(footer, 0)
+        _, offset = read_varint(footer, offset)
+        index_offset, offset = read_varint(footer, offset)
+        index_size, offset = read_varint(footer, offset)
+        # (last user key of the block, offset, size), in key order
+        self.index = []
+        for key, handle in iter_block(self._block(index_offset, index_size)):
+            block_offset, o = read_varint(handle, 0)
+            block_size, _ = read_varint(handle, o)
+            self.index.append((key[:-8], block_offset, block_size))
+
+    def _block(self, offset, size):
+        compression = self._view[offset + size]
+        if compression == NO_COMPRESSION:
+            return self._view[offset:offset + size]
+        if compression == SNAPPY_COMPRESSION:
+            return snappy_decompress(self._view[offset:offset + size])
+        raise Exception('%s: unknown block compression %d' % (self.path, compression))
+
+    def _first_block(self, start):
+        lo, hi = 0, len(self.index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.index[mid][0] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def approximate_offset(self, key):
+        """ File offset of the block holding key. """
+        i = self._first_block(key)
+        return self.index[i][1] if i < len(self.index) else len(self._mm)
+
+    def entries(self, start=None, stop=None):
+        """ Yields (user key, MAX_SEQUENCE - sequence, type, value) of the entries of user keys in [start, stop). """
+        first = 0 if start is None else self._first_block(start)
+        for _, offset, size in self.index[first:]:
+            for key, value in iter_block(self._block(offset, size), start):
+                user_key = key[:-8]
+                if stop is not None and user_key >= stop:
+                    return
+                tag = int.from_bytes(key[-8:], 'little')
+                yield user_key, MAX_SEQUENCE - (tag >> 8), tag & 0xff, value
+            start = None
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+
+
+class LevelDB:
+    """
+    Read only view of a LevelDB directory with the subset of the plyvel.DB interface used by the scans: get,
+    iterator, approximate_size and close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'CURRENT')) as f:
+            manifest = f.read().strip()
+        # level -> {file number: (size, smallest user key, largest user key)}
+        files = dict()
+        log_number = prev_log_number = 0
+        for edit in iter_log(os.path.join(path, manifest)):
+            offset = 0
+            while offset < len(edit):
+                tag, offset = read_varint(edit, offset)
+                if tag == EDIT_COMPARATOR:
+                    comparator, offset = read_slice(edit, offset)
+                    if comparator != b'leveldb.BytewiseComparator':
+                        raise Exception('Unsupported comparator %s' % comparator)
+                elif tag in (EDIT_NEXT_FILE_NUMBER, EDIT_LAST_SEQUENCE):
+                    _, offset = read_varint(edit, offset)
+                elif tag == EDIT_LOG_NUMBER:
+                    log_number, offset = read_varint(edit, offset)
+                elif tag == EDIT_PREV_LOG_NUMBER:
+                    prev_log_number, offset = read_varint(edit, offset)
+                elif tag == EDIT_COMPACT_POINTER:
+                    _, offset = read_varint(edit, offset)
+                    _, offset = read_slice(edit, offset)
+                elif tag == EDIT_DELETED_FILE:
+                    level, offset = read_varint(edit, offset)
+                    number, offset = read_varint(edit, offset)
+                    files.get(level, {}).pop(number, None)
+                elif tag == EDIT_NEW_FILE:
+                    level, offset = read_varint(edit, offset)
+                    number, offset = read_varint(edit, offset)
+                    size, offset = read_varint(edit, offset)
+                    smallest, offset = read_slice(edit, offset)
+                    largest, offset = read_slice(edit, offset)
+                    files.setdefault(level, {})[number] = (size, smallest[:-8], largest[:-8])
+                else:
+                    raise Exception('Unknown MANIFEST tag %d' % tag)
+
+        # (level, number, size, smallest user key, largest user key) of the live tables, opened lazily by _table. The
+        # tables of a level above 0 do not overlap, they are sorted by key
+        self.files = []
+        for level in sorted(files):
+            for number, (size, smallest, largest) in sorted(files[level].items(), key=lambda f: f[1][1:]):
+                self.files.append((level, number, size, smallest, largest))
+        self._tables = dict()
+
+        # the logs not yet compacted to tables, in write order
+        memtable = dict()
+        logs = []
+        for name in os.listdir(path):
+            m = re.match(r'^(\d+)\.log$', name)
+            if m and (int(m.group(1)) >= log_number or int(m.group(1)) == prev_log_number):
+                logs.append(int(m.group(1)))
+        for number in sorted(logs):
+            for batch in iter_log(os.path.join(path, '%06d.log' % number)):
+                for key, seq, value_type, value in iter_write_batch(batch):
+                    memtable[key] = (MAX_SEQUENCE - seq, value_type, value)
+        self._memtable = sorted((key,) + entry for key, entry in memtable.items())
+        self._memtable_keys = [entry[0] for entry in self._memtable]
+
+    def _table(self, number):
+        table = self._tables.get(number)
+        if table is None:
+            name = os.path.join(self.path, '%06d.ldb' % number)
+            if not os.path.exists(name):
+                name = os.path.join(self.path, '%06d.sst' % number)
+            table = self._tables[number] = Table(name)
+        return table
+
+    def _overlapping(self, start, stop):
+        return [(level, number) for level, number, _, smallest, largest in self.files
+                if (start is None or largest >= start) and (stop is None or smallest < stop)]
+
+    def _level_entries(self, numbers, start, stop):
+        # the tables of a level above 0 are read one after the other
+        for number in numbers:
+            yield from self._table(number).entries(start, stop)
+
+    def _memtable_entries(self, start, stop):
+        i = 0 if start is None else bisect_left(self._memtable_keys, start)
+        j = len(self._memtable) if stop is None else bisect_left(self._memtable_keys, stop)
+        return self._memtable[i:j]
+
+    def iterator(self, start=None, stop=None, prefix=None):
+        """ Yields (key, value) of the live keys in [start, stop), or with the given prefix, in key order. """
+        if prefix is not None:
+            start = prefix
+            stop = bytes(prefix[:-1]) + bytes([prefix[-1] + 1]) if prefix[-1] < 0xff else None
+        sources = []
+        levels = dict()
+        for level, number in self._overlapping(start, stop):
+            if level == 0:
+                sources.append(self._table(number).entries(start, stop))
+            else:
+                levels.setdefault(level, []).append(number)
+        for numbers in levels.values():
+            sources.append(self._level_entries(numbers, start, stop))
+        memtable = self._memtable_entries(start, stop)
+        if memtable:
+            sources.append(memtable)
+        if len(sources) == 1:
+            merged = sources[0]
+        else:
+            # (user key, MAX_SEQUENCE - sequence) are unique, the newest entry of a key comes first
+            merged = heapq.merge(*sources)
+        last = None
+        for key, _, value_type, value in merged:
+            if key == last:
+                continue
+            last = key
+            if value_type == TYPE_VALUE:
+                yield key, bytes(value)
+
+    def get(self, key, default=None):
+        stop = key + b'\x00'
+        for _, value in self.iterator(start=key, stop=stop):
+            return value
+        return default
+
+    def approximate_size(self, start, stop):
+        """ Approximate size of the table data of the keys in [start, stop). """
+        size = 0
+        for _, number in self._overlapping(start, stop):
+            table = self._table(number)
+            size += table.approximate_offset(stop) - table.approximate_offset(start)
+        return size
+
+    def file_ranges(self, start, stop, n=None):
+        """
+        Splits [start, stop) at the smallest keys of the table files, so that the ranges can be scanned in parallel,
+        each merging only the files overlapping it.
+
+        :param n: Maximum number of ranges, the cuts are spread over the file boundaries. By default every file
+            starts a range.
+        :return: The ranges, in key order.
+        :rtype: list of (bytes, bytes)
+        """
+        bounds = sorted(set(smallest for _, _, _, smallest, _ in self.files if start < smallest < stop))
+        if n is not None and len(bounds) >= n:
+            bounds = sorted(set(bounds[i * len(bounds) // n] for i in range(1, n)))
+        bounds = [start] + bounds + [stop]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def close(self):
+        for table in self._tables.values():
+            table.close()
+        self._tables = dict()
@@ -0,0 +1,101 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import plyvel
+
+from ldb import LevelDB, iter_block, snappy_decompress
+from utils import parse_ldb
+from gen_chainstate import generate_chainstate
+
+
+class TestLevelDB(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_db(self, compact, compression=None):
+        """ overwrites and deletes spread over several tables of several levels, the last writes left in the log """
+        path = os.path.join(self.dir, 'db')
+        rnd = random.Random(1)
+        db = plyvel.DB(path, create_if_missing=True, compression=compression, write_buffer_size=64 << 10,
+                       block_size=1024)
+        keys = [rnd.randbytes(rnd.randrange(1, 40)) for _ in range(3000)]
+        for _ in range(4):
+            for key in rnd.sample(keys, 2000):
+                db.put(key, rnd.randbytes(8) * rnd.randrange(0, 12))
+            for key in rnd.sample(keys, 300):
+                db.delete(key)
+            if compact:
+                db.compact_range()
+        db.close()
+        return path
+
+    def assert_same(self, path):
+        db = plyvel.DB(path, compression=None)
+        try:
+            expected = list(db.iterator())
+            lo = expected[100][0]
+            expected_range = list(db.iterator(start=lo, stop=b'\x80'))
+            expected_prefix = list(db.iterator(prefix=b'\x80'))
+            missing = [k for k in (b'\x00', b'\xff' * 50) if db.get(k) is None]
+        finally:
+            db.close()
+
+        ldb = LevelDB(path)
+        try:
+            self.assertGreater(len(ldb.files), 1)
+            self.assertEqual(expected, list(ldb.iterator()))
+            self.assertEqual(expected_range, list(ldb.iterator(start=lo, stop=b'\x80')))
+            self.assertEqual(expected_prefix, list(ldb.iterator(prefix=b'\x80')))
+            for key, value in expected[::50]:
+                self.assertEqual(value, ldb.get(key))
+            for key in missing:
+                self.assertIsNone(ldb.get(key))
+
+            ranges = ldb.file_ranges(b'', b'\xff' * 50, 7)
+            self.assertLessEqual(len(ranges), 7)
+            self.assertEqual(expected, [kv for start, stop in ranges for kv in ldb.iterator(start=start, stop=stop)])
+        finally:
+            ldb.close()
+
+    def test_uncompacted(self):
+        self.assert_same(self.make_db(compact=False))
+
+    def test_compacted(self):
+        self.assert_same(self.make_db(compact=True))
+
+    def test_snappy(self):
+        self.assert_same(self.make_db(compact=True, compression='snappy'))
+
+    def test_snappy_decompress(self):
+        # literal "abcd", then copies of 2 byte offsets, one overlapping its output
+        data = b'\x0c' + b'\x0cabcd' + b'\x0e\x04\x00' + b'\x0e\x01\x00'
+        self.assertEqual(b'abcdabcddddd', bytes(snappy_decompress(data)))
+
+    def test_iter_block(self):
+        # restart every 2 entries, "ab" shares "a" with "a"
+        block = b''.join([
+            b'\x00\x09\x01' + b'a' + b'\x01' * 8 + b'1',
+            b'\x01\x09\x01' + b'b' + b'\x01' * 8 + b'2',
+            b'\x00\x09\x01' + b'c' + b'\x01' * 8 + b'3',
+        ])
+        block += (0).to_bytes(4, 'little') + (26).to_bytes(4, 'little') + (2).to_bytes(4, 'little')
+        self.assertEqual([b'a', b'ab', b'c'], [key[:-8] for key, _ in iter_block(memoryview(block))])
+        self.assertEqual([b'3'], [bytes(v) for _, v in iter_block(memoryview(block), start=b'b')])
+
+    def test_parse_ldb(self):
+        path = os.path.join(self.dir, 'chainstate')
+        generate_chainstate(path, 3000, seed=5)
+        expected = list(parse_ldb(path, 'main', types={0, 1}, compact=True, reader='plyvel'))
+        self.assertEqual(expected, list(parse_ldb(path, 'main', types={0, 1}, compact=True, reader='python')))
+        self.assertGreater(len(expected), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
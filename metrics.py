@@ -0,0 +1,125 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from aggregation import peak_rss
+
+
+def script_type(out_type):
+    """ Name of the script type of an out_type, see parse_ldb. """
+    if out_type == 0:
+        return 'P2PKH'
+    if out_type == 1:
+        return 'P2SH'
+    if 2 <= out_type <= 5:
+        return 'P2PK'
+    # utils.P2WPKH
+    if out_type == 28:
+        return 'P2WPKH'
+    return 'other'
+
+
+class Metrics:
+    """
+    Counters of a chainstate scan, emitted as JSON lines every interval seconds and as a final summary line.
+
+    The scan updates outputs and not_decoded (out_type -> [count, satoshi]) in place and calls tick with the records
+    and bytes read since the last call, every few thousand outputs.
+    """
+
+    def __init__(self, out=None, interval=10.0, total_bytes=None):
+        """
+        :param out: File object or path receiving the JSON lines, '-' for stderr, None to only count.
+        :param interval: Seconds between two progress lines.
+        :param total_bytes: Estimated size of the scanned records, for the ETA.
+        """
+        if out == '-':
+            out = sys.stderr
+        self._close_out = isinstance(out, str)
+        self.out = open(out, 'a') if self._close_out else out
+        self.interval = interval
+        self.total_bytes = total_bytes
+        self.records = 0
+        self.bytes = 0
+        self.outputs = dict()
+        self.not_decoded = dict()
+        self.stages = dict()
+        self.start = time.time()
+        self._last_emit = self.start
+
+    def tick(self, records=0, nbytes=0):
+        self.records += records
+        self.bytes += nbytes
+        if self.out is not None and time.time() - self._last_emit >= self.interval:
+            self.emit('progress')
+
+    def merge(self, counters):
+        """ Adds the counters of another scan, as returned by counters(). """
+        self.records += counters['records']
+        self.bytes += counters['bytes']
+        for mine, theirs in [(self.outputs, counters['outputs']), (self.not_decoded, counters['not_decoded'])]:
+            for out_type, (count, satoshi) in theirs.items():
+                c = mine.setdefault(out_type, [0, 0])
+                c[0] += count
+                c[1] += satoshi
+        self.tick()
+
+    def counters(self):
+        return dict(records=self.records, bytes=self.bytes, outputs=self.outputs, not_decoded=self.not_decoded)
+
+    @contextmanager
+    def stage(self, name):
+        """ Times a stage of the run, stage times add up if the stage is entered again. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.time() - start
+
+    def not_decoded_total(self):
+        return [sum(c[0] for c in self.not_decoded.values()), sum(c[1] for c in self.not_decoded.values())]
+
+    def snapshot(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        outputs = sum(c[0] for c in self.outputs.values())
+        script_types = dict()
+        for out_type, (count, satoshi) in sorted(self.outputs.items()):
+            t = script_types.setdefault(script_type(out_type), dict(outputs=0, satoshi=0))
+            t['outputs'] += count
+            t['satoshi'] += satoshi
+        eta = None
+        if self.total_bytes and self.bytes:
+            eta = max(0.0, (self.total_bytes - self.bytes) / (self.bytes / elapsed))
+        return dict(
+            time=time.time(),
+            elapsed=elapsed,
+            records=self.records,
+            outputs=outputs,
+            bytes=self.bytes,
+            total_bytes=self.total_bytes,
+            outputs_per_second=outputs / elapsed,
+            bytes_per_second=self.bytes / elapsed,
+            eta_seconds=eta,
+            script_types=script_types,
+            not_decoded={str(out_type): dict(outputs=count, satoshi=satoshi)
+                         for out_type, (count, satoshi) in sorted(self.not_decoded.items())},
+            stages=self.stages,
+            peak_rss=peak_rss(),
+        )
+
+    def emit(self, event):
+        self._last_emit = time.time()
+        line = self.snapshot()
+        line['event'] = event
+        self.out.write(json.dumps(line) + '\n')
+        self.out.flush()
+
+    def close(self):
+        """ Writes the final summary line. """
+        if self.out is None:
+            return
+        self.emit('summary')
+        if self._close_out:
+            self.out.close()
+        self.out = None
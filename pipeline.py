@@ -0,0 +1,288 @@
+"""
+Staged chainstate scan: a LevelDB reader thread, a pool of decoding processes, an aggregator thread and a buffered
+CSV writer, connected by bounded queues so that reading, decoding and writing overlap. Every stage reports its busy
+and idle time and the depth of the queue it reads from, to show where the bottleneck is.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+from binascii import unhexlify
+from functools import partial
+
+from aggregation import AddressTable, top_by_amount
+from metrics import Metrics
+from utils import DEOBFUSCATE_BATCH, decode_coins, address_key, encode_key, open_chainstate
+from writers import OutputWriter
+
+_DONE = object()
+
+
+class Aborted(Exception):
+    pass
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.depth_max = 0
+        self.depth_sum = 0
+        self.depth_samples = 0
+
+    def sample(self, q):
+        depth = q.qsize()
+        self.depth_max = max(self.depth_max, depth)
+        self.depth_sum += depth
+        self.depth_samples += 1
+
+    def report(self):
+        depth = self.depth_sum / self.depth_samples if self.depth_samples else 0
+        return '%-10s items %10d  busy %8.1f s  idle %8.1f s  input queue avg %5.1f max %4d' % (
+            self.name, self.items, self.busy, self.idle, depth, self.depth_max)
+
+
+class Pipeline:
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.abort = threading.Event()
+        self.errors = []
+        self.stats = []
+        self.threads = []
+
+    def queue(self):
+        return queue.Queue(self.queue_size)
+
+    def get(self, q, stats):
+        """ Gets the next item of q, the waiting time is accounted as idle time of the stage. """
+        start = time.perf_counter()
+        if stats is not None:
+            stats.sample(q)
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.abort.is_set():
+                    raise Aborted()
+        if stats is not None:
+            stats.idle += time.perf_counter() - start
+        return item
+
+    def put(self, q, item, stats):
+        start = time.perf_counter()
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if self.abort.is_set():
+                    raise Aborted()
+        if stats is not None:
+            stats.idle += time.perf_counter() - start
+
+    def iterate(self, q, stats):
+        while True:
+            item = self.get(q, stats)
+            if item is _DONE:
+                return
+            yield item
+
+    def stage(self, name, target, *args):
+        """ Runs target(stats, *args) in a thread, its wall time minus its idle time is its busy time. """
+        stats = StageStats(name)
+        self.stats.append(stats)
+
+        def run():
+            start = time.perf_counter()
+            try:
+                target(stats, *args)
+            except Aborted:
+                pass
+            except BaseException as e:
+                self.errors.append(e)
+                self.abort.set()
+            stats.busy += time.perf_counter() - start - stats.idle
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return stats
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def decode_batch(batch, o_key, filters):
+    """
+    Decodes a batch of raw chainstate values to (key, value, height) address records. Runs in the decoding processes.
+
+    :param batch: The raw values and the total size of their chainstate keys.
+    :param filters: types, min_amount, min_height and max_height, see utils.decode_coins.
+    :return: The records, the scan counters of the batch (see Metrics.counters) and the decoding time.
+    """
+    start = time.perf_counter()
+    values, nbytes = batch
+    records = []
+    outputs = dict()
+    not_decoded = dict()
+    nbytes += sum(map(len, values))
+    for i in range(0, len(values), DEOBFUSCATE_BATCH):
+        for out_type, data, amount, height in decode_coins(values[i:i + DEOBFUSCATE_BATCH], o_key, **filters):
+            counter = outputs.setdefault(out_type, [0, 0])
+            counter[0] += 1
+            counter[1] += amount
+            if data is None:
+                continue
+            key = address_key(out_type, data)
+            if key is None:
+                counter = not_decoded.setdefault(out_type, [0, 0])
+                counter[0] += 1
+                counter[1] += amount
+                continue
+            records.append((key, amount, height))
+    counters = dict(records=len(values), bytes=nbytes, outputs=outputs, not_decoded=not_decoded)
+    return records, counters, time.perf_counter() - start
+
+
+def _read(stats, p, db, out_q, batch_size):
+    batch = []
+    key_bytes = 0
+    for key, value in db.iterator(prefix=b'C'):
+        batch.append(value)
+        key_bytes += len(key)
+        if len(batch) == batch_size:
+            stats.items += len(batch)
+            p.put(out_q, (batch, key_bytes), stats)
+            batch = []
+            key_bytes = 0
+    stats.items += len(batch)
+    p.put(out_q, (batch, key_bytes), stats)
+    p.put(out_q, _DONE, stats)
+
+
+def _decode(stats, p, pool, in_q, out_q, o_key, filters, in_flight, pool_stats, metrics):
+    # the pool reads its input eagerly, the semaphore bounds the number of batches sent to the decoders
+    slots = threading.Semaphore(in_flight)
+
+    def batches():
+        for batch in p.iterate(in_q, stats):
+            while not slots.acquire(timeout=0.1):
+                if p.abort.is_set():
+                    return
+            yield batch
+
+    for records, counters, busy in pool.imap(partial(decode_batch, o_key=o_key, filters=filters), batches()):
+        slots.release()
+        pool_stats.busy += busy
+        pool_stats.items += len(records)
+        metrics.merge(counters)
+        stats.items += 1
+        p.put(out_q, records, None)
+    p.put(out_q, _DONE, None)
+
+
+def _aggregate(stats, p, in_q, table):
+    for records in p.iterate(in_q, stats):
+        for key, amount, height in records:
+            table.add(key, amount, height)
+        stats.items += len(records)
+
+
+def _write(stats, p, in_q, out, output):
+    with OutputWriter(out, **output) as f:
+        for chunk in p.iterate(in_q, stats):
+            f.write(chunk)
+            stats.items += 1
+    print(f.report())
+
+
+def run(chainstate, out, network, types, raw_script=False, decoders=None, sort=None, top=None,
+        batch_size=10000, queue_size=16, metrics=None, min_amount=0, min_height=0, max_height=None, reader='auto',
+        output=None):
+    """
+    Scans a v0.15+ chainstate with the staged pipeline and writes the address CSV, same format as btcposbal2csv.
+
+    :param decoders: Number of decoding processes, all cpus by default.
+    :param sort: None, 'ASC' or 'DESC'.
+    :param top: Only write the top N addresses (the richest unless sort is 'ASC').
+    :param batch_size: Number of chainstate records per batch sent to the decoders.
+    :param queue_size: Capacity of the queues between the stages, in batches.
+    :param metrics: Metrics receiving the scan counters and the stage times.
+    :param min_amount: Skip the outputs of less satoshi.
+    :param min_height: Skip the outputs created before this height.
+    :param max_height: Skip the outputs created after this height.
+    :param reader: Chainstate reader, see utils.open_chainstate.
+    :param output: writers.OutputWriter options of the csv (compression, level, threads).
+    :return: The stage statistics.
+    """
+    decoders = decoders or multiprocessing.cpu_count()
+    p = Pipeline(queue_size)
+    metrics = metrics or Metrics()
+    # busy time summed over the decoding processes
+    pool_stats = StageStats('decoders')
+
+    db = open_chainstate(chainstate, reader)
+    try:
+        o_key = db.get(unhexlify('0e00') + b'obfuscate_key')
+        if o_key is not None:
+            o_key = o_key[1:]
+
+        raw_q, records_q, write_q = p.queue(), p.queue(), p.queue()
+        if metrics.total_bytes is None:
+            metrics.total_bytes = db.approximate_size(b'C', b'D')
+        table = AddressTable()
+        start = time.perf_counter()
+        with multiprocessing.Pool(decoders) as pool:
+            p.stage('reader', _read, p, db, raw_q, batch_size)
+            filters = dict(types=set(types), min_amount=min_amount, min_height=min_height, max_height=max_height)
+            p.stage('dispatch', _decode, p, pool, raw_q, records_q, o_key, filters, 2 * decoders, pool_stats, metrics)
+            p.stage('aggregator', _aggregate, p, records_q, table)
+            p.join()
+        pool_stats.idle = decoders * (time.perf_counter() - start) - pool_stats.busy
+    finally:
+        db.close()
+    p.stats.insert(2, pool_stats)
+
+    # the writer overlaps with the address encoding and formatting
+    writer = p.stage('writer', _write, p, write_q, out, output or dict())
+    formatter = StageStats('formatter')
+    p.stats.insert(len(p.stats) - 1, formatter)
+    start = time.perf_counter()
+    if top:
+        rows = top_by_amount(table, top, reverse=sort != 'ASC')
+    elif sort is not None:
+        rows = table.sorted_by_amount(reverse=sort == 'DESC')
+    else:
+        rows = table
+    try:
+        w = ['address,value_satoshi,last_height']
+        for key, sat_val, block_height in rows:
+            if sat_val == 0:
+                continue
+            w.append('%s,%d,%d' % (encode_key(key, network, raw_script), sat_val, block_height))
+            formatter.items += 1
+            if len(w) == 10000:
+                p.put(write_q, ('\n'.join(w) + '\n').encode(), formatter)
+                w = []
+        if w:
+            p.put(write_q, ('\n'.join(w) + '\n').encode(), formatter)
+        p.put(write_q, b'\n', formatter)
+        p.put(write_q, _DONE, formatter)
+    except Aborted:
+        pass
+    formatter.busy = time.perf_counter() - start - formatter.idle
+    p.join()
+
+    not_decoded = metrics.not_decoded_total()
+    print('unable to decode %d transactions' % not_decoded[0])
+    print('totaling %d satoshi' % not_decoded[1])
+    for stats in p.stats:
+        print(stats.report())
+        metrics.stages[stats.name] = stats.busy
+    return p.stats
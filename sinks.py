@@ -0,0 +1,173 @@
+"""
+Outputs of the aggregated balances. A run writes any number of them in a single pass over the (key, value,
+last_height) rows, so the chainstate is scanned and decoded once whatever the outputs: every row is handed to every
+sink, with its address and script encoded at most once. The files are written by writers.OutputWriter, - writes to
+stdout and the .gz, .xz and .zst suffixes compress.
+
+Sinks are given on the command line as KIND:PATH, see SINKS.
+"""
+import json
+
+from metrics import script_type
+from utils import encode_key
+from writers import LineWriter, OutputWriter, split_suffix
+
+CSV_HEADER = 'address,value_satoshi,last_height'
+
+
+class CsvSink:
+    """ Address csv, the format of the main output of btcposbal2csv. """
+    # the encoding of the key the sink needs: False for the address, True for the hex script, None for none
+    raw_script = False
+
+    def __init__(self, path, keep_zero=False, **output):
+        self.path = path
+        self.keep_zero = keep_zero
+        self._out = LineWriter(path, CSV_HEADER, **output)
+        self.writers = [self._out.out]
+
+    def add(self, key, amount, height, names):
+        self._out.add('%s,%d,%d' % (names[self.raw_script], amount, height))
+
+    def close(self):
+        self._out.close(trailer='')
+
+
+class RawScriptCsvSink(CsvSink):
+    """ Csv of the hex scripts instead of the addresses, like --raw_script. """
+    raw_script = True
+
+
+class TypesSink:
+    """
+    One address csv per script type, PATH_p2pkh.csv, PATH_p2sh.csv and PATH_p2wpkh.csv, created on first use. A
+    .csv suffix of PATH is dropped and a compression suffix goes after .csv: out.csv writes out_p2pkh.csv...,
+    out.csv.gz and out.gz write out_p2pkh.csv.gz...
+    """
+    raw_script = False
+
+    def __init__(self, path, keep_zero=False, **output):
+        self.path = path
+        self.keep_zero = keep_zero
+        self.writers = []
+        self._output = output
+        self._files = dict()
+
+    def add(self, key, amount, height, names):
+        out = self._files.get(key[0])
+        if out is None:
+            base, suffix = split_suffix(self.path)
+            if base.endswith('.csv'):
+                base = base[:-len('.csv')]
+            path = '%s_%s.csv%s' % (base, script_type(key[0]).lower(), suffix)
+            out = self._files[key[0]] = LineWriter(path, CSV_HEADER, **self._output)
+            self.writers.append(out.out)
+        out.add('%s,%d,%d' % (names[self.raw_script], amount, height))
+
+    def close(self):
+        for out in self._files.values():
+            out.close(trailer='')
+
+
+class Hash160Sink:
+    """ The hex hash160 of every address, one per line: the witness program for P2WPKH. """
+    raw_script = None
+
+    def __init__(self, path, keep_zero=False, **output):
+        self.path = path
+        self.keep_zero = False
+        self._out = LineWriter(path, **output)
+        self.writers = [self._out.out]
+
+    def add(self, key, amount, height, names):
+        self._out.add(key[1:].hex())
+
+    def close(self):
+        self._out.close()
+
+
+class SummarySink:
+    """ JSON totals: addresses and satoshi, overall and per script type, and the highest last_height. """
+    raw_script = None
+
+    def __init__(self, path, keep_zero=False, **output):
+        self.path = path
+        self.keep_zero = False
+        self.types = dict()
+        self.max_height = 0
+        self._out = OutputWriter(path, **output)
+        self.writers = [self._out]
+
+    def add(self, key, amount, height, names):
+        totals = self.types.setdefault(script_type(key[0]), [0, 0])
+        totals[0] += 1
+        totals[1] += amount
+        self.max_height = max(self.max_height, height)
+
+    def close(self):
+        summary = dict(
+            addresses=sum(count for count, _ in self.types.values()),
+            satoshi=sum(satoshi for _, satoshi in self.types.values()),
+            max_height=self.max_height,
+            types={name: dict(addresses=count, satoshi=satoshi) for name, (count, satoshi) in sorted(self.types.items())},
+        )
+        try:
+            self._out.write((json.dumps(summary, indent=2) + '\n').encode())
+        finally:
+            self._out.close()
+
+
+SINKS = {
+    'csv': CsvSink,
+    'raw_script': RawScriptCsvSink,
+    'types': TypesSink,
+    'hash160': Hash160Sink,
+    'summary': SummarySink,
+}
+
+
+def parse_sink(spec):
+    """ Parses a KIND:PATH sink specification, KIND being one of SINKS. """
+    kind, sep, path = spec.partition(':')
+    if not sep or not path or kind not in SINKS:
+        raise ValueError('sink %r is not KIND:PATH with KIND among %s' % (spec, ', '.join(SINKS)))
+    return kind, path
+
+
+def open_sinks(specs, keep_zero=False, **output):
+    """
+    Opens the (kind, path) sinks of parse_sink.
+
+    :param keep_zero: The csv sinks also write the rows without balance.
+    :param output: writers.OutputWriter options (compression, level, threads).
+    """
+    return [SINKS[kind](path, keep_zero, **output) for kind, path in specs]
+
+
+def fan_out(rows, sinks, network):
+    """
+    Hands every (key, value, last_height) row to every sink, then closes them and prints the size and rate of every
+    written file. The address and the script of a row are encoded once, and only for the sinks which write it.
+
+    :return: Number of rows.
+    :rtype: int
+    """
+    encodings = sorted(set(sink.raw_script for sink in sinks if sink.raw_script is not None))
+    keep_zero = [sink for sink in sinks if sink.keep_zero]
+    count = 0
+    try:
+        for key, amount, height in rows:
+            count += 1
+            targets = sinks if amount else keep_zero
+            if not targets:
+                continue
+            names = {raw_script: encode_key(key, network, raw_script) for raw_script in encodings}
+            for sink in targets:
+                sink.add(key, amount, height, names)
+    finally:
+        for sink in sinks:
+            sink.close()
+    for sink in sinks:
+        for writer in sink.writers:
+            print(writer.report())
+    return count
@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sinks import fan_out, open_sinks, parse_sink
+from utils import P2WPKH, encode_key
+
+P2PKH_KEY = b'\x00' + bytes.fromhex('62e907b15cbf27d5425399ebf6f0fb50ebb88f18')
+P2SH_KEY = b'\x01' + bytes.fromhex('8f55563b9a19f321c211e9b9f38cdf686ea07845')
+P2WPKH_KEY = bytes([P2WPKH]) + bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')
+ROWS = [(P2PKH_KEY, 5000000000, 1), (P2SH_KEY, 0, 7), (P2WPKH_KEY, 2100, 600000)]
+
+
+class TestSinks(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_parse_sink(self):
+        self.assertEqual(('types', 'out/balances'), parse_sink('types:out/balances'))
+        self.assertEqual(('csv', 'C:/out.csv'), parse_sink('csv:C:/out.csv'))
+        for spec in ['out.csv', 'csv:', 'xml:out.xml']:
+            self.assertRaises(ValueError, parse_sink, spec)
+
+    def test_fan_out(self):
+        specs = [('csv', self.path('a.csv')), ('raw_script', self.path('s.csv')), ('types', self.path('t')),
+                 ('hash160', self.path('h.txt')), ('summary', self.path('summary.json'))]
+        self.assertEqual(3, fan_out(iter(ROWS), open_sinks(specs), 'main'))
+
+        self.assertEqual('address,value_satoshi,last_height\n'
+                         '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa,5000000000,1\n'
+                         'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4,2100,600000\n\n', self.read('a.csv'))
+        self.assertIn('76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac,5000000000,1\n', self.read('s.csv'))
+        self.assertEqual(['t_p2pkh.csv', 't_p2wpkh.csv'], sorted(n for n in os.listdir(self.dir) if n.startswith('t_')))
+        self.assertIn(encode_key(P2WPKH_KEY, 'main') + ',2100,600000\n', self.read('t_p2wpkh.csv'))
+        self.assertEqual([P2PKH_KEY[1:].hex(), P2WPKH_KEY[1:].hex()], self.read('h.txt').split())
+        summary = json.loads(self.read('summary.json'))
+        self.assertEqual(2, summary['addresses'])
+        self.assertEqual(5000002100, summary['satoshi'])
+        self.assertEqual(600000, summary['max_height'])
+        self.assertEqual({'addresses': 1, 'satoshi': 2100}, summary['types']['P2WPKH'])
+
+    def test_types_names(self):
+        for spec, name in [('t', 't_p2pkh.csv'), ('t.csv', 't_p2pkh.csv'), ('t.csv.gz', 't_p2pkh.csv.gz'),
+                           ('t.gz', 't_p2pkh.csv.gz')]:
+            fan_out(iter(ROWS), open_sinks([('types', self.path(spec))]), 'main')
+            self.assertEqual([name, name.replace('p2pkh', 'p2wpkh')], sorted(os.listdir(self.dir)))
+            for written in os.listdir(self.dir):
+                os.remove(self.path(written))
+
+    def test_keep_zero(self):
+        fan_out(iter(ROWS), open_sinks([('csv', self.path('a.csv')), ('summary', self.path('s.json'))], True), 'main')
+        self.assertIn(encode_key(P2SH_KEY, 'main') + ',0,7\n', self.read('a.csv'))
+        self.assertEqual(2, json.loads(self.read('s.json'))['addresses'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Reader of the UTXO snapshots written by the dumptxoutset RPC of Bitcoin Core, an alternative input to the chainstate
+LevelDB which does not need the node to be stopped. The file is read sequentially in large buffers.
+
+Two layouts are supported:
+    - v28+: magic 'utxo\\xff', version (uint16), network magic (4 bytes), base block hash, coins count (uint64), then
+      the coins grouped by transaction: txid, compact size count, and count times compact size vout + coin.
+    - v22 - v27: base block hash, coins count (uint64), then every coin as txid, vout (uint32) + coin.
+
+A coin is serialized like in the chainstate, without obfuscation: varint code | varint value | varint out_type | script,
+see utils.decode_coin.
+"""
+import os
+import struct
+
+from metrics import Metrics
+from utils import P2WPKH, NSPECIALSCRIPTS, B58PUBKEY_PREFIXES, read_b128, txout_decompress, _iter_addresses
+
+SNAPSHOT_MAGIC = b'utxo\xff'
+SNAPSHOT_VERSION = 2
+NETWORK_MAGICS = {
+    bytes.fromhex('f9beb4d9'): 'main',
+    bytes.fromhex('0b110907'): 'test',  # testnet3
+    bytes.fromhex('1c163f28'): 'test',  # testnet4
+    bytes.fromhex('0a03cf40'): 'test',  # signet
+}
+# magic, version, network magic, base block hash, coins count
+SNAPSHOT_HEADER = struct.Struct('<5sH4s32sQ')
+# base block hash, coins count
+LEGACY_SNAPSHOT_HEADER = struct.Struct('<32sQ')
+# scripts of the UTXO set are at most MAX_SCRIPT_SIZE bytes, a record always fits in the buffer tail kept on refill
+MAX_RECORD_SIZE = 32 + 9 + 9 + 5 + 10 + 3 + 10000
+READ_SIZE = 1 << 24
+
+
+def read_compact_size(data, offset):
+    """ Reads a Bitcoin CompactSize integer, returns the value and the offset of the next byte. """
+    n = data[offset]
+    if n < 0xfd:
+        return n, offset + 1
+    if n == 0xfd:
+        return int.from_bytes(data[offset + 1:offset + 3], 'little'), offset + 3
+    if n == 0xfe:
+        return int.from_bytes(data[offset + 1:offset + 5], 'little'), offset + 5
+    return int.from_bytes(data[offset + 1:offset + 9], 'little'), offset + 9
+
+
+def read_header(f):
+    """
+    Reads the metadata of a snapshot file.
+
+    :return: Layout version (SNAPSHOT_VERSION or 0 for the legacy layout), network (None for the legacy layout), base
+        block hash (hex, as displayed) and number of coins.
+    :rtype: int, str, str, int
+    """
+    head = f.read(SNAPSHOT_HEADER.size)
+    if head[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC:
+        _, version, network_magic, block_hash, count = SNAPSHOT_HEADER.unpack(head)
+        if version != SNAPSHOT_VERSION:
+            raise Exception('Unsupported snapshot version %d' % version)
+        if network_magic not in NETWORK_MAGICS:
+            raise Exception('Unknown snapshot network magic %s' % network_magic.hex())
+        return version, NETWORK_MAGICS[network_magic], block_hash[::-1].hex(), count
+    block_hash, count = LEGACY_SNAPSHOT_HEADER.unpack(head[:LEGACY_SNAPSHOT_HEADER.size])
+    f.seek(LEGACY_SNAPSHOT_HEADER.size)
+    return 0, None, block_hash[::-1].hex(), count
+
+
+def _buffers(f, tail_size):
+    """ Yields (buffer, end, eof): the buffers overlap, every buffer starts with the unread tail of the previous one,
+    the records are parsed until end, which leaves at least tail_size bytes unless at the end of the file. """
+    buf = b''
+    offset = 0
+    while True:
+        chunk = f.read(READ_SIZE)
+        buf = buf[offset:] + chunk
+        eof = not chunk
+        offset = yield buf, len(buf) if eof else len(buf) - tail_size, eof
+        if eof:
+            return
+
+
+def _read_coin(buf, offset, filters):
+    """ Reads a coin, returns (out_type, data, amount, height) like utils.decode_coins and the next offset. """
+    types, min_amount, min_height, max_height = filters
+    code, offset = read_b128(buf, offset)
+    amount, offset = read_b128(buf, offset)
+    out_type, offset = read_b128(buf, offset)
+    if out_type in (0, 1):
+        size = 20
+    elif out_type in (2, 3, 4, 5):
+        size = 32
+    else:
+        size = out_type - NSPECIALSCRIPTS
+    amount = txout_decompress(amount)
+    height = code >> 1
+    if amount < min_amount or height < min_height or height > max_height or out_type in (0, 1) and out_type not in types:
+        data = None
+    elif out_type == 0 or out_type == 1 or out_type == P2WPKH:
+        data = bytes(buf[offset:offset + size])
+    else:
+        data = b''
+    return out_type, data, amount, height, offset + size
+
+
+def _iter_outs_snapshot(f, version, filters):
+    # same records as utils._iter_outs_bytes, the record key is the offset of the coin in the file
+    buffers = _buffers(f, MAX_RECORD_SIZE)
+    buf, end, eof = next(buffers)
+    base = f.tell() - len(buf)
+    offset = 0
+    remaining = 0
+    while True:
+        if offset >= end and not eof:
+            base += offset
+            buf, end, eof = buffers.send(offset)
+            offset = 0
+        if offset >= len(buf):
+            return
+        start = offset
+        if version == 0:
+            offset += 36
+        else:
+            if remaining == 0:
+                # next transaction
+                remaining, offset = read_compact_size(buf, offset + 32)
+            _, offset = read_compact_size(buf, offset)
+            remaining -= 1
+        out_type, data, amount, height, offset = _read_coin(buf, offset, filters)
+        yield out_type, data, amount, height, offset - start, base + start
+
+
+def parse_snapshot(fin_name, network, types=(0, 1), raw_script=False, verbose=True, compact=False, metrics=None,
+                   min_amount=0, min_height=0, max_height=None, watch=None):
+    """
+    Scans a dumptxoutset snapshot file, yielding the same (address, value, height) records as utils.parse_ldb with the
+    same arguments.
+    """
+    assert network in B58PUBKEY_PREFIXES
+    filters = (set(types), min_amount, min_height, 1 << 62 if max_height is None else max_height)
+    if metrics is None:
+        metrics = Metrics()
+    with open(fin_name, 'rb', buffering=0) as f:
+        version, snapshot_network, block_hash, count = read_header(f)
+        if snapshot_network is not None and snapshot_network != network:
+            raise AssertionError('%s is a snapshot of the %s network' % (fin_name, snapshot_network))
+        if verbose:
+            print('snapshot of %d coins at block %s' % (count, block_hash))
+        if metrics.total_bytes is None:
+            metrics.total_bytes = os.fstat(f.fileno()).st_size - f.tell()
+        yield from _iter_addresses(_iter_outs_snapshot(f, version, filters), network, types, raw_script, compact,
+                                   metrics, min_amount, min_height, max_height, watch, None)
+
+    if verbose:
+        total = metrics.not_decoded_total()
+        print('unable to decode %d transactions' % total[0])
+        print('totaling %d satoshi' % total[1])
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+import snapshot
+from snapshot import *
+from btcposbal2csv import in_mem, low_mem
+from gen_chainstate import generate_chainstate, generate_coins, write_snapshot
+from utils import parse_ldb
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.chainstate = os.path.join(self.dir, 'chainstate')
+        generate_chainstate(self.chainstate, 5000, seed=4)
+        self.records = list(generate_coins(5000, seed=4))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def args(self, chainstate, snapshot):
+        return Namespace(chainstate=chainstate, snapshot=snapshot, network='main', bitcoin_version=0.15,
+                         decoder='bytes', workers=1, P2PKH=True, P2SH=True, P2PK=False, max_memory=1 << 16,
+                         tmp_dir=None, sort=None, top=None, min_amount=0, min_height=0, max_height=None,
+                         checkpoint=None, reader='auto')
+
+    def test_matches_chainstate(self):
+        expected = list(parse_ldb(self.chainstate, 'main', raw_script=True))
+        path = os.path.join(self.dir, 'utxo.dat')
+        read_size = snapshot.READ_SIZE
+        try:
+            for legacy in [False, True]:
+                write_snapshot(path, self.records, legacy=legacy)
+                with open(path, 'rb') as f:
+                    self.assertEqual((0 if legacy else SNAPSHOT_VERSION, None if legacy else 'main', '00' * 32, 5000),
+                                     read_header(f))
+                # records crossing the buffer boundaries
+                snapshot.READ_SIZE = 20011
+                self.assertEqual(expected, list(parse_snapshot(path, 'main', raw_script=True)))
+                snapshot.READ_SIZE = read_size
+                self.assertEqual(list(in_mem(self.args(self.chainstate, False))),
+                                 list(in_mem(self.args(path, True))))
+                self.assertEqual(list(low_mem(self.args(self.chainstate, False))),
+                                 list(low_mem(self.args(path, True))))
+        finally:
+            snapshot.READ_SIZE = read_size
+
+    def test_network(self):
+        path = os.path.join(self.dir, 'utxo.dat')
+        write_snapshot(path, self.records[:100])
+        expected = [(key, val, height) for key, val, height in parse_snapshot(path, 'main', compact=True)]
+        write_snapshot(path, self.records[:100], network_magic=bytes.fromhex('1c163f28'))
+        self.assertEqual(expected, list(parse_snapshot(path, 'test', compact=True)))
+        with self.assertRaises(AssertionError):
+            list(parse_snapshot(path, 'main'))
+
+
+if __name__ == '__main__':
+    unittest.main()
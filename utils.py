@@ -1,9 +1,19 @@
 from hashlib import sha256
 from re import match
-import plyvel
 from binascii import hexlify, unhexlify
-from base58 import b58encode
-import sys
+from base58 import b58encode, b58decode_check
+import os
+import shutil
+from itertools import islice
+
+from metrics import Metrics
+from ldb import LevelDB
+
+try:
+    import plyvel
+except ImportError:
+    # the chainstate is read with the pure Python reader of ldb.py
+    plyvel = None
 
 # THIS functions are from bitcoin_tools and was only mildly changed.
 # Please refer to readme.md for the proper link to that library.
@@ -11,6 +21,17 @@ import sys
 # Fee per byte range
 NSPECIALSCRIPTS = 6
 
+# longest code | value | out_type prefix of a coin: 5 bytes for the height and coinbase flag, 10 for the compressed
+# amount of any int64 and 2 for the out_type
+COIN_HEADER_SIZE = 17
+
+# number of chainstate values de-obfuscated at once by the bytes decoder, larger batches do not get faster as the
+# big integers stop fitting in the cpu caches
+DEOBFUSCATE_BATCH = 1024
+
+# chainstate readers of open_chainstate
+LEVELDB_READERS = ('auto', 'plyvel', 'python')
+
 
 def txout_decompress(x):
     """ Decompresses the Satoshi amount of a UTXO stored in the LevelDB. Code is a port from the Bitcoin Core C++
@@ -41,6 +62,51 @@ def txout_decompress(x):
     return n
 
 
+def txout_compress(n):
+    """ Compresses the Satoshi amount of a UTXO to be stored in the LevelDB, inverse of txout_decompress. Code is a
+    port from the Bitcoin Core C++ source:
+        https://github.com/bitcoin/bitcoin/blob/v0.13.2/src/compressor.cpp#L133#L160
+
+    :param n: Amount of satoshi to be compressed.
+    :type n: int
+    :return: The compressed amount.
+    :rtype: int
+    """
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        assert 1 <= d <= 9
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+    else:
+        return 1 + (n - 1) * 10 + 9
+
+
+def b128_encode(n):
+    """ Performs the MSB base-128 encoding of a given value, inverse of b128_decode. Every byte holds 7 bits of the
+    value, most significant first, the bit 128 is set on every byte but the last one. One is subtracted from the value
+    at every continuation so that every value has a single encoding:
+        0 -> 00, 127 -> 7f, 128 -> 8000, 255 -> 807f, 16511 -> ff7f, 16512 -> 808000
+
+    :param n: Value to be encoded.
+    :type n: int
+    :return: The encoded value.
+    :rtype: bytes
+    """
+    out = bytearray([n & 0x7F])
+    n >>= 7
+    while n:
+        n -= 1
+        out.insert(0, 0x80 | (n & 0x7F))
+        n >>= 7
+    return bytes(out)
+
+
 def b128_decode(data):
     """ Performs the MSB base-128 decoding of a given value. Used to decode variable integers (varints) from the LevelDB.
     The code is a port from the Bitcoin Core C++ source. Notice that the code is not exactly the same since the original
@@ -304,47 +370,147 @@ def decode_utxo_v08_v014(utxo):
     return {'version': version, 'coinbase': coinbase, 'outs': outs, 'height': height}
 
 
-def parse_ldb(fin_name, network, version=0.15, types=(0, 1), raw_script=False):
-    '''
-    b58pubkey_prefix = 0   for mainnet
-                     = 111 for testnet, regtest
-    b58script_prefix = 5   for mainnet
-                     = 196 for testnet, regtest
-    '''
-    b58pubkey_prefixes = {
-        "main": 0,
-        "test": 111
-    }
-    b58script_prefixes = {
-        "main": 5,
-        "test": 196
-    }
-    prefixes = {
-        "main": "bc",
-        "test": "tb"
-    }
-
-    assert network in b58pubkey_prefixes
-    b58pubkey_prefix = b58pubkey_prefixes[network]
-    assert network in b58script_prefixes
-    b58script_prefix = b58script_prefixes[network]
-    assert network in prefixes
-    addrprefix = prefixes[network]
-
-    counter = 0
-    if 0.08 <= version < 0.15:
-        prefix = b'c'
-    elif version < 0.08:
-        raise Exception("The utxo decoder only works for version 0.08 onwards.")
+def read_b128(data, offset=0):
+    """ Reads a MSB base-128 varint straight from a bytes-like buffer. This is the bytes counterpart of parse_b128 +
+    b128_decode: no hex strings are built, the bytes are read in place starting at the given offset.
+
+    :param data: Buffer holding the serialized UTXO.
+    :type data: bytes, bytearray or memoryview
+    :param offset: Offset where the varint starts.
+    :type offset: int
+    :return: The decoded value, and the offset of the byte located right after it.
+    :rtype: int, int
+    """
+
+    n = 0
+    while True:
+        d = data[offset]
+        offset += 1
+        n = n << 7 | d & 0x7F
+        if d & 0x80:
+            n += 1
+        else:
+            return n, offset
+
+
+def encode_coin(height, coinbase, amount, out_type, data):
+    """
+    Serializes a v0.15+ coin (the value of a 'C' record, before obfuscation), inverse of decode_coin.
+
+    :param data: Script data, for out_type 2 - 5 with the leading type byte like decode_coin returns it.
+    :type data: bytes
+    :return: The serialized coin.
+    :rtype: bytes
+    """
+
+    if out_type in (2, 3, 4, 5):
+        assert data[0] == out_type
+        data = data[1:]
+    return b128_encode(2 * height + coinbase) + b128_encode(txout_compress(amount)) + b128_encode(out_type) + data
+
+
+def decode_coin_header(coin):
+    """
+    Decodes the leading varints of a de-obfuscated v0.15+ coin: code | value | out_type. They fit in the first
+    COIN_HEADER_SIZE bytes, so filters on the height, amount and type only need that prefix.
+
+    :param coin: The de-obfuscated coin, or at least its first COIN_HEADER_SIZE bytes.
+    :type coin: bytes, bytearray or memoryview
+    :return: The block height, coinbase flag, amount in satoshi, out_type and the offset of the script data.
+    :rtype: int, int, int, int, int
+    """
+
+    code, offset = read_b128(coin)
+    amount, offset = read_b128(coin, offset)
+    # out_types of the standard scripts fit in one byte
+    out_type = coin[offset]
+    if out_type < 0x80:
+        offset += 1
     else:
-        prefix = b'C'
+        out_type, offset = read_b128(coin, offset)
+    return code >> 1, code & 0x01, txout_decompress(amount), out_type, offset
 
-    # Open the LevelDB
-    db = plyvel.DB(fin_name, compression=None)  # Change with path to chainstate
 
-    # Load obfuscation key (if it exists)
-    o_key = db.get((unhexlify("0e00") + b"obfuscate_key"))
+def decode_coin(coin):
+    """
+    Decodes a de-obfuscated v0.15+ coin (the value of a 'C' record) working directly on a bytes-like buffer. The format
+    is the same as the one described in decode_utxo: code | value | out_type | script.
+
+    :param coin: The de-obfuscated coin.
+    :type coin: bytes, bytearray or memoryview
+    :return: The block height, coinbase flag, amount in satoshi, out_type and script data (without the leading and
+        tailing opcodes for the compressed script types).
+    :rtype: int, int, int, int, bytes
+    """
 
+    height, coinbase, amount, out_type, offset = decode_coin_header(coin)
+
+    if out_type in (0, 1):
+        data_size = 20
+    elif out_type in (2, 3, 4, 5):
+        data_size = 33
+        offset -= 1
+    else:
+        data_size = out_type - NSPECIALSCRIPTS
+
+    script = bytes(coin[offset:])
+    assert len(script) == data_size
+
+    return height, coinbase, amount, out_type, script
+
+
+def decode_coins(values, o_key=None, types=(0, 1), min_amount=0, min_height=0, max_height=None):
+    """
+    Decodes a batch of obfuscated v0.15+ coins, applying the filters as early as the format allows: when filtering,
+    only the first COIN_HEADER_SIZE bytes of every value are de-obfuscated to read its height, amount and out_type, and
+    only the selected values are de-obfuscated in full. The script data is only extracted for the out_types that can
+    have an address (see address_key), other outputs get empty data.
+
+    :param values: Obfuscated coins.
+    :type values: list of bytes
+    :param o_key: Obfuscation key without the leading length byte, None if the chainstate is not obfuscated.
+    :type o_key: bytes
+    :param types: P2PKH (0) and P2SH (1) outputs of other types are filtered out.
+    :param min_amount: Outputs of less satoshi are filtered out.
+    :param min_height: Outputs created before this height are filtered out.
+    :param max_height: Outputs created after this height are filtered out.
+    :return: (out_type, data, amount, height) of every value, data is None for the filtered out outputs.
+    :rtype: generator
+    """
+
+    pushdown = min_amount > 0 or min_height > 0 or max_height is not None or not {0, 1} <= set(types)
+    if max_height is None:
+        max_height = 1 << 62
+    if o_key is None:
+        coins = values
+    elif pushdown:
+        coins = deobfuscate_batch(o_key, [value[:COIN_HEADER_SIZE] for value in values])
+    else:
+        coins = deobfuscate_batch(o_key, values)
+
+    if not pushdown:
+        for coin in coins:
+            height, _, amount, out_type, offset = decode_coin_header(coin)
+            if out_type == 0 or out_type == 1 or out_type == P2WPKH:
+                yield out_type, bytes(coin[offset:]), amount, height
+            else:
+                yield out_type, b'', amount, height
+        return
+
+    for value, coin in zip(values, coins):
+        height, _, amount, out_type, offset = decode_coin_header(coin)
+        if amount < min_amount or height < min_height or height > max_height \
+                or out_type in (0, 1) and out_type not in types:
+            yield out_type, None, amount, height
+        elif out_type == 0 or out_type == 1 or out_type == P2WPKH:
+            if o_key is not None:
+                coin = deobfuscate_bytes(o_key, value)
+            yield out_type, bytes(coin[offset:]), amount, height
+        else:
+            yield out_type, b'', amount, height
+
+
+def _iter_outs_hex(records, o_key, version):
     # If the key exists, the leading byte indicates the length of the key (8 byte by default). If there is no key,
     # 8-byte zeros are used (since the key will be XORed with the given values).
     if o_key is not None:
@@ -353,72 +519,359 @@ def parse_ldb(fin_name, network, version=0.15, types=(0, 1), raw_script=False):
     # For every UTXO (identified with a leading 'c'), the key (tx_id) and the value (encoded utxo) is displayed.
     # UTXOs are obfuscated using the obfuscation key (o_key), in order to get them non-obfuscated, a XOR between the
     # value and the key (concatenated until the length of the value is reached) if performed).
-    not_decoded = [0, 0]
-    for key, o_value in db.iterator(prefix=prefix):
-        key = hexlify(key)
+    for raw_key, o_value in records:
+        key = hexlify(raw_key)
         if o_key is not None:
             value = deobfuscate_value(o_key, hexlify(o_value))
         else:
             value = hexlify(o_value)
 
-        # If the decode flag is passed, we also decode the utxo before storing it. This is really useful when running
-        # a full analysis since will avoid decoding the whole utxo set twice (once for the utxo and once for the tx
-        # based analysis)
         if version < 0.15:
             value = decode_utxo_v08_v014(value)
         else:
             value = decode_utxo(value, key, version)
 
+        # the size and the key of the record go with its first output
+        nbytes = len(raw_key) + len(o_value)
         for out in value['outs']:
-            # 0 --> P2PKH
-            # 1 --> P2SH
-            # 2 - 3 --> P2PK(Compressed keys)
-            # 4 - 5 --> P2PK(Uncompressed keys)
-
-            if counter % 1000 == 0:
-                sys.stdout.write('\r parsed transactions: %d' % counter)
-                sys.stdout.flush()
-            counter += 1
-
-            if out['out_type'] == 0:
-                if out['out_type'] not in types:
-                    continue
-                # p2pkh
-                # OP_DUP OP_HASH160 <hash> OP_EQUALVERIFY OP_CHECKSIG
-                add = '76a914' + out['data'] + '88ac'
-                if not raw_script:
-                    add = hash_160_to_btc_address(out['data'], b58pubkey_prefix)
-                yield add, out['amount'], value['height']
-            elif out['out_type'] == 1:
-                if out['out_type'] not in types:
-                    continue
-                # p2sh
-                # OP_HASH160 <hash> OP_EQUAL
-                add = 'a914' + out['data'] + '87'
-                if not raw_script:
-                    add = hash_160_to_btc_address(out['data'], b58pubkey_prefix)
-                yield add, out['amount'], value['height']
-            elif out['out_type'] == 28:
-                addr = out['data']
-                if not raw_script:
-                    import bech32
-                    addr = list(bytes.fromhex(out['data'][4:]))
-                    addr = bech32.convertbits(addr, 8, 5, True)
-                    assert isinstance(addr, list)
-                    assert all(isinstance(x, int) for x in addr)
-                    assert len(addr) == 20 or len(addr) == 32, len(addr)
-                    addr = bech32.bech32_encode(addrprefix, [0] + addr)
-                    if isinstance(addr, str):
-                        addr = addr.encode('ascii')
-                yield addr, out['amount'], value['height']
-            else:
-                not_decoded[0] += 1
-                not_decoded[1] += out['amount']
+            yield out['out_type'], unhexlify(out['data']), out['amount'], value['height'], nbytes, raw_key
+            nbytes = 0
+            raw_key = None
 
-    print('\nunable to decode %d transactions' % not_decoded[0])
-    print('totaling %d satoshi' % not_decoded[1])
 
-    db.close()
+def _iter_outs_bytes(records, o_key, **filters):
+    if o_key is not None:
+        o_key = o_key[1:]
+
+    # records are de-obfuscated by batches, see deobfuscate_batch
+    while True:
+        batch = list(islice(records, DEOBFUSCATE_BATCH))
+        if not batch:
+            return
+        values = [o_value for _, o_value in batch]
+        for (key, o_value), (out_type, data, amount, height) in zip(batch, decode_coins(values, o_key, **filters)):
+            yield out_type, data, amount, height, len(key) + len(o_value), key
+
+
+B58PUBKEY_PREFIXES = {
+    "main": 0,
+    "test": 111
+}
+B58SCRIPT_PREFIXES = {
+    "main": 5,
+    "test": 196
+}
+BECH32_PREFIXES = {
+    "main": "bc",
+    "test": "tb"
+}
+
+# out_type of the P2WPKH scripts (22 bytes + NSPECIALSCRIPTS)
+P2WPKH = 28
+
+
+def key_script(key):
+    """
+    Builds the scriptPubKey of a compact address key (see encode_key).
+
+    :param key: Compact address key.
+    :type key: bytes
+    :return: The script.
+    :rtype: bytes
+    """
+
+    out_type, h = key[0], key[1:]
+    if out_type == 0:
+        # p2pkh
+        # OP_DUP OP_HASH160 <hash> OP_EQUALVERIFY OP_CHECKSIG
+        return b'\x76\xa9\x14' + h + b'\x88\xac'
+    elif out_type == 1:
+        # p2sh
+        # OP_HASH160 <hash> OP_EQUAL
+        return b'\xa9\x14' + h + b'\x87'
+    elif out_type == P2WPKH:
+        # p2wpkh
+        # OP_0 <program>
+        return b'\x00\x14' + h
+    raise Exception("Unknown address key type %d" % out_type)
+
+
+def encode_key(key, network, raw_script=False):
+    """
+    Encodes a compact address key, as yielded by parse_ldb(compact=True), to its address or to its hex script.
+
+    The key is the out_type byte followed by the hash: the hash160 for P2PKH (0) and P2SH (1), the witness program
+    for P2WPKH (28).
+
+    :param key: Compact address key.
+    :type key: bytes
+    :param network: main or test
+    :type network: str
+    :param raw_script: Return the hex script instead of the address, see key_script.
+    :type raw_script: bool
+    :return: The address or the hex script.
+    :rtype: str
+    """
+
+    if raw_script:
+        return key_script(key).hex()
+    out_type, h = key[0], key[1:]
+    if out_type == 0:
+        return hash_160_to_btc_address(h, B58PUBKEY_PREFIXES[network]).decode('ascii')
+    elif out_type == 1:
+        return hash_160_to_btc_address(h, B58SCRIPT_PREFIXES[network]).decode('ascii')
+    elif out_type == P2WPKH:
+        import bech32
+        program = bech32.convertbits(list(h), 8, 5, True)
+        assert len(program) == 32, len(program)
+        return bech32.bech32_encode(BECH32_PREFIXES[network], [0] + program)
+    raise Exception("Unknown address key type %d" % out_type)
+
+
+def decode_address(address, network):
+    """
+    Decodes a P2PKH, P2SH or P2WPKH address to its compact address key, the inverse of encode_key.
+
+    :param address: Base58check or bech32 address.
+    :type address: str
+    :param network: main or test
+    :type network: str
+    :return: The compact address key, None if the address is not a valid address of these types on the network.
+    :rtype: bytes
+    """
+
+    import bech32
+    if address.lower().startswith(BECH32_PREFIXES[network] + '1'):
+        witver, program = bech32.decode(BECH32_PREFIXES[network], address)
+        if witver != 0 or len(program) != 20:
+            return None
+        return bytes((P2WPKH,)) + bytes(program)
+    try:
+        payload = b58decode_check(address)
+    except ValueError:
+        return None
+    if len(payload) != 21:
+        return None
+    if payload[0] == B58PUBKEY_PREFIXES[network]:
+        return b'\x00' + payload[1:]
+    if payload[0] == B58SCRIPT_PREFIXES[network]:
+        return b'\x01' + payload[1:]
+    return None
+
+
+def address_key(out_type, data):
+    """
+    Builds the compact address key of a decoded output (see encode_key).
+
+    :param out_type: out_type of the output.
+    :type out_type: int
+    :param data: Script data of the output, as decoded by decode_coin.
+    :type data: bytes
+    :return: The compact address key, None for outputs without address.
+    :rtype: bytes
+    """
+
+    if out_type == 0 or out_type == 1:
+        return bytes((out_type,)) + data
+    elif out_type == P2WPKH and data[:2] == b'\x00\x14':
+        return bytes((out_type,)) + data[2:]
+    return None
+
+
+def _iter_addresses(outs, network, types, raw_script, compact, metrics, min_amount, min_height, max_height, watch,
+                    checkpoint):
+    # common part of the chainstate and snapshot scans: counts the outputs yielded by the record decoders, see
+    # _iter_outs_bytes, applies the filters and builds the address keys, see parse_ldb for the arguments
+    outputs = metrics.outputs
+    not_decoded = metrics.not_decoded
+    nrecords = 0
+    nbytes = 0
+    for out_type, data, amount, height, size, record_key in outs:
+        # 0 --> P2PKH
+        # 1 --> P2SH
+        # 2 - 3 --> P2PK(Compressed keys)
+        # 4 - 5 --> P2PK(Uncompressed keys)
+        # 28 --> P2WPKH (any 22 bytes script, only OP_0 <20 bytes> is an address)
+
+        if size:
+            if nrecords == 10000:
+                metrics.tick(nrecords, nbytes)
+                nrecords = nbytes = 0
+                if checkpoint is not None:
+                    # the outputs of the previous records are consumed, the scan can resume at this record
+                    checkpoint(record_key)
+            nrecords += 1
+            nbytes += size
+
+        c = outputs.get(out_type)
+        if c is None:
+            c = outputs[out_type] = [0, 0]
+        c[0] += 1
+        c[1] += amount
+
+        if data is None or amount < min_amount or height < min_height or max_height is not None and height > max_height:
+            continue
+        key = address_key(out_type, data)
+        if key is None:
+            c = not_decoded.get(out_type)
+            if c is None:
+                c = not_decoded[out_type] = [0, 0]
+            c[0] += 1
+            c[1] += amount
+            continue
+        if out_type in (0, 1) and out_type not in types:
+            continue
+        if watch is not None and key not in watch:
+            continue
+
+        if compact:
+            yield key, amount, height
+        else:
+            yield encode_key(key, network, raw_script), amount, height
+    metrics.tick(nrecords, nbytes)
+
+
+def parse_ldb(fin_name, network, version=0.15, types=(0, 1), raw_script=False, decoder='bytes', start=None, stop=None,
+              db=None, verbose=True, compact=False, metrics=None, min_amount=0, min_height=0, max_height=None,
+              watch=None, checkpoint=None, reader='auto'):
+    '''
+    b58pubkey_prefix = 0   for mainnet
+                     = 111 for testnet, regtest
+    b58script_prefix = 5   for mainnet
+                     = 196 for testnet, regtest
+
+    decoder = 'bytes' decodes the records in place (v0.15+ only, older chainstates always use 'hex')
+            = 'hex'   goes through the hex string decoders of bitcoin_tools
+
+    start, stop limit the scan to the [start, stop) chainstate key range, by default all UTXO records are scanned.
+    db can be an already opened plyvel.DB or ldb.LevelDB, in that case fin_name is ignored and the db is left open,
+    otherwise fin_name is opened with the given reader (see open_chainstate).
+    compact yields the compact address keys (see encode_key) instead of the addresses, leaving the encoding to the
+    caller, which can do it once per address instead of once per output.
+    metrics is a metrics.Metrics receiving the scan counters, its total_bytes defaults to the LevelDB approximate size
+    of the scanned range.
+    min_amount, min_height, max_height skip the outputs of less satoshi, or created outside [min_height, max_height].
+    The bytes decoder tests them, and types, on the leading varints of the records before decoding the scripts (see
+    decode_coins). Skipped outputs are counted in the metrics outputs, not in the not decoded ones.
+    watch is a container of compact address keys (see watchlist.WatchList), only the outputs of these addresses are
+    yielded and the other addresses are never encoded.
+    checkpoint is called with the key of the next record every 10000 records, once the outputs of all the previous
+    records are consumed: a scan started at that key completes the consumed outputs (see checkpoint.Checkpoint).
+    '''
+
+    assert network in B58PUBKEY_PREFIXES
+    assert network in B58SCRIPT_PREFIXES
+    assert network in BECH32_PREFIXES
+    assert decoder in ('hex', 'bytes'), decoder
+
+    if 0.08 <= version < 0.15:
+        prefix = b'c'
+        decoder = 'hex'
+    elif version < 0.08:
+        raise Exception("The utxo decoder only works for version 0.08 onwards.")
+    else:
+        prefix = b'C'
+
+    # Open the LevelDB
+    close_db = db is None
+    if close_db:
+        db = open_chainstate(fin_name, reader)
+
+    # Load obfuscation key (if it exists)
+    o_key = db.get((unhexlify("0e00") + b"obfuscate_key"))
+
+    start = prefix if start is None else start
+    stop = bytes([prefix[0] + 1]) if stop is None else stop
+    if metrics is None:
+        metrics = Metrics()
+    if metrics.total_bytes is None:
+        metrics.total_bytes = db.approximate_size(start, stop)
+
+    records = db.iterator(start=start, stop=stop)
+    if decoder == 'bytes':
+        outs = _iter_outs_bytes(records, o_key, types=types, min_amount=min_amount, min_height=min_height,
+                                max_height=max_height)
+    else:
+        outs = _iter_outs_hex(records, o_key, version)
+
+    yield from _iter_addresses(outs, network, types, raw_script, compact, metrics, min_amount, min_height, max_height,
+                               watch, checkpoint)
+
+    if verbose:
+        total = metrics.not_decoded_total()
+        print('unable to decode %d transactions' % total[0])
+        print('totaling %d satoshi' % total[1])
+
+    if close_db:
+        db.close()
+
+
+def open_chainstate(path, reader='auto'):
+    """
+    Opens a chainstate directory read only.
+
+    :param path: Chainstate directory.
+    :type path: str
+    :param reader: 'plyvel' for the LevelDB library, 'python' for the pure Python reader of ldb.py, which needs no
+        native dependency and can be opened by many processes at once, 'auto' for plyvel when it is installed.
+    :type reader: str
+    :return: plyvel.DB or ldb.LevelDB
+    """
+
+    if resolve_reader(reader) == 'python':
+        return LevelDB(path)
+    return plyvel.DB(path, compression=None)
+
+
+def resolve_reader(reader):
+    """ The chainstate reader open_chainstate uses for reader, 'plyvel' or 'python'. """
+    assert reader in LEVELDB_READERS, reader
+    if reader == 'auto':
+        return 'python' if plyvel is None else 'plyvel'
+    if reader == 'plyvel' and plyvel is None:
+        raise Exception('plyvel is not installed, use the python chainstate reader')
+    return reader
+
+
+def key_ranges(prefix, n):
+    """
+    Splits the chainstate key space of the given record prefix into n disjoint [start, stop) ranges. Keys are sorted by
+    txid, so the ranges are cut on the first two txid bytes and hold roughly the same number of records.
+
+    :param prefix: Record prefix, b'C' for v0.15+ chainstates.
+    :type prefix: bytes
+    :param n: Number of ranges, up to 65536.
+    :type n: int
+    :return: The ranges, in key order.
+    :rtype: list of (bytes, bytes)
+    """
+
+    assert 0 < n <= 0x10000, n
+    bounds = [prefix + (i * 0x10000 // n).to_bytes(2, 'big') for i in range(n)] + [bytes([prefix[0] + 1])]
+    bounds[0] = prefix
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def clone_chainstate(src, dest):
+    """
+    Makes a private view of a chainstate directory that can be opened next to other views of the same chainstate
+    (LevelDB allows a single process to open a directory). Table files are symlinked, since LevelDB never modifies them
+    in place, everything else is copied.
+
+    :param src: Chainstate directory.
+    :type src: str
+    :param dest: Existing empty directory receiving the view.
+    :type dest: str
+    """
+
+    for name in os.listdir(src):
+        if name == 'LOCK':
+            continue
+        path = os.path.join(src, name)
+        if name.endswith('.ldb') or name.endswith('.sst'):
+            os.symlink(os.path.abspath(path), os.path.join(dest, name))
+        else:
+            shutil.copy2(path, os.path.join(dest, name))
 
 
 def deobfuscate_value(obfuscation_key, value):
@@ -445,9 +898,9 @@ def deobfuscate_value(obfuscation_key, value):
 
     r = format(int(value, 16) ^ int(extended_key, 16), 'x')
 
-    # In some cases, the obtained value could be 1 byte smaller than the original, since the leading 0 is dropped off
+    # In some cases, the obtained value could be smaller than the original, since the leading 0s are dropped off
     # when the formatting.
-    if len(r) is l_value-1:
+    if len(r) < l_value:
         r = r.zfill(l_value)
 
     assert len(value) == len(r)
@@ -455,6 +908,54 @@ def deobfuscate_value(obfuscation_key, value):
     return r
 
 
+def deobfuscate_bytes(obfuscation_key, value):
+    """
+    De-obfuscate a given raw value parsed from the chainstate. Bytes counterpart of deobfuscate_value.
+
+    :param obfuscation_key: Key used to obfuscate the given value, without the leading length byte.
+    :type obfuscation_key: bytes
+    :param value: Obfuscated value.
+    :type value: bytes
+    :return: The de-obfuscated value.
+    :rtype: bytes
+    """
+
+    l_value = len(value)
+    extended_key = (obfuscation_key * (l_value // len(obfuscation_key) + 1))[:l_value]
+
+    return (int.from_bytes(value, 'big') ^ int.from_bytes(extended_key, 'big')).to_bytes(l_value, 'big')
+
+
+def deobfuscate_batch(obfuscation_key, values):
+    """
+    De-obfuscates many raw values at once. The values are concatenated and XORed in a single big integer operation
+    with the concatenation of the key prefixes of their lengths, so the per value cost is a slice instead of the
+    conversions to and from int.
+
+    :param obfuscation_key: Key used to obfuscate the given values, without the leading length byte.
+    :type obfuscation_key: bytes
+    :param values: Obfuscated values.
+    :type values: list of bytes
+    :return: The de-obfuscated values, as views on one shared buffer.
+    :rtype: list of memoryview
+    """
+
+    lengths = [len(value) for value in values]
+    if not lengths:
+        return []
+    extended_key = obfuscation_key * (max(lengths) // len(obfuscation_key) + 1)
+    key_stream = b''.join([extended_key[:l_value] for l_value in lengths])
+    n = len(key_stream)
+    buf = memoryview((int.from_bytes(b''.join(values), 'big') ^ int.from_bytes(key_stream, 'big')).to_bytes(n, 'big'))
+
+    out = []
+    offset = 0
+    for l_value in lengths:
+        out.append(buf[offset:offset + l_value])
+        offset += l_value
+    return out
+
+
 def change_endianness(x):
     """ Changes the endianness (from BE to LE and vice versa) of a given value.
 
@@ -489,11 +990,11 @@ def hash_160_to_btc_address(h160, v):
     """
 
     # If h160 is passed as hex str, the value is converted into bytes.
-    if match('^[0-9a-fA-F]*$', h160):
+    if isinstance(h160, str) and match('^[0-9a-fA-F]*$', h160):
         h160 = unhexlify(h160)
 
     # Add the network version leading the previously calculated RIPEMD-160 hash.
-    vh160 = chr(v).encode('ascii') + h160
+    vh160 = bytes((v,)) + h160
     # Double sha256.
     h = sha256(sha256(vh160).digest()).digest()
     # Add the two first bytes of the result as a checksum tailing the RIPEMD-160 hash.
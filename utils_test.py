@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import plyvel
+
+from utils import *
+from gen_chainstate import obfuscate, generate_chainstate, generate_coins
+
+
+def make_chainstate(path, coins, o_key):
+    """ writes coins given as (txid, height, amount, out_type, data) into a new obfuscated chainstate """
+    db = plyvel.DB(path, create_if_missing=True, compression=None)
+    db.put(bytes.fromhex('0e00') + b'obfuscate_key', bytes([len(o_key)]) + o_key)
+    for txid, height, amount, out_type, data in coins:
+        db.put(b'C' + txid + b128_encode(0), obfuscate(o_key, encode_coin(height, 0, amount, out_type, data)))
+    db.close()
+
+
+class TestDecoder(unittest.TestCase):
+    O_KEY = bytes.fromhex('b12dcefd8f872536')
+
+    COINS = [
+        # (txid, height, amount, out_type, data)
+        (b'\x01' * 32, 500000, 5000000000, 0, bytes.fromhex('62e907b15cbf27d5425399ebf6f0fb50ebb88f18')),
+        (b'\x02' * 32, 600001, 123456789, 1, bytes.fromhex('8f55563b9a19f321c211e9b9f38cdf686ea07845')),
+        (b'\x03' * 32, 12, 1, 28, bytes.fromhex('0014751e76e8199196d454941c45d1b3a323f1433bd6')),
+        (b'\x04' * 32, 700000, 2100, 2, bytes.fromhex('02' + '11' * 32)),
+        (b'\x05' * 32, 1, 0, 0, bytes.fromhex('62e907b15cbf27d5425399ebf6f0fb50ebb88f18')),
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        make_chainstate(self.dir, self.COINS, self.O_KEY)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_b128(self):
+        for n in [0, 1, 127, 128, 255, 16383, 16384, 2 ** 40 + 3]:
+            data = b'\xff' + b128_encode(n) + b'\x00'
+            self.assertEqual((n, 1 + len(b128_encode(n))), read_b128(data, 1))
+            self.assertEqual(n, b128_decode(b128_encode(n).hex()))
+
+    def test_deobfuscate_bytes(self):
+        for value in [b'\x00', b'\x01\x02\x03', bytes(range(30))]:
+            obfuscated = obfuscate(self.O_KEY, value)
+            self.assertEqual(value, deobfuscate_bytes(self.O_KEY, obfuscated))
+            self.assertEqual(value.hex(), deobfuscate_value(self.O_KEY.hex(), obfuscated.hex()))
+
+    def test_deobfuscate_batch(self):
+        values = [b'\x00', b'', b'\x01\x02\x03', bytes(range(30)), b'\x00' * 9]
+        out = deobfuscate_batch(self.O_KEY, [obfuscate(self.O_KEY, value) for value in values])
+        self.assertEqual(values, [bytes(value) for value in out])
+        self.assertEqual([], deobfuscate_batch(self.O_KEY, []))
+
+    def test_decode_coin_matches_decode_utxo(self):
+        outpoint = (b'C' + b'\x01' * 32 + b'\x00').hex().encode()
+        for _, height, amount, out_type, data in self.COINS:
+            coin = encode_coin(height, 1, amount, out_type, data)
+            expected = decode_utxo(coin.hex(), outpoint)
+            self.assertEqual(data.hex(), expected['outs'][0]['data'])
+            self.assertEqual(
+                (expected['height'], expected['coinbase'], expected['outs'][0]['amount'],
+                 expected['outs'][0]['out_type'], data),
+                decode_coin(memoryview(coin))
+            )
+
+    def test_encoders(self):
+        for n in [0, 127, 128, 255, 16511, 16512]:
+            self.assertEqual(n, b128_decode(b128_encode(n).hex()))
+        self.assertEqual('808000', b128_encode(16512).hex())
+        for amount in [0, 1, 546, 2100, 123456789, 5000000000, 21 * 10 ** 14]:
+            self.assertEqual(amount, txout_decompress(txout_compress(amount)))
+
+    def test_generated_chainstate(self):
+        path = os.path.join(self.dir, 'generated')
+        o_key = generate_chainstate(path, 3000, seed=3)
+        coins = dict(generate_coins(3000, seed=3))
+        db = plyvel.DB(path)
+        try:
+            self.assertEqual(bytes([8]) + o_key, db.get(bytes.fromhex('0e00') + b'obfuscate_key'))
+            self.assertEqual(len(coins), sum(1 for _ in db.iterator(prefix=b'C')))
+            for key, value in db.iterator(prefix=b'C'):
+                self.assertEqual(coins[key], deobfuscate_bytes(o_key, value))
+        finally:
+            db.close()
+
+        outputs = list(parse_ldb(path, 'main', types={0, 1}, compact=True))
+        self.assertEqual(outputs, list(parse_ldb(path, 'main', types={0, 1}, compact=True, decoder='hex')))
+        self.assertGreater(len(outputs), 2000)
+
+    def test_encode_key(self):
+        p2pkh = b'\x00' + bytes.fromhex('62e907b15cbf27d5425399ebf6f0fb50ebb88f18')
+        p2sh = b'\x01' + bytes.fromhex('8f55563b9a19f321c211e9b9f38cdf686ea07845')
+        p2wpkh = bytes([P2WPKH]) + bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')
+        self.assertEqual('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', encode_key(p2pkh, 'main'))
+        self.assertEqual('3EktnHQD7RiAE6uzMj2ZifT9YgRrkSgzQX', encode_key(p2sh, 'main'))
+        self.assertEqual('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', encode_key(p2wpkh, 'main'))
+        self.assertEqual('2', encode_key(p2sh, 'test')[0])
+        self.assertEqual('tb1', encode_key(p2wpkh, 'test')[:3])
+        self.assertEqual('a9148f55563b9a19f321c211e9b9f38cdf686ea0784587', encode_key(p2sh, 'main', raw_script=True))
+        self.assertEqual('0014751e76e8199196d454941c45d1b3a323f1433bd6', encode_key(p2wpkh, 'test', raw_script=True))
+
+    def test_decode_address(self):
+        for key in [b'\x00' + bytes(range(20)), b'\x01' + bytes(range(20)), bytes([P2WPKH]) + bytes(range(20))]:
+            for network in ['main', 'test']:
+                self.assertEqual(key, decode_address(encode_key(key, network), network))
+        self.assertEqual(None, decode_address(encode_key(b'\x00' + bytes(20), 'test'), 'main'))
+        self.assertEqual(None, decode_address('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb', 'main'))
+        self.assertEqual(None, decode_address('bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3', 'main'))
+        self.assertEqual(None, decode_address('not an address', 'main'))
+
+    def test_parse_ldb_decoders_agree(self):
+        for raw_script in [False, True]:
+            results = [
+                list(parse_ldb(self.dir, 'main', types={0, 1}, raw_script=raw_script, decoder=decoder))
+                for decoder in ['hex', 'bytes']
+            ]
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(4, len(results[1]))
+
+        self.assertEqual(
+            ('76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac', 5000000000, 500000),
+            next(parse_ldb(self.dir, 'main', raw_script=True))
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import math
+
+from aggregation import AddressTable
+from utils import decode_address
+
+
+class BloomFilter:
+    """
+    Bloom filter of compact address keys. Keys end with a hash, so the bit positions are derived from their bytes
+    directly (double hashing over two 8 bytes words) instead of hashing them again.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: Number of keys the filter is sized for.
+        :param error_rate: False positive rate at capacity.
+        """
+        capacity = max(1, capacity)
+        self.nbits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self._bits = bytearray((self.nbits + 7) // 8)
+
+    def _positions(self, key):
+        h1 = int.from_bytes(key[-8:], 'little')
+        h2 = int.from_bytes(key[-16:-8], 'little') | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & 1 << (pos & 7):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+
+class WatchList:
+    """
+    Set of watched compact address keys, and the table their balances are aggregated in. Every watched address is in
+    the table from the start with a zero balance, so the addresses without any output are reported too.
+
+    Membership is tested with a Python set by default. With bloom, a Bloom filter in front of the table replaces the
+    set: non watched keys are mostly rejected by the filter, and the table probing confirms the rest. Slower, but
+    without the set and its per key objects for lists of many millions of addresses.
+    """
+
+    def __init__(self, keys, bloom=False, error_rate=0.001):
+        self.table = AddressTable()
+        for key in keys:
+            self.table.add(key, 0, 0)
+        if bloom:
+            self._set = None
+            self.bloom = BloomFilter(len(self.table), error_rate)
+            for key, _, _ in self.table:
+                self.bloom.add(key)
+        else:
+            self._set = set(key for key, _, _ in self.table)
+            self.bloom = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        if self._set is not None:
+            return key in self._set
+        return key in self.bloom and key in self.table
+
+    def add(self, key, amount, height):
+        self.table.add(key, amount, height)
+
+
+def read_addresses(path, network):
+    """
+    Reads a list of addresses, one per line. Only the first comma separated field is read, so the CSV written by
+    btcposbal2csv can be used as a list too. Empty lines and the CSV header are skipped.
+
+    :return: The compact address keys, and the lines which are not P2PKH, P2SH or P2WPKH addresses of the network.
+    :rtype: list, list
+    """
+    keys = []
+    invalid = []
+    with open(path) as f:
+        for line in f:
+            address = line.split(',', 1)[0].strip()
+            if not address or address == 'address':
+                continue
+            key = decode_address(address, network)
+            if key is None:
+                invalid.append(address)
+            else:
+                keys.append(key)
+    return keys, invalid
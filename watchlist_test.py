@@ -0,0 +1,34 @@
+import random
+import unittest
+
+from watchlist import *
+
+
+class TestWatchList(unittest.TestCase):
+    def keys(self, n, seed):
+        rnd = random.Random(seed)
+        return [bytes([rnd.choice([0, 1, 28])]) + rnd.randbytes(20) for _ in range(n)]
+
+    def test_bloom_filter(self):
+        keys = self.keys(10000, 1)
+        bloom = BloomFilter(len(keys), error_rate=0.01)
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(key in bloom for key in self.keys(10000, 2))
+        self.assertLess(false_positives, 300)
+
+    def test_watch_list(self):
+        keys = self.keys(1000, 1)
+        others = self.keys(1000, 2)
+        for bloom in [False, True]:
+            watch = WatchList(keys + keys[:10], bloom=bloom)
+            self.assertEqual(1000, len(watch))
+            self.assertTrue(all(key in watch for key in keys))
+            self.assertFalse(any(key in watch for key in others))
+            watch.add(keys[5], 7, 100)
+            self.assertEqual((7, 100), watch.table.get(keys[5]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+"""
+Buffered binary output files. Rows are formatted by the callers in bulk and written as large byte chunks, the
+compression and the writes run on a background thread, so the output overlaps with the scan and the formatting.
+
+Compressions: gzip and xz (standard library), zstd (needs the zstandard package). With several threads every chunk is
+compressed independently, as a gzip member, an xz stream or a zstd frame: their concatenation is a valid file of the
+format, decompressed by the usual tools.
+"""
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+COMPRESSIONS = ('auto', 'none', 'gzip', 'xz', 'zstd')
+SUFFIXES = {'.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}
+STDOUT = '-'
+CHUNK_SIZE = 1 << 20
+# lines formatted and encoded at once by LineWriter
+LINES_PER_WRITE = 10000
+
+
+def compression_of(path, compression='auto'):
+    """ Compression of an output file, 'auto' picks it from the file suffix. """
+    assert compression in COMPRESSIONS, compression
+    if compression != 'auto':
+        return compression
+    for suffix, name in SUFFIXES.items():
+        if path.endswith(suffix):
+            return name
+    return 'none'
+
+
+def split_suffix(path):
+    """ Splits the compression suffix off a path: ('out', '.gz') for 'out.gz', (path, '') without suffix. """
+    for suffix in SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)], suffix
+    return path, ''
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zstd compression needs the zstandard package: pip install zstandard')
+    return zstandard
+
+
+def _compressor(compression, level):
+    """ Streaming compressor, with compress and flush methods. """
+    if compression == 'gzip':
+        import zlib
+        # wbits 31: gzip header and trailer
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+    if compression == 'xz':
+        import lzma
+        return lzma.LZMACompressor(preset=level)
+    if compression == 'zstd':
+        return _zstd().ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise Exception('Unknown compression %s' % compression)
+
+
+def _compress_chunk(compression, level, data):
+    """ Compresses a chunk as a complete gzip member, xz stream or zstd frame. """
+    compressor = _compressor(compression, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class OutputWriter:
+    """
+    Binary output file, - for stdout. write buffers the data and hands chunks of CHUNK_SIZE bytes to a background
+    thread which compresses and writes them, with threads > 1 the chunks are compressed in parallel by a thread pool
+    (zlib, lzma and zstandard release the GIL) and written in order. Errors of the background thread are raised by the
+    next write or by close.
+    """
+
+    def __init__(self, path, compression='auto', level=None, threads=1, chunk_size=CHUNK_SIZE):
+        """
+        :param path: Output file, - for stdout.
+        :param compression: One of COMPRESSIONS, 'auto' picks it from the file suffix (.gz, .xz, .zst).
+        :param level: Compression level, default of the compression if None.
+        :param threads: Number of compressing threads.
+        :param chunk_size: Bytes buffered before a chunk is handed to the background thread.
+        """
+        self.path = path
+        self.compression = compression_of(path, compression)
+        if self.compression != 'none':
+            # a missing zstandard or a bad level fails now rather than after the scan
+            _compressor(self.compression, level)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # seconds the background thread spent compressing and writing, and the writer spent waiting for it
+        self.busy = 0.0
+        self.blocked = 0.0
+        self._level = level
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        # the process stdout, even when sys.stdout is redirected to keep the progress messages out of the output
+        self._f = sys.__stdout__.buffer if path == STDOUT else open(path, 'wb', buffering=0)
+        self._pool = ThreadPoolExecutor(threads) if threads > 1 and self.compression != 'none' else None
+        self._queue = queue.Queue(2 * threads + 2)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        compressor = None
+        done = False
+        try:
+            if self._pool is None and self.compression != 'none':
+                compressor = _compressor(self.compression, self._level)
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    done = True
+                    break
+                start = time.perf_counter()
+                if self._pool is not None:
+                    data = item.result()
+                elif compressor is not None:
+                    data = compressor.compress(item)
+                else:
+                    data = item
+                self._f.write(data)
+                self.bytes_out += len(data)
+                self.busy += time.perf_counter() - start
+            if compressor is not None:
+                data = compressor.flush()
+                self._f.write(data)
+                self.bytes_out += len(data)
+            self._f.flush()
+        except BaseException as e:
+            self._error = e
+            # unblock write, unless the end was already received (the final flush failed)
+            while not done:
+                done = self._queue.get() is None
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _hand_off(self):
+        chunk = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._pool is not None:
+            chunk = self._pool.submit(_compress_chunk, self.compression, self._level, chunk)
+        start = time.perf_counter()
+        self._queue.put(chunk)
+        self.blocked += time.perf_counter() - start
+
+    def write(self, data):
+        self._check()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes_in += len(data)
+        if self._buffered >= self._chunk_size:
+            self._hand_off()
+
+    def close(self):
+        """ Writes the buffered data, waits for the background thread and closes the file (stdout stays open). """
+        if self._thread is None:
+            return
+        if self._buffered and self._error is None:
+            self._hand_off()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self.path != STDOUT:
+            self._f.close()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def report(self):
+        """
+        Written bytes, the rate of the background thread and the time the writer was blocked on it, once closed. The
+        output is not the bottleneck of a run as long as the blocked time stays small.
+        """
+        rate = self.bytes_in / self.busy / 1e6 if self.busy else 0.0
+        compressed = '' if self.compression == 'none' else ', %.1f MB %s' % (self.bytes_out / 1e6, self.compression)
+        return '%s: %.1f MB%s, %.1f MB/s, blocked %.2f s' % (self.path, self.bytes_in / 1e6, compressed, rate,
+                                                             self.blocked)
+
+
+class LineWriter:
+    """ Text lines joined and encoded in batches of LINES_PER_WRITE into an OutputWriter. """
+
+    def __init__(self, path, header=None, **output):
+        """
+        :param header: First line, if any.
+        :param output: OutputWriter options.
+        """
+        self.out = OutputWriter(path, **output)
+        self._lines = [] if header is None else [header]
+
+    def add(self, line):
+        self._lines.append(line)
+        if len(self._lines) >= LINES_PER_WRITE:
+            self._flush()
+
+    def _flush(self):
+        self.out.write(('\n'.join(self._lines) + '\n').encode())
+        self._lines = []
+
+    def close(self, trailer=None):
+        """ Writes the remaining lines and a last trailer line, if any, then closes the file. """
+        if trailer is not None:
+            self._lines.append(trailer)
+        try:
+            if self._lines:
+                self._flush()
+        finally:
+            self.out.close()
@@ -0,0 +1,81 @@
+import gzip
+import lzma
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from writers import LineWriter, OutputWriter, compression_of, split_suffix
+
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rnd = random.Random(3)
+        self.chunks = [('%040x,%d\n' % (rnd.getrandbits(160), rnd.randrange(10 ** 9))).encode() * rnd.randrange(50)
+                       for _ in range(2000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, **output):
+        path = os.path.join(self.dir, name)
+        with OutputWriter(path, chunk_size=1 << 14, **output) as w:
+            for chunk in self.chunks:
+                w.write(chunk)
+        self.assertEqual(sum(map(len, self.chunks)), w.bytes_in)
+        self.assertEqual(os.path.getsize(path), w.bytes_out)
+        return path
+
+    def test_compression_of(self):
+        self.assertEqual('gzip', compression_of('out.csv.gz'))
+        self.assertEqual('none', compression_of('out.csv'))
+        self.assertEqual('xz', compression_of('out.csv', 'xz'))
+        self.assertEqual(('out', '.zst'), split_suffix('out.zst'))
+        self.assertEqual(('out.csv', ''), split_suffix('out.csv'))
+
+    def test_plain(self):
+        with open(self.write('out.csv'), 'rb') as f:
+            self.assertEqual(b''.join(self.chunks), f.read())
+
+    def test_compressed(self):
+        expected = b''.join(self.chunks)
+        for threads in [1, 4]:
+            with gzip.open(self.write('out%d.csv.gz' % threads, threads=threads)) as f:
+                self.assertEqual(expected, f.read())
+            with lzma.open(self.write('out%d.csv.xz' % threads, threads=threads, level=0)) as f:
+                self.assertEqual(expected, f.read())
+
+    def test_error(self):
+        self.assertRaises(ValueError, OutputWriter, os.path.join(self.dir, 'out.gz'), level=42)
+        w = OutputWriter(os.path.join(self.dir, 'out.csv'))
+        w._f.close()
+        w.write(b'x')
+        self.assertRaises(ValueError, w.close)
+
+    def test_flush_error(self):
+        # the final flush fails once every chunk is written, close raises instead of waiting forever
+        w = OutputWriter(os.path.join(self.dir, 'out.csv.gz'))
+        w.write(b'x')
+
+        def fail():
+            raise OSError('No space left on device')
+        w._f.flush = fail
+        self.assertRaises(OSError, w.close)
+
+    def test_line_writer(self):
+        path = os.path.join(self.dir, 'lines.csv')
+        w = LineWriter(path, 'a,b')
+        for i in range(25000):
+            w.add('%d,%d' % (i, i * i))
+        w.close(trailer='')
+        with open(path) as f:
+            lines = f.read().split('\n')
+        self.assertEqual(['a,b', '0,0', '1,1'], lines[:3])
+        self.assertEqual(['24999,624950001', '', ''], lines[-3:])
+
+
+if __name__ == '__main__':
+    unittest.main()